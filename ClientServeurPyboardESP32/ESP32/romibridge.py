@@ -0,0 +1,385 @@
+############
+# romibridge.py for Micropython on ESP32
+#
+# Bridge between the web sockets of the web server and the serial link to the
+# other board which controls the Romi chassis (see romimain.py).
+#
+# Each request is tagged with a sequence number, as in "#12 STAT", and the 
+# other board answers with the same tag, as in "#12 UPDATE ...", so that several
+# requests can be in flight and each answer is sent back to the web socket 
+# which made the request. The serial link is read in the background by a 
+# uasyncio task, so that a slow answer from the other board does not block 
+# the web server.
+# The messages are sent in COBS frames with a CRC16 (see romilink.py). A request
+# whose answer is lost or corrupted is sent again, and the other board answers
+# it again without executing it twice.
+# Untagged messages from the other board, such as status updates and the end of
+# moves, are pushed to all the web sockets.
+# The bridge keeps the last status of the chassis, from the pushed updates and
+# from the answers to STAT, and answers STAT itself when this status is recent
+# enough. When no update arrives, it polls the other board in the background.
+#
+# The web sockets only need a SendText method, and the UART read, write and
+# init methods, so the bridge can be tested on a host (see tools/bridgetest.py).
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import time
+import random
+import _thread
+import uasyncio
+from romilink import FrameLink
+
+# Baud rates to try when starting, in increasing order
+BAUDRATES = (230400, 460800, 921600)
+
+"""
+Bridge between the web sockets and the serial link to the other board.
+A request which is not answered within 'retry_ms' is sent again, at most 
+'maxretries' times, before getting a "NOK" answer. At most 'maxpending' 
+requests can be in flight at the same time.
+STAT is answered from the cached status when it is less than 'max_age_ms' old,
+and the status is polled when it has not been updated for 'poll_ms' (0 for no poll).
+The cached status is dropped when another command is sent to the other board,
+since this command may change the status, and the answers to the requests sent
+before this command are then not used to update the cache.
+The web sockets are only written from the uasyncio tasks, never from the 
+thread of the web server.
+"""
+class UartBridge :
+  def __init__(self, uart, baudrate=115200, retry_ms=300, maxretries=2, maxpending=16,
+               max_age_ms=250, poll_ms=200) :
+    self.uart = uart
+    self.link = FrameLink(uart)
+    self.baudrate = baudrate
+    self.retry_ms = retry_ms
+    self.maxretries = maxretries
+    self.maxpending = maxpending
+    self.pending = {}       # [web socket, time, message, tries, epoch] of the requests, by sequence number
+    self.replies = []       # (web socket, text) of the answers made by the bridge
+    self.sockets = []       # open web sockets
+    self.seq = 0
+    self.lock = _thread.allocate_lock()   # for the pending requests and the link
+    self.retries = 0        # number of requests sent again
+    self.timeouts = 0       # number of requests without answer
+    self.orphans = 0        # number of answers to unknown requests
+    self.control_answer = None  # answer to the last control message (tag #0)
+    self.wake = uasyncio.ThreadSafeFlag()  # set when there are replies to send
+    self.max_age_ms = max_age_ms
+    self.poll_ms = poll_ms
+    self.status = None      # last status of the chassis
+    self.status_ms = 0      # time of the last status
+    self.epoch = 0          # number of commands sent which may change the status
+    self.poll_epoch = 0     # epoch of the last poll
+    self.hits = 0           # number of STAT answered from the cache
+    self.misses = 0         # number of STAT sent to the other board
+    self.stale = 0          # number of misses because the cached status was too old
+    self.hit_age_ms = 0     # total age of the cached status at the hits
+    self.max_hit_age_ms = 0 # maximum age of the cached status at the hits
+    self.polls = 0          # number of polls of the status
+    self.updates = 0        # number of updates of the cached status
+
+  """
+  Send request 'msg' from 'webSocket' on the serial link.
+  Called from the thread of the web server, does not wait for the answer.
+  """
+  def request(self, webSocket, msg) :
+    cmd = msg.strip()
+    if cmd == "BRIDGESTAT" :
+      self.reply(webSocket, self.stats())
+      return
+    if cmd == "CACHESTAT" :
+      self.reply(webSocket, self.cache_stats())
+      return
+    if cmd == "STAT" and self.cached_status(webSocket) :
+      return
+    with self.lock :
+      busy = len(self.pending) >= self.maxpending
+    if busy :
+      self.reply(webSocket, "NOK Busy")
+      return
+    with self.lock :
+      if cmd != "STAT" :   # the command may change the status, which is no longer valid
+        self.status = None
+        self.epoch += 1
+      self.seq = self.seq % 0xffff + 1    # sequence number 0 is for controlling the link
+      message = ("#%d %s" % (self.seq, msg)).encode()
+      self.pending[self.seq] = [webSocket, time.ticks_ms(), message, 0, self.epoch]
+      self.link.send(message)
+
+  """
+  Queue answer 'text' for 'webSocket'.
+  """
+  def reply(self, webSocket, text) :
+    with self.lock :
+      self.replies.append((webSocket, text))
+    self.wake.set()
+
+  """
+  Answer STAT to 'webSocket' with the cached status if it is recent enough.
+  Return False if the request must be sent to the other board.
+  """
+  def cached_status(self, webSocket) :
+    status = self.status
+    if status is None :
+      self.misses += 1
+      return False
+    age = time.ticks_diff(time.ticks_ms(), self.status_ms)
+    if age > self.max_age_ms :
+      self.misses += 1
+      self.stale += 1
+      return False
+    self.hits += 1
+    self.hit_age_ms += age
+    if age > self.max_hit_age_ms :
+      self.max_hit_age_ms = age
+    self.reply(webSocket, status)
+    return True
+
+  """
+  Get the statistics of the status cache: hits, misses, stale misses, 
+  mean and maximum age of the status at the hits, polls and updates.
+  """
+  def cache_stats(self) :
+    mean = self.hit_age_ms // self.hits if self.hits > 0 else 0
+    return "CACHESTAT %d %d %d %d %d %d %d" % (self.hits, self.misses, self.stale,
+              mean, self.max_hit_age_ms, self.polls, self.updates)
+
+  """
+  Send a message which is not a request, such as CLOSE.
+  """
+  def notify(self, msg) :
+    with self.lock :
+      self.link.send(msg.encode())
+
+  """
+  Get the statistics of the bridge and of the link.
+  """
+  def stats(self) :
+    link = self.link
+    return "BRIDGESTAT %d %d %d %d %d %d %d %d" % (self.baudrate, link.received, link.sent, 
+              link.crc_errors, link.overruns, self.retries, self.timeouts, self.orphans)
+
+  """
+  Add 'webSocket' to the web sockets which receive the pushed messages.
+  """
+  def connect(self, webSocket) :
+    with self.lock :
+      self.sockets.append(webSocket)
+
+  """
+  Forget 'webSocket' and its requests (when it is closed).
+  """
+  def forget(self, webSocket) :
+    with self.lock :
+      self.sockets = [ws for ws in self.sockets if ws is not webSocket]
+      for seq in [s for s in self.pending if self.pending[s][0] is webSocket] :
+        del self.pending[seq]
+      self.replies = [r for r in self.replies if r[0] is not webSocket]
+
+  """
+  Handle a message received from the other board.
+  Untagged messages are pushed to all the web sockets.
+  """
+  def received(self, msg) :
+    if len(msg) == 0 :
+      return
+    buf = bytes(msg)
+    if buf[0] != 35 :           # not tagged by '#'
+      text = buf.decode()
+      self.update_status(text)
+      self.broadcast(text)
+      return
+    space = buf.find(b' ')
+    try :
+      seq = int(buf[1:space])
+    except ValueError :
+      return
+    text = buf[space+1:].decode()
+    if seq == 0 :
+      if self.poll_epoch == self.epoch :
+        self.update_status(text)
+      self.control_answer = text.strip()
+      return
+    with self.lock :
+      entry = self.pending.pop(seq, None)
+    if entry is None :          # late answer to a request which timed out
+      self.orphans += 1
+      return
+    if entry[4] == self.epoch : # no command changed the status since the request
+      self.update_status(text)
+    try :
+      entry[0].SendText(text)
+    except Exception as err :
+      print("WS SEND ERROR: %s" % err)
+
+  """
+  Keep 'text' as the status of the chassis if it is an UPDATE.
+  """
+  def update_status(self, text) :
+    if text.startswith("UPDATE") :
+      self.status = text
+      self.status_ms = time.ticks_ms()
+      self.updates += 1
+
+  """
+  Task which polls the status of the chassis when it has not been updated
+  for 'poll_ms'. The answer is only used to update the cache.
+  """
+  async def poller(self) :
+    while True :
+      await uasyncio.sleep_ms(self.poll_ms)
+      if self.status is None or time.ticks_diff(time.ticks_ms(), self.status_ms) >= self.poll_ms :
+        self.polls += 1
+        with self.lock :
+          self.poll_epoch = self.epoch
+          self.link.send(b"#0 STAT")
+
+  """
+  Send 'text' to all the web sockets.
+  """
+  def broadcast(self, text) :
+    for ws in self.sockets :
+      try :
+        ws.SendText(text)
+      except Exception as err :
+        print("WS SEND ERROR: %s" % err)
+
+  """
+  Read the frames on the serial link and send the answers to the web sockets 
+  which made the requests.
+  """
+  async def reader(self, stream) :
+    while True :
+      data = await stream.read(128)
+      self.link.feed(data, self.received)
+
+  """
+  Send again the requests which were not answered in time, answer "NOK" to 
+  the requests which were sent too many times, and send the queued replies.
+  """
+  async def sweeper(self, period_ms=50) :
+    while True :
+      try :                       # wait for the period or for replies to send
+        await uasyncio.wait_for_ms(self.wake.wait(), period_ms)
+      except uasyncio.TimeoutError :
+        pass
+      now = time.ticks_ms()
+      with self.lock :
+        for seq in [s for s in self.pending 
+                      if time.ticks_diff(now, self.pending[s][1]) > self.retry_ms] :
+          entry = self.pending[seq]
+          if entry[3] < self.maxretries :
+            entry[1] = now
+            entry[3] += 1
+            self.retries += 1
+            self.link.send(entry[2])
+          else :
+            del self.pending[seq]
+            self.replies.append((entry[0], "NOK Timeout"))
+            self.timeouts += 1
+        replies = self.replies
+        self.replies = []
+      for (ws, text) in replies :
+        try :
+          ws.SendText(text)
+        except Exception as err :
+          print("WS SEND ERROR: %s" % err)
+
+  """
+  Send control message 'msg' and wait for its answer during at most 'timeout_ms'.
+  Return the answer, or None if there was no valid answer.
+  Used while negotiating the baud rate, before the other tasks run.
+  """
+  async def control(self, stream, msg, timeout_ms=200) :
+    self.control_answer = None
+    with self.lock :
+      self.link.send(("#0 %s" % msg).encode())
+    deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+    while self.control_answer is None :
+      remaining = time.ticks_diff(deadline, time.ticks_ms())
+      if remaining <= 0 :
+        return None
+      try :
+        data = await uasyncio.wait_for_ms(stream.read(128), remaining)
+      except uasyncio.TimeoutError :
+        return None
+      self.link.feed(data, self.received)
+    return self.control_answer
+
+  """
+  Set the baud rate of the UART.
+  """
+  def set_baudrate(self, rate) :
+    time.sleep_ms(2)        # let the last byte go out
+    self.uart.init(baudrate=rate)
+    self.baudrate = rate
+
+  """
+  Try to switch the link to 'rate': the other board switches after answering
+  BAUD, then we check that 'pings' PING messages are answered without error 
+  at the new rate before confirming it with BAUDOK. If the rate is not 
+  confirmed, the other board falls back to the previous rate after 'fallback_ms'.
+  Return True if the link now runs at 'rate'.
+  """
+  async def try_baudrate(self, stream, rate, pings=20, fallback_ms=1000) :
+    old = self.baudrate
+    if await self.control(stream, "BAUD %d" % rate) != "OK" :
+      return False
+    self.set_baudrate(rate)
+    pattern = "0123456789ABCDEF" * 4
+    ok = True
+    for i in range(pings) :
+      if await self.control(stream, "PING %d %s" % (i, pattern)) != "PONG %d %s" % (i, pattern) :
+        ok = False
+        break
+    if ok :
+      for i in range(3) :         # BAUDOK may be sent again, it does not change anything
+        if await self.control(stream, "BAUDOK") == "OK" :
+          return True
+    self.set_baudrate(old)
+    await uasyncio.sleep_ms(fallback_ms + 200)  # let the other board fall back
+    return False
+
+  """
+  Start a new session with the other board, so that it forgets the answers 
+  to the requests of the previous session, whose sequence numbers are used 
+  again. The other board may still be at a rate negotiated before the ESP32 
+  was reset, so HELLO is tried at each rate of 'rates'.
+  Return True if the other board answered.
+  """
+  async def hello(self, stream, rates=(115200,) + BAUDRATES) :
+    nonce = "%d" % random.getrandbits(24)
+    for rate in rates :
+      self.set_baudrate(rate)
+      for i in range(3) :
+        if await self.control(stream, "HELLO " + nonce) == "HELLO " + nonce :
+          return True
+    self.set_baudrate(rates[0])
+    return False
+
+  """
+  Step up the baud rate of the link to the highest rate of 'rates' which works.
+  """
+  async def negotiate(self, stream, rates=BAUDRATES) :
+    for rate in rates :
+      if rate <= self.baudrate :
+        continue
+      if not await self.try_baudrate(stream, rate) :
+        break
+    print("UART at %d bauds" % self.baudrate)
+
+  """
+  Run the tasks of the bridge, after starting a session and negotiating the baud rate.
+  """
+  async def run(self) :
+    stream = uasyncio.StreamReader(self.uart)
+    if not await self.hello(stream) :
+      print("No answer to HELLO from the other board")
+    await self.negotiate(stream)
+    uasyncio.create_task(self.sweeper())
+    if self.poll_ms > 0 :
+      uasyncio.create_task(self.poller())
+    await self.reader(stream)
@@ -0,0 +1,180 @@
+############
+# romilink.py for Micropython on ESP32 and Pyboard
+#
+# This module provides the link layer of the serial link between the ESP32
+# and the Pyboard. Each message is sent in a frame made of the message and
+# its CRC16 (CCITT, big endian), encoded with COBS (Consistent Overhead Byte
+# Stuffing) so that it contains no 0 byte, and terminated by a 0 byte.
+# A corrupted frame is detected by its CRC and dropped, and the receiver
+# resynchronizes on the next 0 byte.
+#
+# See https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+from array import array
+
+"""
+Build the table of the CRC16 CCITT (polynomial 0x1021).
+"""
+def _crc_table() :
+  table = array('H', [0] * 256)
+  for i in range(256) :
+    crc = i << 8
+    for b in range(8) :
+      if crc & 0x8000 :
+        crc = ((crc << 1) ^ 0x1021) & 0xffff
+      else :
+        crc = (crc << 1) & 0xffff
+    table[i] = crc
+  return table
+
+_CRC_TABLE = _crc_table()
+
+"""
+Compute the CRC16 CCITT of the bytes of 'buf' from 'start' to 'end'.
+"""
+def crc16(buf, start, end, crc=0xffff) :
+  table = _CRC_TABLE
+  for i in range(start, end) :
+    crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ buf[i]]
+  return crc
+
+"""
+Get the index of the first 0 byte of 'data' from 'start' to 'end', or 'end'
+if there is none. bytearray has no find method in MicroPython.
+"""
+def find_zero(data, start, end) :
+  while start < end and data[start] != 0 :
+    start += 1
+  return start
+
+"""
+COBS encode the first 'n' bytes of 'data' into 'out',
+which must hold at least n + n // 254 + 1 bytes.
+Return the length of the encoded data, without the terminating 0.
+"""
+def cobs_encode(data, n, out) :
+  i = 0
+  o = 0
+  while True :
+    end = min(n, i + 254)
+    j = find_zero(data, i, end)
+    out[o] = j - i + 1
+    out[o+1:o+1+j-i] = data[i:j]
+    o += j - i + 1
+    if j - i == 254 :             # block of 254 non zero bytes, without 0
+      i = j
+    elif j < n :                  # the block ends with a 0
+      i = j + 1
+    else :                        # end of the data
+      break
+  return o
+
+"""
+COBS decode the first 'n' bytes of 'data' into 'out'.
+Return the length of the decoded data, or None if the data is not valid.
+"""
+def cobs_decode(data, n, out) :
+  i = 0
+  o = 0
+  size = len(out)
+  while i < n :
+    code = data[i]
+    if code == 0 or i + code > n or o + code - 1 > size :
+      return None
+    out[o:o+code-1] = data[i+1:i+code]
+    o += code - 1
+    i += code
+    if code < 0xff and i < n :
+      if o == size :
+        return None
+      out[o] = 0
+      o += 1
+  return o
+
+"""
+Framed link on 'uart', for messages of at most 'maxlen' bytes.
+'feed' is given the bytes read on the UART and calls a handler with the
+message of each valid frame. The buffers are preallocated, and the message
+given to the handler is a memoryview which is only valid during the call.
+'received' and 'sent' count the valid frames, 'crc_errors' the frames which
+were dropped because they were corrupted, and 'overruns' the frames which
+were too long.
+"""
+class FrameLink :
+  def __init__(self, uart, maxlen=512) :
+    self.uart = uart
+    self.maxlen = maxlen
+    size = maxlen + 2                     # message and CRC
+    encsize = size + size // 254 + 2      # COBS overhead and terminating 0
+    self.txbuf = bytearray(size)
+    self.txenc = bytearray(encsize)
+    self.txview = memoryview(self.txenc)
+    self.rxenc = bytearray(encsize)
+    self.rxbuf = bytearray(size)
+    self.rxview = memoryview(self.rxbuf)
+    self.rxlen = 0              # -1 while skipping a frame which is too long
+    self.received = 0
+    self.sent = 0
+    self.crc_errors = 0
+    self.overruns = 0
+
+  """
+  Send 'message' (bytes or bytearray) in a frame, after 'prefix' if not None.
+  """
+  def send(self, message, prefix=None) :
+    n = 0
+    if prefix is not None :
+      n = len(prefix)
+      self.txbuf[:n] = prefix
+    k = len(message)
+    if n + k > self.maxlen :
+      raise ValueError("Message too long")
+    self.txbuf[n:n+k] = message
+    n += k
+    crc = crc16(self.txbuf, 0, n)
+    self.txbuf[n] = crc >> 8
+    self.txbuf[n+1] = crc & 0xff
+    m = cobs_encode(self.txbuf, n + 2, self.txenc)
+    self.txenc[m] = 0
+    self.uart.write(self.txview[:m+1])
+    self.sent += 1
+
+  """
+  Process the first 'n' bytes of 'data' (all of it if 'n' is None) read on
+  the UART, and call 'handler' with the message of each valid frame.
+  """
+  def feed(self, data, handler, n=None) :
+    if n is None :
+      n = len(data)
+    start = 0
+    while start < n :
+      end = find_zero(data, start, n)
+      count = end - start
+      if self.rxlen >= 0 :
+        if self.rxlen + count > len(self.rxenc) :
+          self.overruns += 1
+          self.rxlen = -1
+        else :
+          self.rxenc[self.rxlen:self.rxlen+count] = data[start:end]
+          self.rxlen += count
+      if end == n :
+        break
+      if self.rxlen > 0 :
+        self.frame_received(handler)
+      self.rxlen = 0
+      start = end + 1
+
+  """
+  Decode the frame in 'rxenc', check its CRC and give its message to 'handler'.
+  """
+  def frame_received(self, handler) :
+    m = cobs_decode(self.rxenc, self.rxlen, self.rxbuf)
+    if m is None or m < 2 or crc16(self.rxbuf, 0, m - 2) != (self.rxbuf[m-2] << 8) | self.rxbuf[m-1] :
+      self.crc_errors += 1
+      return
+    self.received += 1
+    handler(self.rxview[:m-2])
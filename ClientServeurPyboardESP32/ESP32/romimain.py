@@ -11,46 +11,62 @@
 # This software is licensed under the Eclipse Public License 2.0
 ############
 # You will need MicroWebSrv: https://github.com/jczic/MicroWebSrv
+#
+# The web server runs in its own thread, and the requests of the web sockets 
+# are sent to the other board on the serial link by the bridge of romibridge.py,
+# which reads the serial link in the background with uasyncio, so that a slow
+# answer from the other board does not block the web server.
 from microWebSrv import MicroWebSrv
 from machine import UART
+import uasyncio
+from romibridge import UartBridge
+from romipage import loadPage, pageAnswer
 
 # UART(0) is the REPL (the one connected to the USB port?)
 # UART(1) is on TX0/RX0 (10/9) and seems to be linked to the REPL too
 # UART(2) is on TX2/RX2 (17/16)
-uart=UART(2, baudrate=115200, timeout=1000)
+uart=UART(2, baudrate=115200, timeout=0)
+
+bridge = UartBridge(uart)
+
+# The page is served from www/index.html.gz when it exists (see romipage.py)
+PAGE = 'www/index.html'
+
+page, pageEtag = loadPage(PAGE + '.gz')
 
 """
-Send the status of the chassis to the client.
-We first ask for the status of the chassis to the other board through the serial link.
-Then we send the answer of the board to the client.
+Serve the page, answering 304 when the browser already has it.
 """
-def sendStatus(webSocket) :
-  uart.write("STAT\r\n".encode()) # Ask for an update of the status of the Romi
-  buf = uart.readline()           # Read the answer (timeout is 1s)
-  if buf is None :                # No answer
-    webSocket.SendText("NOK")     # Send error to the web server
+@MicroWebSrv.route('/')
+@MicroWebSrv.route('/index.html')
+def _pageHandler(httpClient, httpResponse) :
+  headers = {}
+  for (name, value) in httpClient.GetRequestHeaders().items() :
+    headers[name.lower()] = value
+  answer = pageAnswer(headers, pageEtag)
+  if answer is None :
+    httpResponse.WriteResponseFile(PAGE, 'text/html')
+  elif answer[0] == 304 :
+    httpResponse.WriteResponse(304, answer[1], None, None, None)
   else :
-    webSocket.SendText(buf.decode()) # Send answer to the web server
+    httpResponse.WriteResponse(200, answer[1], 'text/html', 'UTF-8', page)
 
 """
 Accept a connection to the web socket.
 """
 def _acceptWebSocketCallback(webSocket, httpClient) :
   print("WS ACCEPT")
+  bridge.connect(webSocket)
   webSocket.RecvTextCallback   = _recvTextCallback
   webSocket.RecvBinaryCallback = _recvBinaryCallback
   webSocket.ClosedCallback   = _closedCallback
 
 """
 Handle a text message, by transferring it on the serial link to the other board.
+The answer is sent to the web socket by the bridge when it arrives.
 """
 def _recvTextCallback(webSocket, msg) :
-  uart.write((msg+'\r\n').encode())
-  buf = uart.readline()
-  if buf is None :                # No answer
-    webSocket.SendText("NOK")     # Send error to the web server
-  else :
-    webSocket.SendText(buf.decode()) # Send answer to the web server
+  bridge.request(webSocket, msg)
 
 """
 Handle binary messages (don't do anything)
@@ -63,7 +79,8 @@ Handle the ending of the connection.
 """
 def _closedCallback(webSocket) :
   print("WS CLOSED")
-  uart.write(('CLOSE\r\n').encode())
+  bridge.forget(webSocket)
+  bridge.notify('CLOSE')
 
 # Create the HTTP server
 srv = MicroWebSrv(webPath='www/')
@@ -71,5 +88,7 @@ srv.MaxWebSocketRecvLen     = 256
 srv.WebSocketThreaded   = False
 # Install the callback for web socket connections
 srv.AcceptWebSocketCallback = _acceptWebSocketCallback
-# Start the server
-srv.Start()
+# Start the server in its own thread
+srv.Start(threaded=True)
+# Read the serial link in the background
+uasyncio.run(bridge.run())
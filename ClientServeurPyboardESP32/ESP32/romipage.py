@@ -0,0 +1,57 @@
+############
+# romipage.py for Micropython on ESP32
+#
+# Serving of the web page of the bridge (see romimain.py). The page is served
+# from a gzipped file made by tools/packwww.py, with a strong ETag so that the
+# browser can keep it in its cache and only check that it has not changed.
+# The raw page is only used when there is no gzipped page, or for browsers 
+# which do not accept gzip.
+#
+# The answers do not depend on the web server, so that they can be tested on
+# a host (see tools/httptest.py).
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+try :
+  import uhashlib as hashlib
+  import ubinascii as binascii
+except ImportError :
+  import hashlib
+  import binascii
+
+CACHE_MAX_AGE = 7 * 24 * 3600     # in seconds
+
+"""
+Load the gzipped page 'path' and compute its ETag (see tools/packwww.py).
+Return (None, None) if there is no gzipped page.
+"""
+def loadPage(path) :
+  try :
+    with open(path, 'rb') as f :
+      data = f.read()
+  except OSError :
+    return (None, None)
+  etag = '"%s"' % binascii.hexlify(hashlib.sha1(data).digest()).decode()[:16]
+  return (data, etag)
+
+"""
+Get the answer to a request of the page with 'headers' (a dictionary with 
+names in lower case), when the gzipped page has ETag 'etag' (None if there is 
+no gzipped page). Return None when the raw page must be sent, or the status 
+code and the headers of the answer: 304 when the browser already has the page,
+and 200 when the gzipped page must be sent.
+"""
+def pageAnswer(headers, etag) :
+  if etag is None or 'gzip' not in headers.get('accept-encoding', '') :
+    return None
+  answer = { 'ETag': etag, 
+             'Cache-Control': 'public, max-age=%d' % CACHE_MAX_AGE,
+             'Vary': 'Accept-Encoding' }
+  match = headers.get('if-none-match')
+  if match is not None and (match.strip() == '*' or 
+                            etag in [tag.strip() for tag in match.split(',')]) :
+    return (304, answer)
+  answer['Content-Encoding'] = 'gzip'
+  return (200, answer)
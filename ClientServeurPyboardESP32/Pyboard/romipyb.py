@@ -12,28 +12,107 @@
 ############
 import pyb
 from pyb import Pin, Timer, ExtInt
+from array import array
 
 import micropython
+from micropython import const
+from romienc import make_counter
+from romictl import PID, Scheduler, Profile, Odometry, SegmentQueue
+from romictl import SEG_LCOUNTS, SEG_RCOUNTS, SEG_LSPEED, SEG_RSPEED, SEG_MS, SEG_POWER
+from romictl import TelemetryRing, int16
+from romictl import TEL_TIME, TEL_LPOS, TEL_LSPEED, TEL_LDUTY, TEL_RPOS, TEL_RSPEED, TEL_RDUTY
+try :
+  import uasyncio
+  from uasyncio import ThreadSafeFlag
+except ImportError :    # no uasyncio, or a version without ThreadSafeFlag
+  ThreadSafeFlag = None
 # The following line is useful to debug error in IRQ callbacks
 #micropython.alloc_emergency_exception_buf(100)
 
+# Indices of the state of a motor in its 'state' array.
+# The state is kept in a preallocated array of 32 bits integers so that the
+# interrupt handlers of the encoder never allocate memory on the heap.
+_COUNT_A = const(0)     # counter for impulses on the A output of the encoder
+_COUNT_B = const(1)     # counter for impulses on the B output of the encoder
+_TARGET_A = const(2)    # target value for the A counter (for controlled rotation)
+_TIME_A = const(3)      # last time (in µs) we got an impulse on the A output of the encoder
+_TIME_B = const(4)      # last time (in µs) we got an impulse on the B output of the encoder
+_ELAPSED_A_B = const(5) # time elapsed between an impulse on A and an impulse on B
+_DIRSENSED = const(6)   # direction sensed through the phase of the A and B outputs
+_ZONE = const(7)        # how close we are to the target (0 = far, 1 = close, 2 = very close)
+_SLOW = const(8)        # pulse width when close to the target
+_VSLOW = const(9)       # pulse width when very close to the target
+_POS = const(10)        # signed position, in quadrature counts (4 per impulse on A)
+_QSTATE = const(11)     # last levels of the A and B outputs, as (A << 1) | B
+_QERR = const(12)       # number of invalid transitions (both outputs changed at once)
+_QABS = const(13)       # quadrature counts in any direction, polled from a counter backend
+_EDGE_IDX = const(14)   # index of the next slot in the ring of edge times
+_EDGE_N = const(15)     # number of valid edge times in the ring
+_ZERO_US = const(16)    # time without impulse (in µs) after which the speed is 0
+_CHAIN = const(17)      # 1 if the motor keeps running at the target because another move follows
+_NSTATE = const(18)     # number of items in the state array
+
+# Size of the ring buffer of the times of the impulses on A (a power of 2)
+_EDGE_RING = const(8)
+_EDGE_MASK = const(7)
+
+# Quadrature decoding table, indexed by (previous state << 2) | new state, where
+# a state is (A << 1) | B. The values are the change of position, invalid
+# transitions are counted as 0. As for 'dirsensed', A leading B counts negatively.
+_QUAD_TABLE = array('i', [
+   0,  1, -1,  0,
+  -1,  0,  0,  1,
+   1,  0,  0, -1,
+   0, -1,  1,  0
+])
+
+# pyb.micros() wraps at 2**30, see pyb.elapsed_micros()
+_TICKS_MAX = const(0x3fffffff)
+
 """
 This class is for driver one motor of the chassis and its rotation encoder
 """
 class RomiMotor :
   """
-  We reuse the same timer for all instances of the class, so this is the callback
-  of the class, which calls the handlers in each instance.
+  We reuse the same timer for all instances of the class. The timer drives a 
+  scheduler which runs the rpm handler of each instance, and other periodic 
+  tasks, at their own rate. Set 'freq' and 'rate' before creating the motors.
+  Timer callbacks are hard IRQs on the Pyboard, so tasks which allocate memory
+  must be added with 'scheduled' set to True.
   """
   @classmethod
-  def class_rpm_handler(cls, tim) :
-    for h in cls.rpm_handlers :
-      h(tim)
-  
-  # List of the rpm handlers of the instances, necessary because we share a single timer.
-  rpm_handlers = []
+  def get_scheduler(cls) :
+    if cls.rpmtimer is None :   # create only one shared timer for all instances
+      cls.scheduler = Scheduler(cls.freq)
+      cls.rpmtimer = Timer(4)
+      cls.rpmtimer.init(freq=cls.freq, callback=cls.scheduler.handler)
+    return cls.scheduler
+
+  """
+  Add a periodic task running 'rate' times per second on the shared timer.
+  If 'scheduled' is True, the task runs outside of the timer callback.
+  """
+  @classmethod
+  def add_task(cls, name, callback, rate, scheduled=False) :
+    return cls.get_scheduler().add(name, callback, rate, scheduled)
+
+  """
+  Get the statistics of the periodic tasks: (name, rate, runs, overruns, max_us)
+  """
+  @classmethod
+  def task_stats(cls) :
+    return cls.get_scheduler().stats()
+
   # The shared timer
   rpmtimer = None
+  # The scheduler of the periodic tasks
+  scheduler = None
+  # Frequency of the shared timer in Hz
+  freq = 100
+  # Rate of the rpm handlers (speed computation and control) in Hz
+  rate = 20
+  # Number of instances
+  instances = 0
   
   """
   Initialize a RomiMotor, connected either to the 'X' side or the 'Y' side of the Pyboard.
@@ -43,8 +122,15 @@ class RomiMotor :
     - SLEEP is on pin ?3
     - ENCA is on pin ?4
     - ENCB is on pin ?5
+  If 'quadrature' is True, both edges of both outputs of the encoder are decoded,
+  which gives an exact signed position with 4 times the resolution of count_a.
+  'counter' selects how the impulses of the encoder are counted (see romienc.py):
+  'irq' (the default) counts them in interrupt handlers, or a counter backend 
+  object may be given, for instance a TimerEncCounter for a timer in encoder mode,
+  in which case the encoder must be wired to the pins of the channels of the timer.
+  With a hardware counter, the counter is polled by the timer handler.
   """
-  def __init__(self, X=True) :
+  def __init__(self, X=True, quadrature=False, counter='irq') :
     if X :
       self.pwmpin = Pin('X1', Pin.OUT_PP)
       self.pwmtim = Timer(2, freq=5000)
@@ -68,70 +154,291 @@ class RomiMotor :
       self.enca = Pin('Y4', Pin.IN, Pin.PULL_UP)
       self.encb = Pin('Y5', Pin.IN, Pin.PULL_UP)
     self.pwmscale = (self.pwmtim.period() + 1) // 100 # scale factor for percent power
-    self.count_a = 0      # counter for impulses on the A output of the encoder
-    self.target_a = 0     # target value for the A counter (for controlled rotation)
-    self.count_b = 0      # counter for impulses on the B output of the encoder
-    self.time_a = 0       # last time we got an impulse on the A output of the encoder
-    self.time_b = 0       # last time we got an impulse on the B output of the encoder
-    self.elapsed_a_b = 0  # time elapsed between an impulse on A and an impulse on B
-    self.dirsensed = 0    # direction sensed through the phase of the A and B outputs
+    self.state = array('i', [0] * _NSTATE)  # state shared with the encoder handlers
+    self.state[_SLOW] = 15 * self.pwmscale
+    self.state[_VSLOW] = 7 * self.pwmscale
+    self.state[_ZERO_US] = 200000
+    self.edges = array('i', [0] * _EDGE_RING)  # times of the last impulses on A
+    self.min_span_us = 4000 # under this span of the ring, use the count difference
     self.rpm = 0          # current speed in rotations per second
     self.rpm_last_a = 0   # value of the A counter when we last computed the rpms
     self.cruise_rpm = 0   # target value for the rpms
-    ExtInt(self.enca, ExtInt.IRQ_RISING, Pin.PULL_UP, self.enca_handler)
-    ExtInt(self.encb, ExtInt.IRQ_RISING, Pin.PULL_UP, self.encb_handler)
-    if RomiMotor.rpmtimer is None :   # create only one shared timer for all instances
-      RomiMotor.rpmtimer = Timer(4)
-      RomiMotor.rpmtimer.init(freq=4, callback=RomiMotor.class_rpm_handler)
-    RomiMotor.rpm_handlers.append(self.rpm_handler) # register the handler for this instance
+    self.pid = None       # PID controller of the speed in 'pid' cruise mode
+    self.profile = None   # motion profile of the current move
+    self.profile_gains = (256, 1024, 64)  # speed feedforward, position and speed gains
+    self.coast_ms = 40    # the motor is stopped when the wheel will coast to the target in this time
+    self.move_start = 0   # time of the start of the current move in ms
+    self.move_time = 0    # time taken by the last move to reach its target in ms
+    self.move_error = 0   # final error of the last move in counts
+    self.coupling = 0     # correction of the output set by the platform in synchronized moves
+    # Flag set by the handlers when a move is over, None if uasyncio is not available
+    self.done_flag = ThreadSafeFlag() if ThreadSafeFlag is not None else None
+    self.quadrature = quadrature
+    self.counter = make_counter(counter)  # None when counting in interrupt handlers
+    if self.counter is None :
+      if quadrature :
+        self.state[_QSTATE] = (self.enca.value() << 1) | self.encb.value()
+        ExtInt(self.enca, ExtInt.IRQ_RISING_FALLING, Pin.PULL_UP, self.quad_handler)
+        ExtInt(self.encb, ExtInt.IRQ_RISING_FALLING, Pin.PULL_UP, self.quad_handler)
+      else :
+        ExtInt(self.enca, ExtInt.IRQ_RISING, Pin.PULL_UP, self.enca_handler)
+        ExtInt(self.encb, ExtInt.IRQ_RISING, Pin.PULL_UP, self.encb_handler)
+    RomiMotor.instances += 1
+    # register the handler for this instance
+    self.rpm_task = RomiMotor.add_task('rpm%d' % RomiMotor.instances, self.rpm_handler, RomiMotor.rate)
+    self.rpm_rate = int(RomiMotor.scheduler.rate(self.rpm_task)) # actual rate of the rpm handler
   
   """
   Handler for interrupts caused by impulses on the A output of the encoder.
   This is where we sense the rotation direction and adjust the throttle to 
   reach a target number of rotations of the wheel.
+  ExtInt callbacks are hard IRQs, so this handler is compiled by the viper
+  emitter, only works on machine integers in the state array and never allocates
+  memory. The PWM is only touched when we get closer to the target.
   """
-  def enca_handler(self, pin) :
-    self.count_a += 1
-    self.time_a = pyb.millis()
-    if pyb.elapsed_millis(self.time_b) > self.elapsed_a_b :
-      self.dirsensed = -1   # A occurs before B
+  @micropython.viper
+  def enca_handler(self, line) :
+    s = ptr32(self.state)
+    count = s[_COUNT_A] + 1
+    s[_COUNT_A] = count
+    now = int(pyb.micros())
+    s[_TIME_A] = now
+    if ((now - s[_TIME_B]) & _TICKS_MAX) > s[_ELAPSED_A_B] :
+      s[_DIRSENSED] = -1    # A occurs before B
+      s[_POS] = s[_POS] - 4
     else :
-      self.dirsensed = 1    # B occurs before A
-    if self.target_a > 0 :  # If we have a target rotation
-      if self.count_a >= self.target_a :
-        self.pwm.pulse_width(0)   # If we reached of exceeded the rotation, stop the motor
-        self.target_a = 0         # remove the target
-      elif (self.target_a - self.count_a) < 30 :
-        self.pwm.pulse_width(7 * self.pwmscale)   # If we are very close to the target, slow down a lot
-      elif (self.target_a - self.count_a) < 60 :
-        self.pwm.pulse_width(15 * self.pwmscale)  # If we are close to the target, slow down
+      s[_DIRSENSED] = 1     # B occurs before A
+      s[_POS] = s[_POS] + 4
+    self.record_edge(now)
+    self.target_check(count)
+
+  """
+  Handler for interrupts caused by both edges of both outputs of the encoder,
+  used in quadrature mode. The transition between the previous and the current 
+  levels of the outputs gives the exact change of position through _QUAD_TABLE.
+  Rising edges of A are still counted in count_a for compatibility.
+  """
+  @micropython.viper
+  def quad_handler(self, line) :
+    s = ptr32(self.state)
+    a = int(self.enca.value())
+    b = int(self.encb.value())
+    prev = s[_QSTATE]
+    cur = (a << 1) | b
+    if cur == prev :        # bounce, or an edge already seen in the previous call
+      return
+    s[_QSTATE] = cur
+    delta = ptr32(_QUAD_TABLE)[(prev << 2) | cur]
+    if delta == 0 :         # both outputs changed, we missed an edge
+      s[_QERR] = s[_QERR] + 1
+      return
+    s[_POS] = s[_POS] + delta
+    s[_DIRSENSED] = delta
+    if b > 0 and (prev & 1) == 0 :   # rising edge on B
+      s[_COUNT_B] = s[_COUNT_B] + 1
+    if a > 0 and (prev & 2) == 0 :   # rising edge on A
+      count = s[_COUNT_A] + 1
+      s[_COUNT_A] = count
+      self.record_edge(int(pyb.micros()))
+      self.target_check(count)
+
+  """
+  Record the time 'now' of an impulse on A in the ring of edge times.
+  If the wheel had stopped, the previous edge times are forgotten.
+  This is called from the hard IRQ handlers of the encoder.
+  """
+  @micropython.viper
+  def record_edge(self, now:int) :
+    s = ptr32(self.state)
+    e = ptr32(self.edges)
+    i = s[_EDGE_IDX]
+    n = s[_EDGE_N]
+    if n > 0 and ((now - e[(i - 1) & _EDGE_MASK]) & _TICKS_MAX) > s[_ZERO_US] :
+      n = 0
+    e[i] = now
+    s[_EDGE_IDX] = (i + 1) & _EDGE_MASK
+    if n < _EDGE_RING :
+      n += 1
+    s[_EDGE_N] = n
+
+  """
+  Check the progress of the A counter toward the target rotation and slow 
+  down or stop the motor when we get close to it.
+  This is called from the hard IRQ handlers of the encoder.
+  """
+  @micropython.viper
+  def target_check(self, count:int) :
+    s = ptr32(self.state)
+    target = s[_TARGET_A]
+    if target > 0 :         # If we have a target rotation
+      if count >= target :
+        if s[_CHAIN] == 0 :       # If we reached of exceeded the rotation, stop the motor
+          self.pwm.pulse_width(0) # unless the next move follows
+        s[_TARGET_A] = 0          # remove the target
+        s[_ZONE] = 0
+        self.signal_done()
+      elif target - count < 30 :
+        if s[_ZONE] < 2 :         # Change the pulse width only when entering a new zone
+          self.pwm.pulse_width(s[_VSLOW]) # If we are very close to the target, slow down a lot
+          s[_ZONE] = 2
+      elif target - count < 60 :
+        if s[_ZONE] < 1 :
+          self.pwm.pulse_width(s[_SLOW])  # If we are close to the target, slow down
+          s[_ZONE] = 1
+
+  """
+  Signal the end of a move to the tasks waiting for it. ThreadSafeFlag.set
+  does not allocate memory, so this can be called from interrupt handlers.
+  """
+  def signal_done(self) :
+    if self.done_flag is not None :
+      self.done_flag.set()
 
   """
   Handler for interrupts caused by impulses on the B output of the encoder.
   """
-  def encb_handler(self, pin) :
-    self.count_b += 1
-    self.elapsed_a_b = pyb.elapsed_millis(self.time_a)  # Memorize the duration since the last A impulse
+  @micropython.viper
+  def encb_handler(self, line) :
+    s = ptr32(self.state)
+    s[_COUNT_B] = s[_COUNT_B] + 1
+    now = int(pyb.micros())
+    s[_TIME_B] = now
+    # Memorize the duration since the last A impulse
+    s[_ELAPSED_A_B] = (now - s[_TIME_A]) & _TICKS_MAX
+
+  """
+  Access to the state of the encoder as attributes.
+  """
+  @property
+  def count_a(self) :
+    return self.state[_COUNT_A]
+
+  @count_a.setter
+  def count_a(self, value) :
+    self.state[_COUNT_A] = value
+    self.state[_QABS] = 4 * value
+
+  @property
+  def count_b(self) :
+    return self.state[_COUNT_B]
+
+  @count_b.setter
+  def count_b(self, value) :
+    self.state[_COUNT_B] = value
+
+  @property
+  def target_a(self) :
+    return self.state[_TARGET_A]
+
+  @target_a.setter
+  def target_a(self, value) :
+    self.state[_TARGET_A] = value
+
+  @property
+  def dirsensed(self) :
+    return self.state[_DIRSENSED]
+
+  """
+  Get the signed position of the wheel in quadrature counts (1440 per turn).
+  It is exact in quadrature mode, and relies on the sensed direction otherwise.
+  """
+  @property
+  def position(self) :
+    return self.state[_POS]
+
+  """
+  Get the number of invalid transitions of the encoder seen in quadrature mode.
+  """
+  @property
+  def quad_errors(self) :
+    return self.state[_QERR]
+
+  """
+  Get the change of position from the hardware counter backend and update
+  the state of the encoder as the interrupt handlers would.
+  """
+  def poll_counter(self) :
+    delta = self.counter.poll()
+    if delta == 0 :
+      return
+    st = self.state
+    st[_POS] += delta
+    if delta < 0 :
+      st[_DIRSENSED] = -1
+      delta = -delta
+    else :
+      st[_DIRSENSED] = 1
+    st[_QABS] += delta
+    count = st[_QABS] >> 2  # impulses on A in any direction
+    st[_COUNT_A] = count
+    st[_COUNT_B] = count
+    self.target_check(count)
+
+  """
+  Follow the motion profile of the current move. This is called by the rpm
+  handler. The output is a feedforward of the reference speed plus corrections
+  of the position and speed errors, on 10 bits as for the PID. The motor is 
+  stopped when the wheel will coast to the target, and the move is over when 
+  the target is reached and the wheel has stopped. If the wheel stops short of
+  the target, it creeps to it.
+  """
+  def follow_profile(self) :
+    prof = self.profile
+    speed = self.speed()
+    remaining = prof.distance - self.count_a
+    if remaining <= (speed * self.coast_ms) // 1000 :
+      self.pwm.pulse_width(0)
+      if remaining <= 0 :
+        if self.move_time < 0 :     # the target has just been reached
+          self.move_time = pyb.elapsed_millis(self.move_start)
+        if speed == 0 :             # the wheel has stopped, the move is over
+          self.move_error = -remaining
+          self.profile = None
+          self.signal_done()
+      return
+    if prof.done() :
+      ref = prof.distance
+      vref = 0
+    else :
+      ref = prof.step()
+      vref = prof.speed()
+    kff, kpos, kvel = self.profile_gains
+    u = (kff * vref + kpos * (ref - self.count_a) + kvel * (vref - speed)) >> 8
+    u += self.coupling
+    if prof.done() :
+      u = max(u, 70)                # creep to the target
+    self.pwm.pulse_width((max(0, min(1023, u)) * 100 * self.pwmscale) >> 10)
 
   """
   This is the handler of the timer interrupts to compute the rpms
   """
   def rpm_handler(self, tim) :
-    self.rpm = 4 * (self.count_a - self.rpm_last_a)   # The timer is at 4Hz
+    if self.counter is not None :
+      self.poll_counter()
+    self.rpm = self.rpm_rate * (self.count_a - self.rpm_last_a)
     self.rpm_last_a = self.count_a      # Memorize the number of impulses on A
+    if self.profile is not None :       # If we follow a motion profile
+      self.follow_profile()
+      return
     if self.cruise_rpm != 0 :           # If we have an RPM target
+      speed = self.speed()
+      if self.pid is not None :         # Let the PID compute the pulse width
+        # The PID works on 10 bits, like the duty of the PWM on the ESP32
+        self.pwm.pulse_width((self.pid.update(self.cruise_rpm, speed) * 100 * self.pwmscale) >> 10)
+        return
       # Add a correction to the PWM according to the difference in RPMs
-      delta = abs(self.rpm - self.cruise_rpm)
+      # The correction per second does not depend on the rate of the handler
+      delta = abs(speed - self.cruise_rpm)
       if delta < 100 :
-        corr = delta // 40
+        corr = delta // (10 * self.rpm_rate)
       elif delta < 500 :
-        corr = delta // 20
+        corr = (2 * delta) // (10 * self.rpm_rate)
       else :
-        corr = delta // 10
-      if self.cruise_rpm < self.rpm :
-      	self.pwm.pulse_width(max(5*self.pwmscale, self.pwm.pulse_width() - self.pwmscale * corr))
+        corr = (4 * delta) // (10 * self.rpm_rate)
+      if self.cruise_rpm < speed :
+        self.pwm.pulse_width(max(5*self.pwmscale, self.pwm.pulse_width() - self.pwmscale * corr))
       else :
-      	self.pwm.pulse_width(min(100*self.pwmscale, self.pwm.pulse_width() + self.pwmscale * corr))
+        self.pwm.pulse_width(min(100*self.pwmscale, self.pwm.pulse_width() + self.pwmscale * corr))
   
   """
   Set the power of the motor in percents.
@@ -158,6 +465,16 @@ class RomiMotor :
       thr = -thr
     return thr
   
+  """
+  Get the current duty of the motor on 10 bits (1023 is the max power).
+  The result is positive if the motor runs forward, negative if it runs backward.
+  """
+  def get_duty(self) :
+    duty = (self.pwm.pulse_width() * 1023) // (100 * self.pwmscale)
+    if self.dir.value() > 0 :
+      duty = -duty
+    return duty
+
   """
   Release the motor to let it rotate freely.
   """
@@ -170,37 +487,205 @@ class RomiMotor :
   """
   Perform 'turns' rotations of the wheel at 'power' percents of the max power.
   If 'turns' is positive, the wheel turns forward, if it is negative, it turns backward.
+  If 'accel' is given, the move follows a motion profile instead, with a peak speed
+  of 'vmax' RPMs and a peak acceleration of 'accel' RPMs per second (the RPMs are
+  the ones of 'cruise'). The profile is trapezoidal, or an S-curve if 'scurve' is True.
+  The time to reach the target and the final error are then given by 'move_report'.
+  A move of less than one impulse on A (1/360 turn) is done at once.
   """
-  def rotatewheel(self, turns, power=20):
-    if turns < 0 :
+  def rotatewheel(self, turns, power=20, vmax=6, accel=None, scurve=False):
+    counts = int(360 * turns)
+    if accel is None and counts != 0 :
+      self.rotate_counts(counts, power)
+      return
+    if counts < 0 :
       sign = -1
-      turns = -turns
+      counts = -counts
     else :
       sign = 1
+    self.profile = None
+    self.coupling = 0
     self.count_a = 0
     self.count_b = 0
-    self.target_a = int(360 * turns)
-    self.throttle(sign*power)
+    self.state[_ZONE] = 0
+    self.target_a = 0
+    if counts == 0 :        # too short to move, the move is done at once
+      self.throttle(0)
+      self.move_time = 0
+      self.move_error = 0
+    else :
+      profile = Profile(counts, 60 * vmax, 60 * accel, self.rpm_rate, scurve)
+      self.throttle(0)
+      if sign < 0 :
+        self.dir.on()
+      self.move_time = -1
+      self.move_start = pyb.millis()
+      self.profile = profile
   
   """
-  Wait for the rotations requested by 'rotatewheel' to be done.
+  Perform 'counts' impulses on A (360 per turn) at 'power' percents of the max
+  power, forward if 'counts' is positive, backward if it is negative.
+  If 'slowdown' is False, the motor does not slow down when it gets close to 
+  the target, and it is not stopped when it reaches the target, which is used
+  to chain moves without stopping in between: the next move is started by 
+  the timer handler (see RomiPlatform.queue_handler).
+  This does not allocate memory, so it can be used in the timer handler.
+  """
+  def rotate_counts(self, counts, power=20, slowdown=True) :
+    if counts < 0 :
+      power = -power
+      counts = -counts
+    self.profile = None
+    self.coupling = 0
+    self.count_a = 0
+    self.count_b = 0
+    self.state[_ZONE] = 0 if slowdown else 2
+    self.state[_CHAIN] = 0 if slowdown else 1
+    self.target_a = counts
+    self.throttle(power)
+
+  """
+  Start a segment of a queued motion: rotate by 'counts' impulses on A at 'power' 
+  percents of the max power while cruising at 'speed' impulses on A per second.
+  When 'counts' is 0, the wheel turns in the direction given by the sign of 
+  'speed', and it is stopped if 'speed' is 0 too. 'slowdown' is given to 
+  rotate_counts. This does not allocate memory.
+  """
+  def start_segment(self, counts, speed, power, slowdown=True) :
+    if counts == 0 :
+      if speed < 0 :
+        power = -power
+      elif speed == 0 :
+        power = 0
+    self.rotate_counts(counts, power, slowdown)
+    self.cruise_speed(abs(speed))
+
+  """
+  Get the time in ms taken by the last profiled move to reach its target (-1 if 
+  it is not reached yet) and its final error in counts (360 per turn).
+  """
+  def move_report(self) :
+    return (self.move_time, self.move_error)
+
+  """
+  Tell whether the rotations requested by 'rotatewheel' are done (or cancelled).
+  """
+  def motion_done(self) :
+    return self.target_a == 0 and self.profile is None
+
+  """
+  Wait for the rotations requested by 'rotatewheel' to be done, sleeping
+  until the next interrupt between checks. If 'timeout_ms' is given, give up 
+  after this time. Return True if the move is done, False on timeout.
   """
-  def wait(self) :
-    while self.count_a < self.target_a :
-      pass
+  def wait(self, timeout_ms=None) :
+    start = pyb.millis()
+    while not self.motion_done() :
+      if timeout_ms is not None and pyb.elapsed_millis(start) >= timeout_ms :
+        return False
+      pyb.wfi()
+    return True
+
+  """
+  Wait for the flag until the move is done, since the flag may have been set 
+  by a previous move.
+  """
+  async def _wait_flag(self) :
+    while not self.motion_done() :
+      await self.done_flag.wait()
+
+  """
+  Coroutine which waits for the rotations requested by 'rotatewheel' to be done,
+  without using the CPU: it is woken up by the handlers at the end of the move.
+  If 'timeout_ms' is given, give up after this time. Return True if the move 
+  is done, False on timeout. This requires uasyncio with ThreadSafeFlag.
+  """
+  async def wait_done(self, timeout_ms=None) :
+    if self.done_flag is None :
+      raise RuntimeError("uasyncio.ThreadSafeFlag is not available")
+    if timeout_ms is None :
+      await self._wait_flag()
+      return True
+    try :
+      await uasyncio.wait_for_ms(self._wait_flag(), timeout_ms)
+    except uasyncio.TimeoutError :
+      return False
+    return True
 
   """
   Set a target RPMs. The wheel turns in its current rotation direction,
   'rpm' should be non negative.
   """
   def cruise(self, rpm) :
-    self.cruise_rpm = int(rpm * 60)
+    self.cruise_speed(int(rpm * 60))
+
+  """
+  Set a target speed in impulses on A per second (0 for no target). 
+  This does not allocate memory.
+  """
+  def cruise_speed(self, speed) :
+    if self.pid is not None :
+      self.pid.reset()
+    self.cruise_rpm = speed
+
+  """
+  Select how the speed is regulated when cruising:
+    - 'step' adds a correction to the pulse width according to the speed error,
+    - 'pid' uses an integer PID controller with feedforward (see romictl.PID),
+      'gains' are given to the constructor of the controller.
+  The PID is tuned on the same scale as on the ESP32.
+  """
+  def cruise_mode(self, mode, **gains) :
+    if mode == 'pid' :
+      self.pid = PID(rate=self.rpm_rate, umin=0, umax=1023, **gains)
+    elif mode == 'step' :
+      self.pid = None
+    else :
+      raise ValueError("Unknown cruise mode %s" % mode)
   
+  """
+  Get the current speed in impulses on A per second, always non negative.
+  The speed is computed when called from the period between the last impulses
+  recorded by the interrupt handlers, so it is always up to date. When the 
+  impulses are too close to each other (or with a hardware counter), we use the
+  count difference computed by the timer handler. When no impulse happened 
+  during the zero speed timeout, the speed is 0.
+  This does not allocate memory, so it can be used in interrupt handlers.
+  """
+  def speed(self) :
+    st = self.state
+    irq = pyb.disable_irq()
+    n = st[_EDGE_N]
+    i = st[_EDGE_IDX]
+    last = self.edges[(i - 1) & _EDGE_MASK]
+    first = self.edges[(i - n) & _EDGE_MASK]
+    pyb.enable_irq(irq)
+    if n == 0 :
+      return self.rpm
+    since_last = pyb.elapsed_micros(last)
+    if since_last > st[_ZERO_US] :
+      return 0
+    if n < 2 :
+      return self.rpm
+    span = (last - first) & _TICKS_MAX
+    if span < self.min_span_us :
+      return self.rpm
+    speed = (n - 1) * 1000000 // span
+    if since_last > span // (n - 1) :   # slowing down, the next impulse is late
+      speed = min(speed, 1000000 // since_last)
+    return speed
+
+  """
+  Set the time without impulse (in ms) after which the wheel is considered stopped.
+  """
+  def set_zero_timeout(self, ms) :
+    self.state[_ZERO_US] = ms * 1000
+
   """
   Get the current RPMs. This is always non negative, regardless of the rotation direction.
   """
   def get_rpms(self) :
-    return self.rpm / 60
+    return self.speed() / 60
   
   """
   Cancel all targets of rotation and RPM
@@ -208,6 +693,8 @@ class RomiMotor :
   def clear(self) :
     self.target_a = 0
     self.cruise_rpm = 0
+    self.profile = None
+    self.signal_done()    # the move is cancelled, do not keep waiting for it
 
   """
   Stop the motor.
@@ -226,12 +713,64 @@ class RomiPlatform :
   The left motor should be connected to the 'X' pins.
   The right motor should be connected to the 'Y' pins.
   The control ('CTRL') pin of the chassis should be connected to pin X12
+  If 'quadrature' is True, the encoders are decoded in quadrature mode.
+  'lcounter' and 'rcounter' are the counter backends of the left and right encoders.
   """
-  def __init__(self) :
-    self.leftmotor = RomiMotor(X=True)
-    self.rightmotor = RomiMotor(X=False)
+  def __init__(self, quadrature=False, lcounter='irq', rcounter='irq') :
+    self.leftmotor = RomiMotor(X=True, quadrature=quadrature, counter=lcounter)
+    self.rightmotor = RomiMotor(X=False, quadrature=quadrature, counter=rcounter)
     self.control = Pin('X12', Pin.OUT)
     self.control.value(1)
+    self.syncing = False  # True during a synchronized move
+    self.lratio = 0       # distance of the left wheel / longest distance (x4096)
+    self.rratio = 0       # distance of the right wheel / longest distance (x4096)
+    self.kcouple = 512    # gain of the cross-coupling (x256)
+    self.sync_task = RomiMotor.add_task('sync', self.sync_handler, RomiMotor.rate)
+    self.odometry = Odometry()
+    self.lpos = self.leftmotor.position   # positions of the wheels at the last odometry update
+    self.rpos = self.rightmotor.position
+    self.odom_task = RomiMotor.add_task('odom', self.odometry_handler, RomiMotor.rate)
+    self.queue = SegmentQueue()   # queued motion segments
+    self.seg_active = False       # True while a segment of the queue is running
+    self.seg_start = 0            # start time of the current segment in ms
+    self.seg_done = 0             # number of segments completed
+    self.queue_task = RomiMotor.add_task('queue', self.queue_handler, RomiMotor.freq)
+    self.telemetry = None         # ring of telemetry samples, created by start_telemetry
+    self.telemetry_task = None
+
+  """
+  Configure the odometry: 'radius' is the radius of the wheels and 'track' the 
+  distance between the wheels in mm. 'lsign' and 'rsign' are the signs of the 
+  positions of the left and right encoders when the platform moves forward.
+  The positions are exact in quadrature mode or with hardware counters.
+  The pose is reset to the origin.
+  """
+  def configure_odometry(self, radius=35, track=141, lsign=1, rsign=1) :
+    self.odometry = Odometry(radius, track, 1440, lsign, rsign)
+
+  """
+  Periodic task of the platform, which updates the pose from the changes of the 
+  positions of the wheels.
+  """
+  def odometry_handler(self, tim) :
+    lpos = self.leftmotor.position
+    rpos = self.rightmotor.position
+    self.odometry.update(lpos - self.lpos, rpos - self.rpos)
+    self.lpos = lpos
+    self.rpos = rpos
+
+  """
+  Get the pose of the platform as (x, y, heading), in mm and degrees, 
+  counterclockwise from the x axis, which is the initial heading.
+  """
+  def pose(self) :
+    return self.odometry.pose()
+
+  """
+  Set the pose of the platform ('x' and 'y' in mm, 'heading' in degrees).
+  """
+  def set_pose(self, x=0, y=0, heading=0) :
+    self.odometry.reset(x, y, heading)
 
   """
   Set the throttle (power in percents) on the left and right motors.
@@ -253,10 +792,220 @@ class RomiPlatform :
   Make the wheels turn by a given number of turns, at 'power' percents of the 
   maximum power. 'lturns' and 'rturns' may be floats.
   Positive values turn forward, negative values turn backward.
+  If 'accel' is given, each wheel follows a motion profile (see RomiMotor.rotatewheel).
+  If 'sync' is True, the wheels follow motion profiles scaled so that they finish
+  together, the wheel with the longest move using 'vmax' and 'accel' (by default,
+  'vmax' is reached in 0.25s). The ratio of the positions of the wheels is then
+  kept by a cross-coupling correction of their outputs.
+  """
+  def move(self, lturns, rturns, power=20, vmax=6, accel=None, scurve=False, sync=False) :
+    if not sync :
+      self.syncing = False
+      self.leftmotor.rotatewheel(lturns, power, vmax, accel, scurve)
+      self.rightmotor.rotatewheel(rturns, power, vmax, accel, scurve)
+      return
+    if accel is None :
+      accel = 4 * vmax
+    longest = max(abs(lturns), abs(rturns))
+    if longest == 0 :
+      return
+    lratio = abs(lturns) / longest
+    rratio = abs(rturns) / longest
+    self.syncing = False
+    self.lratio = int(lratio * 4096)
+    self.rratio = int(rratio * 4096)
+    self.leftmotor.rotatewheel(lturns, power, vmax * lratio, accel * lratio, scurve)
+    self.rightmotor.rotatewheel(rturns, power, vmax * rratio, accel * rratio, scurve)
+    self.syncing = True
+
+  """
+  Periodic task of the platform, which runs after the rpm handlers of the motors.
+  In synchronized moves, it compares the progress of the wheels relatively to 
+  their distances, and corrects their outputs so that they stay synchronized.
+  """
+  def sync_handler(self, tim) :
+    lm = self.leftmotor
+    rm = self.rightmotor
+    if not self.syncing :
+      return
+    if lm.profile is None or rm.profile is None :  # one of the wheels is done
+      self.syncing = False
+      lm.coupling = 0
+      rm.coupling = 0
+      return
+    # How much the left wheel is ahead, in counts relative to the longest move
+    ahead = (lm.count_a * self.rratio - rm.count_a * self.lratio) >> 12
+    corr = (self.kcouple * ahead) >> 8
+    lm.coupling = -corr
+    rm.coupling = corr
+
+  """
+  Tell whether the moves of both wheels are done.
+  """
+  def motion_done(self) :
+    return self.leftmotor.motion_done() and self.rightmotor.motion_done()
+
+  """
+  Wait for the moves of both wheels to be done, sleeping between checks.
+  If 'timeout_ms' is given, give up after this time. 
+  Return True if the moves are done, False on timeout.
+  """
+  def wait(self, timeout_ms=None) :
+    start = pyb.millis()
+    for motor in (self.leftmotor, self.rightmotor) :
+      remaining = None
+      if timeout_ms is not None :
+        remaining = max(0, timeout_ms - pyb.elapsed_millis(start))
+      if not motor.wait(remaining) :
+        return False
+    return True
+
+  """
+  Coroutine which waits for the moves of both wheels to be done (see 
+  RomiMotor.wait_done). Return True if the moves are done, False on timeout.
+  """
+  async def wait_done(self, timeout_ms=None) :
+    start = pyb.millis()
+    for motor in (self.leftmotor, self.rightmotor) :
+      remaining = None
+      if timeout_ms is not None :
+        remaining = max(0, timeout_ms - pyb.elapsed_millis(start))
+      if not await motor.wait_done(remaining) :
+        return False
+    return True
+
+  """
+  Add a motion segment at the end of the queue. Each wheel turns by 'lturns' and
+  'rturns' at 'power' percents of the max power, while cruising at 'lrpm' and 
+  'rrpm' if they are not 0 (the RPMs are the ones of 'cruise'). A wheel which 
+  does not turn by a number of turns cruises in the direction given by the 
+  sign of its RPMs. The segment ends after 'ms' milliseconds if 'ms' is not 0,
+  and when the moves of both wheels are done otherwise.
+  The segments are started by the timer handler as soon as the previous one 
+  ends, and the wheels do not slow down at the end of a segment which is
+  followed by another one, so that they keep turning until the next segment
+  starts. The platform stops after the last segment.
+  Return False if the queue is full.
+  """
+  def queue_segment(self, lturns, rturns, lrpm=0, rrpm=0, ms=0, power=20) :
+    if lturns == 0 and rturns == 0 and ms <= 0 :
+      raise ValueError("A segment without move needs a duration")
+    lcounts = int(360 * lturns)
+    rcounts = int(360 * rturns)
+    lspeed = int(60 * lrpm)
+    rspeed = int(60 * rrpm)
+    irq = pyb.disable_irq()
+    ok = self.queue.push(lcounts, rcounts, lspeed, rspeed, int(ms), int(power))
+    pyb.enable_irq(irq)
+    return ok
+
+  """
+  Remove the pending segments from the queue. The current segment goes on.
+  """
+  def flush_queue(self) :
+    irq = pyb.disable_irq()
+    self.queue.flush()
+    pyb.enable_irq(irq)
+
+  """
+  Get the state of the queue as (pending, capacity, active, done), where 
+  'pending' is the number of segments in the queue, 'active' tells whether
+  a segment is running, and 'done' is the number of segments completed.
+  """
+  def queue_status(self) :
+    return (len(self.queue), self.queue.capacity, self.seg_active, self.seg_done)
+
+  """
+  Periodic task of the platform, which runs at the frequency of the timer.
+  It ends the current segment of the queue when its moves are done or its 
+  duration has elapsed, and starts the next one.
+  This does not allocate memory.
   """
-  def move(self, lturns, rturns, power=20) :
-    self.leftmotor.rotatewheel(lturns, power)
-    self.rightmotor.rotatewheel(rturns, power)
+  def queue_handler(self, tim) :
+    if self.seg_active :
+      seg = self.queue.current
+      if seg[SEG_MS] > 0 :
+        if pyb.elapsed_millis(self.seg_start) < seg[SEG_MS] :
+          return
+      elif not self.motion_done() :
+        return
+      self.seg_done += 1
+      if not self.queue.pop() :  # this was the last segment
+        self.seg_active = False
+        self.leftmotor.stop()
+        self.rightmotor.stop()
+        return
+    elif not self.queue.pop() :
+      return
+    seg = self.queue.current
+    slowdown = self.queue.count == 0  # chain the moves if another segment follows
+    self.syncing = False
+    self.leftmotor.start_segment(seg[SEG_LCOUNTS], seg[SEG_LSPEED], seg[SEG_POWER], slowdown)
+    self.rightmotor.start_segment(seg[SEG_RCOUNTS], seg[SEG_RSPEED], seg[SEG_POWER], slowdown)
+    self.seg_start = pyb.millis()
+    self.seg_active = True
+
+  """
+  Start recording telemetry samples 'rate' times per second in a ring of
+  'capacity' samples. The fields of the samples are given by the TEL_* constants 
+  of romictl. The rate is at most the frequency of the timer (RomiMotor.freq).
+  Return the actual rate, which may differ from 'rate' because the timer 
+  frequency is divided by an integer.
+  """
+  def start_telemetry(self, rate=100, capacity=128) :
+    self.stop_telemetry()
+    self.telemetry = TelemetryRing(capacity)
+    self.telemetry_task = RomiMotor.add_task('telemetry', self.telemetry_handler, rate)
+    return RomiMotor.scheduler.rate(self.telemetry_task)
+
+  """
+  Stop recording telemetry samples.
+  """
+  def stop_telemetry(self) :
+    if self.telemetry_task is not None :
+      RomiMotor.scheduler.remove(self.telemetry_task)
+      self.telemetry_task = None
+    self.telemetry = None
+
+  """
+  Periodic task of the platform, which records a telemetry sample.
+  This does not allocate memory.
+  """
+  def telemetry_handler(self, tim) :
+    ring = self.telemetry
+    lm = self.leftmotor
+    rm = self.rightmotor
+    d = ring.data
+    i = ring.slot()
+    d[i + TEL_TIME] = int16(pyb.millis())
+    d[i + TEL_LPOS] = int16(lm.position)
+    d[i + TEL_LSPEED] = int16(lm.speed())
+    d[i + TEL_LDUTY] = lm.get_duty()
+    d[i + TEL_RPOS] = int16(rm.position)
+    d[i + TEL_RSPEED] = int16(rm.speed())
+    d[i + TEL_RDUTY] = rm.get_duty()
+    ring.commit()
+
+  """
+  Get the pending telemetry samples packed in a binary frame (see 
+  romictl.TelemetryRing.drain), or None if telemetry is not recorded.
+  The frame is only valid until the next call.
+  """
+  def drain_telemetry(self) :
+    ring = self.telemetry
+    if ring is None :
+      return None
+    irq = pyb.disable_irq()
+    frame = ring.drain()
+    pyb.enable_irq(irq)
+    return frame
+
+  """
+  Get the time to target and the final error of the last profiled move of the
+  left and right wheels, as ((ltime, lerror), (rtime, rerror)).
+  """
+  def move_report(self) :
+    return (self.leftmotor.move_report(), self.rightmotor.move_report())
     
   """
   Set a target RPM value for the wheels.
@@ -266,17 +1015,29 @@ class RomiPlatform :
     self.leftmotor.cruise(lrpms)
     self.rightmotor.cruise(rrpms)
 
+  """
+  Select how the speed of both wheels is regulated when cruising ('step' or 'pid').
+  """
+  def cruise_mode(self, mode, **gains) :
+    self.leftmotor.cruise_mode(mode, **gains)
+    self.rightmotor.cruise_mode(mode, **gains)
+
   """
   Cancel all rotation and RPM targets.
   """
   def clear(self) :
+    self.flush_queue()
+    self.seg_active = False
+    self.syncing = False
     self.leftmotor.clear()
     self.rightmotor.clear()
 
   """
-  Stop both motors.
+  Stop both motors, and cancel the queued segments.
   """
   def stop(self) :
+    self.flush_queue()
+    self.seg_active = False
     self.leftmotor.stop()
     self.rightmotor.stop()
   
@@ -4,23 +4,34 @@
 # This module is a reads command on the UART of the Pyboard to drive a Romi chassis.
 # The commands are sent on the serial link by an ESP32 which runs an HTTP and a 
 # WebSocket server to receive commands from the user.
+# The server runs on uasyncio: a task reads the commands on the UART, another
+# one pushes the status of the chassis when it changes, and a third one tells
+# the ESP32 when a move is done, without waiting for a request.
 #
 # © Frédéric Boulanger <frederic.softdev@gmail.com>
 # 2020-04-02 -- 2020-05-24
 # This software is licensed under the Eclipse Public License 2.0
 ############
 from pyb import UART, Pin, LED
+import time
+import uasyncio
 from romipyb import RomiPlatform
+from romicmd import CommandTable
+from romilink import FrameLink
 
 # UART(1) is on TX=X9/RX=X10
-uart = UART(1, baudrate=115200, timeout=1000)
+# The link starts at 115200 bauds, the ESP32 may then negotiate a higher rate.
+baudrate = 115200
+uart = UART(1, baudrate=baudrate, timeout=0)
+link = FrameLink(uart)
 led = LED(4)  # the blue LED
 
 romp = RomiPlatform()
 lm = romp.leftmotor
 rm = romp.rightmotor
 
-def sendStatus() :
+# Get the status of the chassis
+def status() :
   status = "UPDATE %d %d %f %d %f\r\n" % \
                             (led.intensity(),
                                 lm.count_a,
@@ -28,35 +39,246 @@ def sendStatus() :
                                       rm.count_a,
                                          rm.get_rpms()
                             )
-  uart.write(status.encode())
+  return status.encode()
+
+# Get the state of the motion queue
+def queueStatus() :
+  return ("QSTAT %d %d %d %d\r\n" % romp.queue_status()).encode()
+
+# Handlers of the commands, called with the list of the parsed arguments.
+# They return the answer to send on the UART.
+_OK = b"OK\r\n"
+
+def cmdLedOn(args, context) :
+  led.on()
+  return _OK
+
+def cmdLedOff(args, context) :
+  led.off()
+  return _OK
+
+def cmdStat(args, context) :
+  return status()
+
+def cmdPose(args, context) :
+  return ("POSE %f %f %f\r\n" % romp.pose()).encode()
+
+def cmdQueue(args, context) :
+  power = 20 if args[5] is None else args[5]
+  if not romp.queue_segment(args[0], args[1], args[2] or 0, args[3] or 0, args[4] or 0, power) :
+    return b"ERR Queue full\r\n"
+  moving.set()
+  return queueStatus()
+
+def cmdFlush(args, context) :
+  romp.flush_queue()
+  return queueStatus()
+
+def cmdQstat(args, context) :
+  return queueStatus()
+
+def cmdCmdstat(args, context) :
+  return ("CMDSTAT" + "".join([" %s %d %d %d" % stat for stat in commands.stats()]) + "\r\n").encode()
+
+def cmdMove(args, context) :
+  romp.move(args[0], args[1])
+  moving.set()
+  return _OK
+
+def cmdCruise(args, context) :
+  romp.cruise(args[0], args[1])
+  return _OK
+
+def cmdStop(args, context) :
+  romp.stop()
+  return _OK
+
+def cmdShutdown(args, context) :
+  romp.shutdown()
+  return _OK
+
+# Negotiation of the baud rate: after answering BAUD, we switch to the new rate
+# and keep it only if the ESP32 confirms with BAUDOK within 'fallback_ms'.
+fallback_ms = 1000
+newbaud = None            # rate to switch to after sending the answer
+oldbaud = None            # rate to fall back to if the new one is not confirmed
+fallback = None           # deadline of the confirmation
+
+def setBaudrate(rate) :
+  global baudrate
+  time.sleep_ms(2)        # let the last byte go out
+  uart.init(rate, bits=8, parity=None, stop=1, timeout=0)
+  baudrate = rate
+
+def cmdBaud(args, context) :
+  global newbaud
+  newbaud = args[0]
+  forgetAnswers()
+  return _OK
+
+# HELLO is sent by the other side when it starts. Its sequence numbers start
+# again, so the answers remembered for the previous session must be forgotten.
+def cmdHello(args, context) :
+  forgetAnswers()
+  return ("HELLO %s\r\n" % (args[0] or "")).encode()
+
+def cmdBaudok(args, context) :
+  global fallback
+  fallback = None
+  return _OK
+
+def cmdPing(args, context) :
+  return ("PONG %s\r\n" % (args[0] or "")).encode()
+
+def cmdLinkstat(args, context) :
+  return ("LINKSTAT %d %d %d %d %d %d\r\n" % (baudrate, link.received, link.sent, 
+                                        link.crc_errors, link.overruns, duplicates)).encode()
+
+def cmdPush(args, context) :
+  global push_ms
+  push_ms = max(0, args[0])
+  return _OK
+
+def cmdClose(args, context) :
+  return None
+
+def cmdUnknown(line, context) :
+  return ("ERR Unknow command %s\r\n" % bytes(line).decode().split()[0]).encode()
+
+# Table of the commands
+commands = CommandTable()
+commands.register("LED_ON", cmdLedOn)
+commands.register("LED_OFF", cmdLedOff)
+commands.register("STAT", cmdStat)
+commands.register("POSE", cmdPose)
+commands.register("QUEUE", cmdQueue, "ff|ffff")
+commands.register("FLUSH", cmdFlush)
+commands.register("QSTAT", cmdQstat)
+commands.register("CMDSTAT", cmdCmdstat)
+commands.register("MOVE", cmdMove, "ff")
+commands.register("CRUISE", cmdCruise, "ff")
+commands.register("STOP", cmdStop)
+commands.register("SHUTDOWN", cmdShutdown)
+commands.register("BAUD", cmdBaud, "i")
+commands.register("BAUDOK", cmdBaudok)
+commands.register("HELLO", cmdHello, "|s")
+commands.register("PING", cmdPing, "|*")
+commands.register("LINKSTAT", cmdLinkstat)
+commands.register("PUSH", cmdPush, "i")
+commands.register("CLOSE", cmdClose)
+commands.unknown = cmdUnknown
+
+# Answers to the last tagged commands, so that a command which is sent again
+# by the ESP32 because its answer was lost is not executed twice.
+# Tag "#0" is used by the ESP32 for controlling the link and is not remembered.
+# They are forgotten when a new session starts (HELLO) and when the baud rate changes.
+_RECENT = 8
+recent = {}
+recent_tags = [None] * _RECENT
+recent_next = 0
+duplicates = 0
+
+def remember(tag, answer) :
+  global recent_next
+  old = recent_tags[recent_next]
+  if old is not None :
+    del recent[old]
+  recent[tag] = answer
+  recent_tags[recent_next] = tag
+  recent_next = (recent_next + 1) % _RECENT
+
+def forgetAnswers() :
+  global recent_next
+  recent.clear()
+  for i in range(_RECENT) :
+    recent_tags[i] = None
+  recent_next = 0
+
+# Handle the command in a frame received from the ESP32.
+# A command may be tagged by a sequence number, as in "#12 MOVE 1 1", so that
+# the other board can have several commands in flight. The answer then has 
+# the same tag, as in "#12 OK".
+def handleFrame(line) :
+  global duplicates
+  tag = None
+  if len(line) > 0 and line[0] == 35 :   # '#'
+    space = 1
+    while space < len(line) and line[space] != 32 :
+      space += 1
+    tag = bytes(line[:space + 1])
+    line = line[space + 1:]
+    answer = recent.get(tag)
+    if answer is not None :
+      duplicates += 1
+      link.send(answer, tag)
+      return
+  try :
+    answer = commands.dispatch(line)  # parsed in place, without decoding the line
+  except ValueError as err :
+    answer = ("ERR %s\r\n" % err).encode()
+  if answer is not None :
+    if tag is not None and tag != b"#0 " :
+      remember(tag, answer)
+    link.send(answer, tag)
+
+# Period in ms of the status pushes (0 for no push), set by the PUSH command
+push_ms = 200
+# Set when a move starts, for the notifier task
+moving = uasyncio.Event()
+
+# Task which reads the commands on the UART, and handles the switch to
+# a new baud rate.
+async def reader() :
+  global newbaud, oldbaud, fallback
+  stream = uasyncio.StreamReader(uart)
+  while True :
+    try :
+      data = await uasyncio.wait_for_ms(stream.read(64), 100)
+      link.feed(data, handleFrame)
+    except uasyncio.TimeoutError :
+      pass
+    if newbaud is not None :    # switch to the rate asked by the ESP32
+      oldbaud = baudrate
+      setBaudrate(newbaud)
+      newbaud = None
+      fallback = time.ticks_add(time.ticks_ms(), fallback_ms)
+    elif fallback is not None and time.ticks_diff(time.ticks_ms(), fallback) > 0 :
+      setBaudrate(oldbaud)      # the new rate was not confirmed
+      fallback = None
+
+# Task which pushes the status of the chassis every 'push_ms', 
+# when it has changed since the last push.
+async def pusher() :
+  last = None
+  while True :
+    if push_ms == 0 :
+      await uasyncio.sleep_ms(100)
+      continue
+    await uasyncio.sleep_ms(push_ms)
+    update = status()
+    if update != last :
+      link.send(update)
+      last = update
+
+# Task which sends DONE when the moves asked by MOVE or QUEUE are done.
+async def notifier() :
+  while True :
+    await moving.wait()
+    moving.clear()
+    while True :
+      await romp.wait_done()
+      pending, capacity, active, done = romp.queue_status()
+      if pending == 0 and not active :
+        break
+      await uasyncio.sleep_ms(10)   # wait for the next segment of the queue
+    if not moving.is_set() :  # not already restarted by a new move
+      link.send(b"DONE\r\n")
+      link.send(status())
 
 # Read commands and drive the chassis
-while True :
-  buf = uart.readline()    # Read next command with a timeout of 1s
-  if buf is None :
-    continue
-  args = buf.decode().split()
-#  print(args)
-  
-  if args[0] == "LED_ON" :
-    led.on()
-    uart.write("OK\r\n".encode())
-  elif args[0] == "LED_OFF" :
-    led.off()
-    uart.write("OK\r\n".encode())
-  elif args[0] == "STAT" :
-    sendStatus()
-  elif args[0] == "MOVE" :
-    romp.move(float(args[1]), float(args[2]))
-    uart.write("OK\r\n".encode())
-  elif args[0] == "CRUISE" :
-    romp.cruise(float(args[1]), float(args[2]))
-    uart.write("OK\r\n".encode())
-  elif args[0] == "STOP" :
-    romp.stop()
-    uart.write("OK\r\n".encode())
-  elif args[0] == "SHUTDOWN" :
-    romp.shutdown()
-    uart.write("OK\r\n".encode())
-  else :
-    uart.write(("ERR Unknow command %s\r\n" % args[0]).encode())
+async def main() :
+  uasyncio.create_task(pusher())
+  uasyncio.create_task(notifier())
+  await reader()
+
+uasyncio.run(main())
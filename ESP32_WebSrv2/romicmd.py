@@ -0,0 +1,286 @@
+############
+# romicmd.py for Micropython on ESP32 and Pyboard
+#
+# This module provides a table-driven dispatcher for the text commands sent
+# to the servers which drive the Romi chassis.
+# The first word of a command is hashed without creating a string, and its
+# arguments are parsed in place from a memoryview into preallocated slots,
+# so that dispatching a command allocates as little memory as possible.
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import time
+
+"""
+Hash the bytes of 'buf' from 'start' to 'end' without allocating memory.
+"""
+def hash_word(buf, start, end) :
+  h = 0
+  for i in range(start, end) :
+    h = (h * 31 + buf[i]) & 0xffffff
+  return h
+
+"""
+Parse the integer written in the bytes of 'buf' from 'start' to 'end'.
+"""
+def parse_int(buf, start, end) :
+  sign = 1
+  if start < end and buf[start] in (43, 45) :  # '+' or '-'
+    if buf[start] == 45 :
+      sign = -1
+    start += 1
+  if start >= end :
+    raise ValueError("Invalid integer")
+  value = 0
+  for i in range(start, end) :
+    digit = buf[i] - 48
+    if digit < 0 or digit > 9 :
+      raise ValueError("Invalid integer")
+    value = value * 10 + digit
+  return sign * value
+
+"""
+Parse the decimal number (with an optional exponent) written in the bytes
+of 'buf' from 'start' to 'end'.
+"""
+def parse_float(buf, start, end) :
+  sign = 1
+  if start < end and buf[start] in (43, 45) :
+    if buf[start] == 45 :
+      sign = -1
+    start += 1
+  mantissa = 0
+  scale = 0       # number of digits after the decimal point
+  digits = 0
+  point = False
+  i = start
+  while i < end :
+    c = buf[i]
+    if c == 46 and not point :    # '.'
+      point = True
+    elif 48 <= c <= 57 :
+      mantissa = mantissa * 10 + c - 48
+      digits += 1
+      if point :
+        scale += 1
+    else :
+      break
+    i += 1
+  if digits == 0 :
+    raise ValueError("Invalid number")
+  if i < end :
+    if buf[i] not in (69, 101) :  # 'E' or 'e'
+      raise ValueError("Invalid number")
+    scale -= parse_int(buf, i + 1, end)
+  if scale > 0 :
+    return sign * mantissa / 10 ** scale
+  return float(sign * mantissa * 10 ** -scale)
+
+"""
+A command of a CommandTable.
+'spec' gives the type of each argument: 'i' for an integer, 'f' for a number,
+'s' for a word, and '*' for the rest of the line. The arguments after a '|'
+are optional, and the slots of missing optional arguments are set to None.
+'calls' counts the calls to the handler, 'total_us' and 'max_us' are the
+total and longest durations of the calls in µs, parsing included.
+"""
+class Command :
+  def __init__(self, name, handler, spec) :
+    self.name = name.encode()
+    self.handler = handler
+    self.required = spec.find('|')
+    self.spec = spec.replace('|', '')
+    if self.required < 0 :
+      self.required = len(self.spec)
+    self.calls = 0
+    self.total_us = 0
+    self.max_us = 0
+
+"""
+Table of the text commands of a server. Each command is registered with
+its handler and the specification of its arguments (see Command).
+'dispatch' finds the command from the first word of a line, parses the
+arguments into the preallocated 'args' list and calls the handler with this
+list and a context given by the caller (for instance, the client which sent
+the command). The handler must not keep a reference to the list.
+When no command matches, the 'unknown' handler is called with the line and
+the context. By default, it raises a ValueError.
+A line may also hold a batch of at most 'maxbatch' commands separated by ';',
+which are all parsed by 'parse_batch' before being run by 'run_batch'.
+"""
+class CommandTable :
+  def __init__(self, maxargs=8, maxbatch=8) :
+    self.commands = {}            # lists of commands by hash of their name
+    self.args = [None] * maxargs  # slots of the arguments
+    self.batch = [None] * maxbatch  # commands of the last batch
+    self.batch_args = [[None] * maxargs for i in range(maxbatch)]  # their arguments
+    self.unknown = self.unknown_command
+
+  """
+  Register 'handler' for the command 'name', with arguments given by 'spec'.
+  """
+  def register(self, name, handler, spec='') :
+    cmd = Command(name, handler, spec)
+    if len(cmd.spec) > len(self.args) :
+      raise ValueError("Too many arguments for command %s" % name)
+    key = hash_word(cmd.name, 0, len(cmd.name))
+    self.commands.setdefault(key, []).append(cmd)
+    return cmd
+
+  """
+  Default handler for unknown commands.
+  """
+  def unknown_command(self, line, context) :
+    raise ValueError("Unknown command %s" % line)
+
+  """
+  Find the command whose name is the bytes of 'buf' from 'start' to 'end'.
+  """
+  def find(self, buf, start, end) :
+    cmds = self.commands.get(hash_word(buf, start, end))
+    if cmds is None :
+      return None
+    for cmd in cmds :
+      name = cmd.name
+      if len(name) != end - start :
+        continue
+      i = 0
+      while i < len(name) and name[i] == buf[start + i] :
+        i += 1
+      if i == len(name) :
+        return cmd
+    return None
+
+  """
+  Parse and run the command in 'line' (a str, bytes or bytearray), calling
+  its handler with the arguments and 'context'. Return the result of the
+  handler, or None for an empty line.
+  """
+  def dispatch(self, line, context=None) :
+    start_us = time.ticks_us()
+    buf = _buffer(line)
+    end = len(buf)
+    i = _skip_blanks(buf, 0, end)
+    if i >= end :
+      return None
+    j = _skip_word(buf, i, end)
+    cmd = self.find(buf, i, j)
+    if cmd is None :
+      return self.unknown(line, context)
+    self.parse_args(cmd, buf, j, end, self.args)
+    return self.run(cmd, self.args, context, start_us)
+
+  """
+  Parse the arguments of 'cmd' in the bytes of 'buf' from 'i' to 'end' into 'args'.
+  """
+  def parse_args(self, cmd, buf, i, end, args) :
+    spec = cmd.spec
+    n = 0
+    i = _skip_blanks(buf, i, end)
+    while n < len(spec) and i < end :
+      kind = spec[n]
+      if kind == '*' :
+        j = end
+        while j > i and buf[j - 1] <= 32 :
+          j -= 1
+        args[n] = bytes(buf[i:j]).decode()
+      else :
+        j = _skip_word(buf, i, end)
+        if kind == 'i' :
+          args[n] = parse_int(buf, i, j)
+        elif kind == 'f' :
+          args[n] = parse_float(buf, i, j)
+        else :
+          args[n] = bytes(buf[i:j]).decode()
+      n += 1
+      i = _skip_blanks(buf, j, end)
+    if n < cmd.required :
+      raise ValueError("Missing arguments for command %s" % cmd.name.decode())
+    while n < len(spec) :
+      args[n] = None
+      n += 1
+
+  """
+  Call the handler of 'cmd' with 'args' and 'context', and update the timing 
+  of the command, which started at 'start_us'. Return the result of the handler.
+  """
+  def run(self, cmd, args, context, start_us) :
+    result = cmd.handler(args, context)
+    duration = time.ticks_diff(time.ticks_us(), start_us)
+    cmd.calls += 1
+    cmd.total_us += duration
+    if duration > cmd.max_us :
+      cmd.max_us = duration
+    return result
+
+  """
+  Parse the commands separated by ';' in 'line' in one pass, without running 
+  them, and return their number. Raise a ValueError if one of them is unknown
+  or invalid, so that no command of an invalid batch is run.
+  """
+  def parse_batch(self, line) :
+    buf = _buffer(line)
+    end = len(buf)
+    n = 0
+    i = 0
+    while i < end :
+      stop = i
+      while stop < end and buf[stop] != 59 :    # ';'
+        stop += 1
+      k = _skip_blanks(buf, i, stop)
+      if k < stop :
+        if n >= len(self.batch) :
+          raise ValueError("Too many commands in batch")
+        j = _skip_word(buf, k, stop)
+        cmd = self.find(buf, k, j)
+        if cmd is None :
+          raise ValueError("Unknown command %s" % bytes(buf[k:j]).decode())
+        self.parse_args(cmd, buf, j, stop, self.batch_args[n])
+        self.batch[n] = cmd
+        n += 1
+      i = stop + 1
+    return n
+
+  """
+  Run the command at index 'k' of the last batch parsed by parse_batch
+  with 'context'. Return the result of its handler.
+  """
+  def run_batch(self, k, context=None) :
+    return self.run(self.batch[k], self.batch_args[k], context, time.ticks_us())
+
+  """
+  Get the statistics of the commands as a list of (name, calls, total_us, max_us).
+  """
+  def stats(self) :
+    result = []
+    for cmds in self.commands.values() :
+      for cmd in cmds :
+        result.append((cmd.name.decode(), cmd.calls, cmd.total_us, cmd.max_us))
+    return result
+
+"""
+Get a memoryview of the bytes of 'line'.
+"""
+def _buffer(line) :
+  try :
+    return memoryview(line)
+  except TypeError :          # str has no buffer under CPython
+    return memoryview(line.encode())
+
+"""
+Get the index of the first non blank byte of 'buf' from 'i' to 'end'.
+"""
+def _skip_blanks(buf, i, end) :
+  while i < end and buf[i] <= 32 :
+    i += 1
+  return i
+
+"""
+Get the index of the first blank byte of 'buf' from 'i' to 'end'.
+"""
+def _skip_word(buf, i, end) :
+  while i < end and buf[i] > 32 :
+    i += 1
+  return i
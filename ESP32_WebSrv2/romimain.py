@@ -19,6 +19,7 @@
 from MicroWebSrv2 import MicroWebSrv2
 from machine import Pin
 from romiesp32 import RomiPlatform
+from romicmd import CommandTable
 
 # Builtin LED is on pin 5 on this board
 led = Pin(5, Pin.OUT)
@@ -66,6 +67,12 @@ def sendStatus(webSocket) :
                                                 rm.get_rpms()
                             ))
 
+"""
+Send the state of the motion queue of the chassis to the client
+"""
+def sendQueueStatus(webSocket) :
+  webSocket.SendTextMessage("QSTAT %d %d %d %d" % romp.queue_status())
+
 """
 Accept connections to the web socket server
 """
@@ -75,28 +82,79 @@ def _acceptWebSocketCallback(webSrv, webSocket) :
   webSocket.OnBinaryMessage = _recvBinaryCallback
   webSocket.OnClosed        = _closedCallback
 
+"""
+Handlers of the commands, called with the list of the parsed arguments and
+the web socket of the client
+"""
+def cmdLedOn(args, webSocket) :
+  led.on()
+
+def cmdLedOff(args, webSocket) :
+  led.off()
+
+def cmdStat(args, webSocket) :
+  sendStatus(webSocket)
+
+def cmdPose(args, webSocket) :
+  webSocket.SendTextMessage("POSE %f %f %f" % romp.pose())
+
+def cmdQueue(args, webSocket) :
+  power = 20 if args[5] is None else args[5]
+  if romp.queue_segment(args[0], args[1], args[2] or 0, args[3] or 0, args[4] or 0, power) :
+    sendQueueStatus(webSocket)
+  else :
+    webSocket.SendTextMessage("QFULL")
+
+def cmdFlush(args, webSocket) :
+  romp.flush_queue()
+  sendQueueStatus(webSocket)
+
+def cmdQstat(args, webSocket) :
+  sendQueueStatus(webSocket)
+
+def cmdCmdstat(args, webSocket) :
+  webSocket.SendTextMessage("CMDSTAT" + "".join([" %s %d %d %d" % stat for stat in commands.stats()]))
+
+def cmdMove(args, webSocket) :
+  romp.move(args[0], args[1])
+
+def cmdCruise(args, webSocket) :
+  romp.cruise(args[0], args[1])
+
+def cmdStop(args, webSocket) :
+  romp.stop()
+
+def cmdShutdown(args, webSocket) :
+  romp.shutdown()
+
+def cmdUnknown(msg, webSocket) :
+  webSocket.SendTextMessage("Unknow command %s" % msg)
+
+# Table of the commands
+commands = CommandTable()
+commands.register("LED_ON", cmdLedOn)
+commands.register("LED_OFF", cmdLedOff)
+commands.register("STAT", cmdStat)
+commands.register("POSE", cmdPose)
+commands.register("QUEUE", cmdQueue, "ff|ffff")
+commands.register("FLUSH", cmdFlush)
+commands.register("QSTAT", cmdQstat)
+commands.register("CMDSTAT", cmdCmdstat)
+commands.register("MOVE", cmdMove, "ff")
+commands.register("CRUISE", cmdCruise, "ff")
+commands.register("STOP", cmdStop)
+commands.register("SHUTDOWN", cmdShutdown)
+commands.unknown = cmdUnknown
+
 """
 Handle text messages received on the web socket
 """
 def _recvTextCallback(webSocket, msg) :
   print("WS RECV TEXT : %s" % msg)
-  args = msg.split()
-  if args[0] == "LED_ON" :
-    led.on()
-  elif args[0] == "LED_OFF" :
-    led.off()
-  elif args[0] == "STAT" :
-    sendStatus(webSocket)
-  elif args[0] == "MOVE" :
-    romp.move(float(args[1]), float(args[2]))
-  elif args[0] == "CRUISE" :
-    romp.cruise(float(args[1]), float(args[2]))
-  elif args[0] == "STOP" :
-    romp.stop()
-  elif args[0] == "SHUTDOWN" :
-    romp.shutdown()
-  else :
-    webSocket.SendTextMessage("Unknow command %s" % msg)
+  try :
+    commands.dispatch(msg, webSocket)
+  except ValueError as err :    # missing or invalid arguments
+    webSocket.SendTextMessage("ERR %s" % err)
 
 """
 Handle binary data received on the web socket (do nothing)
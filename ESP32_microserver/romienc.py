@@ -0,0 +1,127 @@
+############
+# romienc.py for Micropython on ESP32 and Pyboard
+#
+# This module provides counter backends for the rotation encoders of the
+# Romi chassis, for use with the RomiMotor class of romiesp32.py and romipyb.py.
+# Hardware backends count the impulses of the encoder without using the CPU,
+# the motor only polls them from its timer handler.
+#
+# The hardware modules are only imported when a backend is created, so that
+# this module can also be used under CPython with the simulated backend.
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+
+"""
+Extend the raw value of a hardware counter, which wraps around modulo 'modulo',
+into an unbounded signed count. The counter must be read at least once every
+modulo/2 counts for the direction of the change to be unambiguous.
+"""
+class WrapCounter :
+  def __init__(self, modulo=65536, raw=0) :
+    self.modulo = modulo
+    self.half = modulo // 2
+    self.raw = raw % modulo
+
+  """
+  Return the signed change of the counter since the last call, 'raw' being
+  the current value of the hardware counter.
+  """
+  def delta(self, raw) :
+    raw = raw % self.modulo
+    d = (raw - self.raw) % self.modulo
+    if d >= self.half :
+      d -= self.modulo
+    self.raw = raw
+    return d
+
+"""
+Counter backend for the pulse counter (PCNT) of the ESP32.
+The two channels of PCNT unit 'unit' decode both edges of the 'enca' and 'encb'
+Pin objects, so the count has the quadrature resolution (4 counts per impulse on A).
+The hardware counter is reset to 0 when it reaches 'limit' or -'limit'.
+"""
+class PcntCounter :
+  def __init__(self, enca, encb, unit=0, limit=32000, filter=1023) :
+    from esp32 import PCNT
+    self.pcnt = PCNT(unit, min=-limit, max=limit, filter=filter)
+    self.pcnt.init(channel=0, pin=enca, mode_pin=encb, mode_low=PCNT.REVERSE,
+                   rising=PCNT.INCREMENT, falling=PCNT.DECREMENT)
+    self.pcnt.init(channel=1, pin=encb, mode_pin=enca, mode_low=PCNT.REVERSE,
+                   rising=PCNT.DECREMENT, falling=PCNT.INCREMENT)
+    self.wrap = WrapCounter(limit)
+    self.pcnt.start()
+
+  """
+  Return the signed change of position since the last call.
+  """
+  def poll(self) :
+    return self.wrap.delta(self.pcnt.value())
+
+"""
+Counter backend for a timer of the Pyboard in encoder mode.
+'pina' and 'pinb' must be the pins of channels 1 and 2 of timer 'timer',
+and 'af' their alternate function for this timer, for instance:
+  TimerEncCounter(3, 'X7', 'X8', Pin.AF2_TIM3)
+The timer counts both edges of both outputs (4 counts per impulse on A).
+"""
+class TimerEncCounter :
+  def __init__(self, timer, pina, pinb, af) :
+    from pyb import Pin, Timer
+    self.pina = Pin(pina, Pin.AF_PP, pull=Pin.PULL_UP, af=af)
+    self.pinb = Pin(pinb, Pin.AF_PP, pull=Pin.PULL_UP, af=af)
+    self.timer = Timer(timer, prescaler=0, period=0xffff)
+    self.timer.channel(1, Timer.ENC_AB)
+    self.wrap = WrapCounter(0x10000, self.timer.counter())
+
+  """
+  Return the signed change of position since the last call.
+  """
+  def poll(self) :
+    return self.wrap.delta(self.timer.counter())
+
+"""
+Simulated hardware counter, which wraps around modulo 'modulo'.
+Use 'advance' to simulate impulses of the encoder.
+"""
+class SimCounter :
+  def __init__(self, modulo=65536) :
+    self.modulo = modulo
+    self.raw = 0
+    self.wrap = WrapCounter(modulo)
+
+  """
+  Simulate 'counts' quadrature counts (negative when the wheel turns backward).
+  """
+  def advance(self, counts) :
+    self.raw = (self.raw + counts) % self.modulo
+
+  """
+  Return the signed change of position since the last call.
+  """
+  def poll(self) :
+    return self.wrap.delta(self.raw)
+
+"""
+Build the counter backend of kind 'kind':
+  - 'irq' for counting in the interrupt handlers of the motor (returns None)
+  - 'pcnt' for the pulse counter of the ESP32
+  - 'timer' for a timer of the Pyboard in encoder mode
+  - 'sim' for a simulated counter
+The other arguments are given to the constructor of the backend.
+An object which already is a backend (it has a 'poll' method) is returned as is.
+"""
+def make_counter(kind, *args, **kwargs) :
+  if kind is None or kind == 'irq' :
+    return None
+  if hasattr(kind, 'poll') :
+    return kind
+  if kind == 'pcnt' :
+    return PcntCounter(*args, **kwargs)
+  if kind == 'timer' :
+    return TimerEncCounter(*args, **kwargs)
+  if kind == 'sim' :
+    return SimCounter(*args, **kwargs)
+  raise ValueError("Unknown counter backend %s" % kind)
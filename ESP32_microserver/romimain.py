@@ -14,8 +14,54 @@
 from httpserver import HttpServer
 from wsserver import WebSocketServer
 
-from machine import Pin
+from machine import Pin, Timer
 from romiesp32 import RomiPlatform
+from romicmd import CommandTable
+import romiproto
+import binascii
+
+"""
+Subscription of a client to the status of the platform: the server pushes an
+UPDATE frame with the values of the fields 'names', formatted by 'format', 
+every 'divider' ticks of its push timer, on the websocket 'writer' of the client.
+"""
+class Subscription :
+  def __init__(self, period, names, formats) :
+    self.period = period    # requested period in ms
+    self.names = names
+    self.formats = formats  # formats of the fields
+    self.format = "UPDATE " + " ".join(formats) + "\n"
+    self.divider = 1
+    self.countdown = 1
+    self.delta = None       # DeltaEncoder of the updates in delta mode
+    self.writer = None      # websocket of the client
+
+"""
+Encoder of the successive values of a status as changes. 'encode' gives a 
+full "UPDATE V0 V1 ..." frame every 'keyframe' updates, so that a client which 
+missed updates resynchronizes, and a "DELTA I V I V ..." frame with the index
+and the new value of the fields which changed otherwise, or None if no field changed.
+"""
+class DeltaEncoder :
+  def __init__(self, keyframe) :
+    self.keyframe = keyframe
+    self.last = None
+    self.countdown = 0
+
+  """
+  Encode 'values' formatted by 'formats' (one format per field).
+  """
+  def encode(self, formats, values) :
+    last = self.last
+    self.last = values
+    self.countdown -= 1
+    if last is None or self.countdown <= 0 or len(last) != len(values) :
+      self.countdown = self.keyframe
+      return "UPDATE " + " ".join([formats[i] % values[i] for i in range(len(values))]) + "\n"
+    changes = [("%d " + formats[i]) % (i, values[i]) for i in range(len(values)) if values[i] != last[i]]
+    if len(changes) == 0 :
+      return None
+    return "DELTA " + " ".join(changes) + "\n"
 
 """
 A subclass of WebSocketServer that implements a protocol to control 
@@ -31,65 +77,486 @@ class RomiServer (WebSocketServer) :
   'ledpin' is the number of the pin for the builtin LED.
   If 'debug' is True, a transcript of the communications with the clients will be printed
   in the console.
+  'min_push_ms' is the shortest period of the status updates pushed to the clients.
   """
-  def __init__(self, romi, port=8080, address="0.0.0.0", password='', ledpin=2, debug=False) :
+  def __init__(self, romi, port=8080, address="0.0.0.0", password='', ledpin=2, debug=False,
+               min_push_ms=20) :
     super().__init__(port, address, password)
     self._debug = debug
     self._led = Pin(ledpin, Pin.OUT)
     self._romi = romi
     self._led.on()
+    lm = romi.leftmotor
+    rm = romi.rightmotor
+    # Fields of the status which can be subscribed to, with their format and getter
+    self._fields = {
+      'led':    ("%d", self._led.value),
+      'lcount': ("%d", lambda : lm.count_a),
+      'lrpm':   ("%f", lm.get_rpms),
+      'rcount': ("%d", lambda : rm.count_a),
+      'rrpm':   ("%f", rm.get_rpms),
+      'lthrot': ("%d", lm.getThrottle),
+      'rthrot': ("%d", rm.getThrottle),
+      'x':      ("%f", lambda : romi.pose()[0]),
+      'y':      ("%f", lambda : romi.pose()[1]),
+      'head':   ("%f", lambda : romi.pose()[2])
+    }
+    self._subscriptions = {}  # subscriptions of the clients, by address
+    self._push_timer = None
+    self._min_push_ms = min_push_ms
+    self._binary = set()      # addresses of the clients which use the binary protocol
+    self._encoder = romiproto.AnswerEncoder()
+    self._deltas = {}         # DeltaEncoder of the status of the clients in delta mode, by address
+    self._commands = CommandTable()
+    self.register_commands()
   
   """
   Process requests from the client:
     - LED_ON requests to switch the builtin LED on
     - LED_OFF requests to switch the builtin LED off
     - STAT requests to send the status of the platform
-  The only possible answer is "UPDATE L CL RL CR RR", where:
+    - POSE requests to send the pose of the platform, answered by "POSE X Y H", 
+      where X and Y are in mm, and H is the heading in degrees
+    - QUEUE LT RT [LR RR [MS [P]]] adds a motion segment to the queue of the 
+      platform (see RomiPlatform.queue_segment), answered by "QFULL" if the 
+      queue is full, and by the answer to QSTAT otherwise
+    - FLUSH removes the pending segments from the queue, answered as QSTAT
+    - QSTAT requests the state of the queue, answered by "QSTAT N C A D", 
+      where N is the number of pending segments, C the capacity of the queue,
+      A is 1 if a segment is running, and D is the number of completed segments
+    - TELEM R [C] starts recording telemetry samples at R Hz in a ring of C samples
+      (see RomiPlatform.start_telemetry), or stops it if R is 0, answered by 
+      "TELEM R C" with the actual rate and the capacity of the ring
+    - DRAIN requests the recorded telemetry samples, answered by "DRAIN B" 
+      where B is the frame with all pending samples (see
+      romictl.TelemetryRing.drain) in base64, since the answers are sent in
+      text frames, or by "TELEM 0 0" when telemetry is not recorded
+    - SUBSCRIBE R [F] requests the server to push "UPDATE ..." frames with the 
+      values of the fields F (separated by commas or spaces) R times per second,
+      answered by "SUBSCRIBED R F" with the actual rate. The fields are the ones 
+      of UPDATE (led, lcount, lrpm, rcount, rrpm, lthrot, rthrot, which is the 
+      default), and x, y, head for the pose of the platform. The answer is 
+      "ERR" followed by the error if R is not positive or a field is unknown
+    - UNSUBSCRIBE stops pushing updates, answered by "UNSUBSCRIBED"
+    - PROTO BIN switches the client to the binary protocol (see romiproto.py), 
+      and PROTO TEXT switches it back, answered by "PROTO BIN V" with the version
+      of the binary protocol, or by "PROTO TEXT". The requests of a client in 
+      binary mode are frames carried by text messages starting with '!' (see
+      romiproto.encode_text), handled by process_binary, and answered in the 
+      same way, but it may still send text requests. Nothing is negotiated 
+      when a client connects: it uses the text protocol until it sends PROTO BIN.
+    - CMDSTAT requests the profiling counters of the commands, answered by 
+      "CMDSTAT N C T M ..." with, for each command N, the number of calls C, 
+      the total time T and the longest time M of these calls in µs
+    - DELTAMODE N switches the client to delta mode if N > 0, or back to full
+      updates, answered by "DELTAMODE N". In delta mode, the status of the 
+      platform, answered or pushed, is a full UPDATE frame every N updates, 
+      and a "DELTA I V ..." frame with the index I and the value V of the fields
+      which changed otherwise. Pushed updates are not sent when nothing changed,
+      and the answer to requests is then "DELTA". The answers and the pushed
+      updates of the fields of UPDATE share the same previous values, so that
+      each DELTA frame is relative to the last frame received by the client
+  Several commands may be sent in one request, separated by ';' (for instance
+  "LTHROT 50;RTHROT 50"). They are all parsed before being run, so that none 
+  of them is run if one is invalid, and the answer is then "ERR" followed by
+  the error. Consecutive commands of the motors (MOVE, CRUISE, LTHROT, RTHROT,
+  STOP, QUEUE, FLUSH) are run with the periodic tasks of the platform paused
+  (speed regulation, motion queue...), so that these tasks see them take 
+  effect at the same tick. The interrupts are not masked, since the commands
+  allocate memory. The answers of the commands which have their 
+  own text answer are sent in order, followed by a single status update if 
+  some commands have none.
+  The answer to other requests is "UPDATE L CL RL CR RR", where:
     - L is the status of the LED
     - CL is the count of the right wheel encoder
     - RL is the RPM of the right wheel
     - CR is the count of the left wheel encoder
     - RR is the RPM of the left wheel
   """
-  def process_request(self, message) :
+  def process_request(self, message, client=None) :
     if self._debug :
       print("# RECEIVED " + str(message))
     if message is None :   # Close server
       return None
-    message = message.split()
-    if len(message) == 0 :
+    if message[:1] == romiproto.TEXT_MARK :   # frame of the binary protocol
+      try :
+        frame = romiproto.decode_text(message)
+      except ValueError :
+        frame = b''
+      return romiproto.encode_text(self.process_binary(frame, client))
+    if ";" in message :
+      return self.process_batch(message, client)
+    try :
+      answer = self._commands.dispatch(message, client)
+    except ValueError as err :    # missing or invalid arguments
+      return "ERR %s\n" % err
+    if answer is None :
+      answer = self.status(client)
+    return answer
+
+  """
+  Process a batch of commands separated by ';' from the client at 'address'.
+  """
+  def process_batch(self, message, address) :
+    cmds = self._commands
+    try :
+      n = cmds.parse_batch(message)
+    except ValueError as err :
+      return "ERR %s\n" % err
+    romi = self._romi
+    answers = []
+    status = False    # some commands are answered by the status
+    paused = False    # the periodic tasks are paused while running motor commands
+    try :
+      for k in range(n) :
+        if cmds.batch[k] in self._motor_commands :
+          if not paused :
+            romi.pause_tasks()
+            paused = True
+        elif paused :
+          romi.resume_tasks()
+          paused = False
+        answer = cmds.run_batch(k, address)
+        if answer is None :
+          status = True
+        else :
+          answers.append(answer)
+    except ValueError as err :    # invalid arguments found by a command
+      answers.append("ERR %s\n" % err)
+    finally :
+      if paused :
+        romi.resume_tasks()
+    if status :
+      answers.append(self.status(address))
+    return "".join(answers)
+
+  """
+  Register the handlers of the text commands. Each handler is called with the
+  list of the parsed arguments and the address of the client, and returns 
+  the answer, or None to answer with the status of the platform.
+  """
+  def register_commands(self) :
+    cmds = self._commands
+    cmds.register("LED_ON", self.cmd_led_on)
+    cmds.register("LED_OFF", self.cmd_led_off)
+    cmds.register("STAT", self.cmd_stat)
+    cmds.register("POSE", self.cmd_pose)
+    queue = cmds.register("QUEUE", self.cmd_queue, "ff|ffff")
+    flush = cmds.register("FLUSH", self.cmd_flush)
+    cmds.register("QSTAT", self.cmd_qstat)
+    cmds.register("TELEM", self.cmd_telem, "i|i")
+    cmds.register("DRAIN", self.cmd_drain)
+    cmds.register("SUBSCRIBE", self.cmd_subscribe, "f|*")
+    cmds.register("UNSUBSCRIBE", self.cmd_unsubscribe)
+    cmds.register("PROTO", self.cmd_proto, "s")
+    cmds.register("CMDSTAT", self.cmd_cmdstat)
+    cmds.register("DELTAMODE", self.cmd_deltamode, "i")
+    # Commands of the motors, run with the interrupts masked in a batch
+    self._motor_commands = set([queue, flush,
+      cmds.register("MOVE", self.cmd_move, "ff"),
+      cmds.register("CRUISE", self.cmd_cruise, "ff"),
+      cmds.register("LTHROT", self.cmd_lthrot, "i"),
+      cmds.register("RTHROT", self.cmd_rthrot, "i"),
+      cmds.register("STOP", self.cmd_stop)
+    ])
+    cmds.register("SHUTDOWN", self.cmd_shutdown)
+    cmds.unknown = self.cmd_unknown
+
+  """
+  Handlers of the text commands (see process_request).
+  """
+  def cmd_led_on(self, args, client) :
+    self._led.on()
+
+  def cmd_led_off(self, args, client) :
+    self._led.off()
+
+  def cmd_stat(self, args, client) :
+    return None
+
+  def cmd_pose(self, args, client) :
+    return "POSE %f %f %f\n" % self._romi.pose()
+
+  def cmd_queue(self, args, client) :
+    lrpm, rrpm, ms, power = args[2], args[3], args[4], args[5]
+    if not self._romi.queue_segment(args[0], args[1], lrpm or 0, rrpm or 0, ms or 0,
+                                    20 if power is None else power) :
+      return "QFULL\n"
+    return self.queue_status()
+
+  def cmd_flush(self, args, client) :
+    self._romi.flush_queue()
+    return self.queue_status()
+
+  def cmd_qstat(self, args, client) :
+    return self.queue_status()
+
+  def cmd_telem(self, args, client) :
+    rate = args[0]
+    if rate <= 0 :
+      self._romi.stop_telemetry()
+      return "TELEM 0 0\n"
+    capacity = 128 if args[1] is None else args[1]
+    rate = self._romi.start_telemetry(rate, capacity)
+    return "TELEM %f %d\n" % (rate, capacity)
+
+  def cmd_drain(self, args, client) :
+    frame = self._romi.drain_telemetry()
+    if frame is None :
+      return "TELEM 0 0\n"
+    return "DRAIN " + binascii.b2a_base64(frame).decode()   # sent in a text frame
+
+  def cmd_subscribe(self, args, client) :
+    names = (args[1] or "").replace(",", " ").split()
+    try :
+      sub = self.subscribe(client, args[0], names)
+    except ValueError as err :
+      return "ERR %s\n" % err
+    return "SUBSCRIBED %f %s\n" % (1000 / sub.period, ",".join(sub.names))
+
+  def cmd_unsubscribe(self, args, client) :
+    self.unsubscribe(client)
+    return "UNSUBSCRIBED\n"
+
+  def cmd_proto(self, args, client) :
+    if args[0] == "BIN" :
+      self._binary.add(client)
+      return "PROTO BIN %d\n" % romiproto.VERSION
+    self._binary.discard(client)
+    return "PROTO TEXT\n"
+
+  def cmd_cmdstat(self, args, client) :
+    return "CMDSTAT" + "".join([" %s %d %d %d" % stat for stat in self._commands.stats()]) + "\n"
+
+  def cmd_move(self, args, client) :
+    self._romi.move(args[0], args[1])
+
+  def cmd_cruise(self, args, client) :
+    self._romi.cruise(args[0], args[1])
+
+  def cmd_lthrot(self, args, client) :
+    self._romi.throttle(args[0], None)
+
+  def cmd_rthrot(self, args, client) :
+    self._romi.throttle(None, args[0])
+
+  def cmd_stop(self, args, client) :
+    self._romi.stop()
+
+  def cmd_shutdown(self, args, client) :
+    self._romi.shutdown()
+
+  def cmd_deltamode(self, args, client) :
+    keyframe = max(0, args[0])
+    sub = self._subscriptions.get(client)
+    if keyframe > 0 :
+      delta = DeltaEncoder(keyframe)
+      self._deltas[client] = delta
+      if sub is not None :
+        sub.delta = delta if sub.names == self.status_names else DeltaEncoder(keyframe)
+    else :
+      self._deltas.pop(client, None)
+      if sub is not None :
+        sub.delta = None
+    return "DELTAMODE %d\n" % keyframe
+
+  def cmd_unknown(self, message, client) :
+    if self._debug :
+      print("# UNKNOWN REQUEST: " + message)
+
+  # Names and formats of the fields of the status
+  status_names = ('led', 'lcount', 'lrpm', 'rcount', 'rrpm', 'lthrot', 'rthrot')
+  status_formats = ("%d", "%d", "%f", "%d", "%f", "%d", "%d")
+
+  """
+  Get the values of the fields of the status of the platform.
+  """
+  def status_values(self) :
+    lm = self._romi.leftmotor
+    rm = self._romi.rightmotor
+    return (self._led.value(), lm.count_a, lm.get_rpms(), rm.count_a, rm.get_rpms(),
+            lm.getThrottle(), rm.getThrottle())
+
+  """
+  Get the status of the platform, which is the answer to most requests from
+  the client at 'address', as changes if the client is in delta mode.
+  """
+  def status(self, address=None) :
+    values = self.status_values()
+    delta = self._deltas.get(address)
+    if delta is None :
+      return "UPDATE %d %d %f %d %f %d %d\n" % values
+    answer = delta.encode(self.status_formats, values)
+    if answer is None :
+      return "DELTA\n"
+    return answer
+
+  """
+  Process a request of the binary protocol from the client at 'address'.
+  The answer is a memoryview of the buffer of the encoder, which is only valid
+  until the next answer: process_request encodes it in a text message at once.
+  """
+  def process_binary(self, message, address) :
+    enc = self._encoder
+    if address not in self._binary :    # the client did not switch to the binary protocol
+      return enc.error(message[0] if len(message) > 0 else 0)
+    try :
+      op, args = romiproto.decode_request(message)
+    except ValueError :
+      return enc.error(message[0] if len(message) > 0 else 0)
+    romi = self._romi
+    if op == romiproto.OP_MOVE :
+      romi.move(args[0], args[1])
+    elif op == romiproto.OP_CRUISE :
+      romi.cruise(args[0], args[1])
+    elif op == romiproto.OP_LTHROT :
+      romi.throttle(args[0], None)
+    elif op == romiproto.OP_RTHROT :
+      romi.throttle(None, args[0])
+    elif op == romiproto.OP_STAT :
       pass
-    elif message[0] == "LED_ON" :
+    elif op == romiproto.OP_STOP :
+      romi.stop()
+    elif op == romiproto.OP_LED_ON :
       self._led.on()
-    elif message[0] == "LED_OFF" :
+    elif op == romiproto.OP_LED_OFF :
       self._led.off()
-    elif message[0] == "STAT" :
-      pass
-    elif message[0] == "MOVE" :
-      self._romi.move(float(message[1]), float(message[2]))
-    elif message[0] == "CRUISE" :
-      self._romi.cruise(float(message[1]), float(message[2]))
-    elif message[0] == "LTHROT" :
-      self._romi.throttle(int(message[1]), None)
-    elif message[0] == "RTHROT" :
-      self._romi.throttle(None, int(message[1]))
-    elif message[0] == "STOP" :
-      self._romi.stop()
-    elif message[0] == "SHUTDOWN" :
-      self._romi.shutdown()
-    else :
-      if self._debug :
-        print("# UNKNOWN REQUEST: " + message)
-    return ("UPDATE %d %d %f %d %f %d %d\n" %
-                   (self._led.value(),
-                       self._romi.leftmotor.count_a,
-                          self._romi.leftmotor.get_rpms(),
-                             self._romi.rightmotor.count_a,
-                                self._romi.rightmotor.get_rpms(),
-                                   self._romi.leftmotor.getThrottle(),
-                                      self._romi.rightmotor.getThrottle()
-           ))
-  
+    elif op == romiproto.OP_POSE :
+      return enc.pose(*romi.pose())
+    elif op == romiproto.OP_QUEUE :
+      if not romi.queue_segment(*args) :
+        return enc.qfull()
+      return enc.qstat(*romi.queue_status())
+    elif op == romiproto.OP_FLUSH :
+      romi.flush_queue()
+      return enc.qstat(*romi.queue_status())
+    elif op == romiproto.OP_QSTAT :
+      return enc.qstat(*romi.queue_status())
+    elif op == romiproto.OP_SHUTDOWN :
+      romi.shutdown()
+    lm = romi.leftmotor
+    rm = romi.rightmotor
+    return enc.update(self._led.value(), lm.count_a, lm.speed(), rm.count_a, rm.speed(),
+                      lm.getThrottle(), rm.getThrottle())
+
+  """
+  Get the answer to the QSTAT request.
+  """
+  def queue_status(self) :
+    pending, capacity, active, done = self._romi.queue_status()
+    return "QSTAT %d %d %d %d\n" % (pending, capacity, active, done)
+
+  """
+  Subscribe the client at 'address' to the fields 'names' of the status (all the
+  fields of UPDATE if empty), pushed 'rate' times per second. Return the Subscription.
+  Raise ValueError if 'rate' is not positive or a field is unknown, and keep 
+  the previous subscription of the client then.
+  """
+  def subscribe(self, address, rate, names) :
+    if not rate > 0 :     # also rejects nan
+      raise ValueError("Invalid rate %s" % rate)
+    names = tuple(names) if len(names) > 0 else self.status_names
+    for name in names :
+      if name not in self._fields :
+        raise ValueError("Unknown status field %s" % name)
+    period = max(self._min_push_ms, int(1000 / rate))
+    formats = tuple([self._fields[name][0] for name in names])
+    sub = Subscription(period, names, formats)
+    sub.writer = self.writer_of(address)
+    delta = self._deltas.get(address)
+    if delta is not None :    # the status is encoded by the same DeltaEncoder as the answers
+      sub.delta = delta if names == self.status_names else DeltaEncoder(delta.keyframe)
+    self._subscriptions[address] = sub
+    self.update_push_timer()
+    return sub
+
+  """
+  Cancel the subscription of the client at 'address'.
+  """
+  def unsubscribe(self, address) :
+    if address in self._subscriptions :
+      del self._subscriptions[address]
+      self.update_push_timer()
+
+  """
+  Run the push timer at the shortest period of the subscriptions, the other 
+  ones being pushed every 'divider' ticks, or stop it when there is no subscription.
+  """
+  def update_push_timer(self) :
+    if self._push_timer is not None :
+      self._push_timer.deinit()
+      self._push_timer = None
+    if len(self._subscriptions) == 0 :
+      return
+    period = min([sub.period for sub in self._subscriptions.values()])
+    for sub in self._subscriptions.values() :
+      sub.divider = max(1, (sub.period + period // 2) // period)
+      sub.countdown = 1
+    self._push_timer = Timer(-1)
+    self._push_timer.init(period=period, mode=Timer.PERIODIC, callback=self.push_handler)
+
+  """
+  Callback of the push timer, which sends their update to the subscribers which are due.
+  The subscribers form a broadcast group: the fields are read once per tick, 
+  and each full update is encoded once per tick for all the subscribers which 
+  requested the same fields, the same buffer being sent to all of them. 
+  Only the updates in delta mode are encoded for each subscriber. The websocket
+  of each subscriber is found when it subscribes, not at each tick.
+  """
+  def push_handler(self, tim) :
+    snapshot = {}   # values of the fields read during this tick
+    frames = {}     # full updates encoded during this tick, by format
+    for address, sub in list(self._subscriptions.items()) :
+      if sub.writer is None :   # the client is not connected
+        self.unsubscribe(address)
+        continue
+      sub.countdown -= 1
+      if sub.countdown > 0 :
+        continue
+      sub.countdown = sub.divider
+      if sub.delta is None :
+        update = frames.get(sub.format)
+        if update is None :
+          update = (sub.format % self.snapshot_values(snapshot, sub.names)).encode()
+          frames[sub.format] = update
+      else :
+        update = sub.delta.encode(sub.formats, self.snapshot_values(snapshot, sub.names))
+        if update is None :   # nothing changed
+          continue
+      try :
+        sub.writer.write(update)
+      except OSError :    # the connection is lost
+        self.unsubscribe(address)
+
+  """
+  Get the values of the fields 'names', reading the fields which are not 
+  in 'snapshot' yet and adding them to it.
+  """
+  def snapshot_values(self, snapshot, names) :
+    for name in names :
+      if name not in snapshot :
+        snapshot[name] = self._fields[name][1]()
+    return tuple([snapshot[name] for name in names])
+
+  """
+  Get the websocket from which the server reads the requests of the client 
+  at 'address', or None if the client is not connected.
+  """
+  def writer_of(self, address) :
+    for wsreader in self._clients :
+      if self.getClientFromReader(wsreader)[0] == address :
+        return wsreader
+    return None
+
+  """
+  Send 'data' to the client at 'address', on the websocket from which the 
+  server reads its requests.
+  """
+  def send_to(self, address, data) :
+    wsreader = self.writer_of(address)
+    if wsreader is not None :
+      wsreader.write(data)
+
   """
   Redefined method to install process_request as the request handler
   """
@@ -102,7 +569,8 @@ class RomiServer (WebSocketServer) :
       if self._debug :
         print("# Accepting connection from: ", address)
       self._led.off()
-      return self.process_request   #   return our request handler
+      # return our request handler, which knows the address of the client
+      return lambda message : self.process_request(message, address)
   
   """
   Redefined method to print a message when a connection is closed
@@ -111,6 +579,10 @@ class RomiServer (WebSocketServer) :
     if self._debug :
       print("# Closing connection from", self.getClientFromReader(wsreader)[0])
     self._led.on()
+    address = self.getClientFromReader(wsreader)[0]
+    self.unsubscribe(address)
+    self._binary.discard(address)
+    self._deltas.pop(address, None)
     super().close_handler(wsreader)  # Reuse superclass behavior to really close the connection
 
 ## TTGO T7_V1.4 board
@@ -0,0 +1,185 @@
+############
+# romiproto.py for Micropython on ESP32
+#
+# Binary protocol for driving a Romi chassis over a websocket, as an
+# alternative to the text protocol of RomiServer in romimain.py.
+# Each request and each answer starts with an opcode on one byte, followed by
+# a payload with a fixed layout for this opcode, packed in little endian order.
+# Decoding a request does not split strings or parse numbers, and answers are
+# packed into a preallocated buffer, so that the heap is much less used than
+# with the text protocol.
+# A client uses the text protocol when it connects, and switches to this
+# protocol by sending the text command PROTO BIN (see romimain.py). Binary
+# frames sent before are answered by OP_ERROR.
+#
+# The websocket server of the board only gives text messages to RomiServer
+# (with webrepl, the binary frames are used for transferring files) and sends
+# the answers in text frames. A frame of this protocol is therefore carried in
+# a text message made of '!' followed by the frame encoded in base64 (see
+# encode_text and decode_text).
+#
+# This module only depends on struct and binascii, so it can also be used 
+# under CPython by the clients of the server.
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-10 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import struct
+import binascii
+try :
+  from micropython import const
+except ImportError :
+  def const(value) :
+    return value
+
+# Version of the protocol, given when the client switches to it
+VERSION = const(1)
+
+# Opcodes of the requests
+OP_LED_ON = const(0x01)
+OP_LED_OFF = const(0x02)
+OP_STAT = const(0x03)
+OP_POSE = const(0x04)
+OP_MOVE = const(0x05)     # left and right turns (floats)
+OP_CRUISE = const(0x06)   # left and right RPMs (floats)
+OP_LTHROT = const(0x07)   # left throttle in percents (signed byte)
+OP_RTHROT = const(0x08)   # right throttle in percents (signed byte)
+OP_STOP = const(0x09)
+OP_SHUTDOWN = const(0x0a)
+OP_QUEUE = const(0x0b)    # turns and RPMs (floats), duration in ms, power in percents
+OP_FLUSH = const(0x0c)
+OP_QSTAT = const(0x0d)
+
+# Opcodes of the answers
+OP_UPDATE = const(0x81)   # LED, count and speed (in impulses on A per second) of
+                          # the left and right wheels, left and right throttles
+OP_POSE_ANS = const(0x84) # x and y in mm, heading in degrees (floats)
+OP_QSTAT_ANS = const(0x8d)  # pending segments, capacity, active, done segments
+OP_QFULL = const(0x8e)
+OP_ERROR = const(0xff)    # opcode of the request which could not be processed
+
+# Layout of the payloads of the requests, by opcode
+REQUESTS = {
+  OP_LED_ON: '',
+  OP_LED_OFF: '',
+  OP_STAT: '',
+  OP_POSE: '',
+  OP_MOVE: '<ff',
+  OP_CRUISE: '<ff',
+  OP_LTHROT: '<b',
+  OP_RTHROT: '<b',
+  OP_STOP: '',
+  OP_SHUTDOWN: '',
+  OP_QUEUE: '<ffffHB',
+  OP_FLUSH: '',
+  OP_QSTAT: ''
+}
+
+# Layout of the answers, including the opcode
+ANSWERS = {
+  OP_UPDATE: '<BBiHiHbb',
+  OP_POSE_ANS: '<Bfff',
+  OP_QSTAT_ANS: '<BHHBH',
+  OP_QFULL: '<B',
+  OP_ERROR: '<BB'
+}
+
+_NOARGS = ()
+
+# First character of the text messages which carry a frame
+TEXT_MARK = '!'
+
+"""
+Get the text message which carries 'frame': '!', the frame in base64 and a newline.
+"""
+def encode_text(frame) :
+  return TEXT_MARK + binascii.b2a_base64(frame).decode()
+
+"""
+Get the frame carried by the text message 'message'.
+Raise ValueError if it is not a valid text message of a frame.
+"""
+def decode_text(message) :
+  if len(message) == 0 or message[0] != TEXT_MARK :
+    raise ValueError("Not a binary frame")
+  return binascii.a2b_base64(message[1:].strip())
+
+"""
+Decode a request and return its opcode and the tuple of its arguments.
+Raise ValueError if the opcode is unknown or the request is too short.
+"""
+def decode_request(msg) :
+  if len(msg) == 0 :
+    raise ValueError("Empty request")
+  op = msg[0]
+  layout = REQUESTS.get(op)
+  if layout is None :
+    raise ValueError("Unknown opcode %d" % op)
+  if layout == '' :
+    return (op, _NOARGS)
+  if len(msg) < 1 + struct.calcsize(layout) :
+    raise ValueError("Request %d is too short" % op)
+  return (op, struct.unpack_from(layout, msg, 1))
+
+"""
+Encode a request with opcode 'op' and arguments 'args' (used by the clients).
+"""
+def encode_request(op, *args) :
+  return bytes([op]) + struct.pack(REQUESTS[op], *args)
+
+"""
+Decode an answer and return the tuple of its fields, starting with the opcode.
+"""
+def decode_answer(msg) :
+  return struct.unpack_from(ANSWERS[msg[0]], msg, 0)
+
+"""
+Encoder of the answers of the server, in a preallocated buffer.
+The memoryview returned by each method is only valid until the next call.
+"""
+class AnswerEncoder :
+  def __init__(self) :
+    size = max([struct.calcsize(layout) for layout in ANSWERS.values()])
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.sizes = {}
+    for op in ANSWERS :
+      self.sizes[op] = struct.calcsize(ANSWERS[op])
+
+  """
+  Pack an answer with opcode 'op' and fields 'values'.
+  """
+  def encode(self, op, *values) :
+    struct.pack_into(ANSWERS[op], self.buffer, 0, op, *values)
+    return self.view[:self.sizes[op]]
+
+  """
+  Pack the status of the platform (answer to most requests).
+  """
+  def update(self, led, lcount, lspeed, rcount, rspeed, lthrot, rthrot) :
+    return self.encode(OP_UPDATE, led, lcount, lspeed, rcount, rspeed, lthrot, rthrot)
+
+  """
+  Pack the pose of the platform.
+  """
+  def pose(self, x, y, heading) :
+    return self.encode(OP_POSE_ANS, x, y, heading)
+
+  """
+  Pack the state of the motion queue.
+  """
+  def qstat(self, pending, capacity, active, done) :
+    return self.encode(OP_QSTAT_ANS, pending, capacity, active, done & 0xffff)
+
+  """
+  Pack the answer to a QUEUE request when the queue is full.
+  """
+  def qfull(self) :
+    return self.encode(OP_QFULL)
+
+  """
+  Pack the answer to request 'op' when it could not be processed.
+  """
+  def error(self, op) :
+    return self.encode(OP_ERROR, op & 0xff)
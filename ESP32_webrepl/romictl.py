@@ -0,0 +1,496 @@
+############
+# romictl.py for Micropython on ESP32 and Pyboard
+#
+# This module provides the control algorithms used by the RomiMotor and
+# RomiPlatform classes of romiesp32.py and romipyb.py, and the scheduler of
+# the periodic tasks which run on their shared timer.
+# Everything is computed with integers so that it can run in interrupt
+# handlers without allocating memory.
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import time
+import struct
+import micropython
+from micropython import const
+from array import array
+
+"""
+Integer PID controller with feedforward and anti-windup.
+The gains are fixed point numbers with 8 fractional bits (256 is 1.0):
+  - 'kff' is the feedforward gain, applied to the target
+  - 'kp' is the proportional gain, applied to the error
+  - 'ki' is the integral gain, per second
+  - 'kd' is the derivative gain, applied to the change of the measure per second
+'rate' is the number of calls to 'update' per second.
+The output is bounded by 'umin' and 'umax', and the integral is only updated
+when this does not push the output further out of these bounds.
+"""
+class PID :
+  def __init__(self, kp=64, ki=512, kd=0, kff=256, rate=4, umin=0, umax=1023) :
+    self.kp = kp
+    self.ki = ki
+    self.kd = kd
+    self.kff = kff
+    self.rate = rate
+    self.umin = umin
+    self.umax = umax
+    self.reset()
+
+  """
+  Forget the integral and the last measure.
+  """
+  def reset(self) :
+    self.integ = 0
+    self.last = None
+
+  """
+  Compute the output for reaching 'target' when the controlled value is 'measure'.
+  """
+  def update(self, target, measure) :
+    err = target - measure
+    integ = self.integ + (self.ki * err) // self.rate
+    u = self.kff * target + self.kp * err + integ
+    if self.last is not None :
+      u += self.kd * (self.last - measure) * self.rate
+    self.last = measure
+    u >>= 8
+    if u > self.umax :
+      u = self.umax
+      if err < 0 :        # the integral reduces the saturation
+        self.integ = integ
+    elif u < self.umin :
+      u = self.umin
+      if err > 0 :
+        self.integ = integ
+    else :
+      self.integ = integ
+    return u
+
+"""
+A periodic task of a Scheduler. The task runs every 'divider' ticks of the 
+timer. If 'scheduled' is True, it runs outside of the interrupt handler
+through micropython.schedule, which is where heavy work should go.
+'runs' counts the runs of the task, and 'overruns' counts the ticks at which 
+the task should have run while a scheduled run was still pending, or the runs
+of a direct task which lasted longer than its period. 'max_us' is the longest
+duration of a run in µs.
+"""
+class Task :
+  def __init__(self, name, callback, divider, scheduled, period_us) :
+    self.name = name
+    self.callback = callback
+    self.divider = divider
+    self.countdown = divider
+    self.scheduled = scheduled
+    self.period_us = period_us
+    self.pending = False
+    self.runs = 0
+    self.overruns = 0
+    self.max_us = 0
+    # Preallocate the bound method so that scheduling it does not allocate
+    self.run_ref = self.run
+
+  """
+  Run the task, measuring its duration.
+  """
+  def run(self, arg) :
+    start = time.ticks_us()
+    self.callback(arg)
+    duration = time.ticks_diff(time.ticks_us(), start)
+    self.pending = False
+    self.runs += 1
+    if duration > self.max_us :
+      self.max_us = duration
+    if not self.scheduled and duration > self.period_us :
+      self.overruns += 1
+
+"""
+Scheduler of periodic tasks at different rates on a single timer running at
+'freq' Hz. The rate of a task is converted into an integer divider of 'freq'.
+'handler' must be installed as the callback of the timer.
+The tasks may be paused: the ticks of the timer are then counted, and the
+tasks which are due during the pause run at the first tick after it.
+"""
+class Scheduler :
+  def __init__(self, freq) :
+    self.freq = freq
+    self.tasks = []
+    self.paused = False
+    self.missed = 0     # ticks of the timer during the pause
+
+  """
+  Add a task calling 'callback' 'rate' times per second. The callback is given
+  the argument of the timer callback. Returns the Task.
+  """
+  def add(self, name, callback, rate, scheduled=False) :
+    divider = max(1, self.freq // rate)
+    task = Task(name, callback, divider, scheduled, divider * 1000000 // self.freq)
+    self.tasks.append(task)
+    return task
+
+  """
+  Remove 'task', as returned by 'add'.
+  """
+  def remove(self, task) :
+    self.tasks = [t for t in self.tasks if t is not task]
+
+  """
+  Get the actual rate of a task in Hz, which may differ from the requested one
+  because of the integer divider.
+  """
+  def rate(self, task) :
+    return self.freq / task.divider
+
+  """
+  Pause the tasks until 'resume' is called. A scheduled run which is already
+  pending is not paused.
+  """
+  def pause(self) :
+    self.paused = True
+
+  """
+  Resume the tasks after 'pause'.
+  """
+  def resume(self) :
+    self.paused = False
+
+  """
+  Callback of the timer, which runs the tasks which are due.
+  """
+  def handler(self, tim) :
+    if self.paused :
+      self.missed += 1
+      return
+    ticks = 1 + self.missed
+    self.missed = 0
+    for task in self.tasks :
+      task.countdown -= ticks
+      if task.countdown > 0 :
+        continue
+      task.countdown = task.divider
+      if not task.scheduled :
+        task.run(tim)
+      elif task.pending :
+        task.overruns += 1
+      else :
+        task.pending = True
+        try :
+          micropython.schedule(task.run_ref, tim)
+        except RuntimeError :   # the queue of scheduled callbacks is full
+          task.pending = False
+          task.overruns += 1
+
+  """
+  Get the statistics of the tasks as a list of (name, rate, runs, overruns, max_us).
+  """
+  def stats(self) :
+    return [(t.name, self.rate(t), t.runs, t.overruns, t.max_us) for t in self.tasks]
+
+"""
+Motion profile for moving by 'distance' counts, with a peak speed of at most
+'vmax' counts per second and a peak acceleration of 'accel' counts per second
+per second. The profile is trapezoidal, or an S-curve (with smooth changes of
+the acceleration) if 'scurve' is True. 'rate' is the number of calls to 'step'
+per second.
+The profile is planned when it is created, and 'step' follows it with integer
+arithmetic only. Positions and speeds are in 1/4096 counts and counts per step.
+A profile for a distance of 0 is done at once. ValueError is raised if 'vmax'
+or 'accel' is not positive.
+"""
+class Profile :
+  def __init__(self, distance, vmax, accel, rate, scurve=False) :
+    self.distance = distance
+    self.rate = rate
+    self.k = 0      # current step
+    self.pos = 0    # current reference position
+    self.vel = 0    # current reference speed
+    if distance <= 0 :
+      self.ramp = array('i')
+      self.vtop = 0
+      self.ncruise = 0
+      self.vlast = 0
+      self.nramp = 0
+      self.nsteps = 0
+      return
+    if not (vmax > 0 and accel > 0) :
+      raise ValueError("The speed and the acceleration of a profile must be positive")
+    shape = 1.5 if scurve else 1.0   # peak acceleration / mean acceleration
+    vpeak = min(vmax, (distance * accel / shape) ** 0.5)
+    ramp = max(1, int(shape * vpeak / accel * rate + 0.999))
+    velocities = []
+    for k in range(ramp) :
+      u = (k + 1) / ramp
+      if scurve :
+        u = u * u * (3 - 2 * u)
+      velocities.append(max(1, int(vpeak * u / rate * 4096)))
+    excess = 2 * sum(velocities) / (distance << 12)
+    if excess > 1 :     # the ramps are too long because of the rounding of their duration
+      velocities = [max(1, int(v / excess)) for v in velocities]
+    self.ramp = array('i', velocities)   # speeds during the acceleration
+    self.vtop = velocities[-1]           # cruise speed
+    # Number of steps at cruise speed, the last one covering the remainder
+    cruise = (distance << 12) - 2 * sum(velocities)
+    self.ncruise = 0
+    self.vlast = 0
+    if cruise > 0 :
+      self.ncruise = cruise // self.vtop
+      self.vlast = cruise - self.ncruise * self.vtop
+      if self.vlast > 0 :
+        self.ncruise += 1
+      else :
+        self.vlast = self.vtop
+    self.nramp = ramp
+    self.nsteps = 2 * ramp + self.ncruise
+
+  """
+  Tell whether the profile is completed.
+  """
+  def done(self) :
+    return self.k >= self.nsteps
+
+  """
+  Advance the profile by one step and return the reference position in counts.
+  The reference speed in counts per second is then given by 'speed'.
+  """
+  def step(self) :
+    k = self.k
+    if k < self.nramp :
+      v = self.ramp[k]
+    elif k < self.nramp + self.ncruise - 1 :
+      v = self.vtop
+    elif k < self.nramp + self.ncruise :
+      v = self.vlast
+    elif k < self.nsteps :
+      v = self.ramp[self.nsteps - 1 - k]
+    else :
+      v = 0
+    self.k = k + 1
+    self.vel = v
+    self.pos += v
+    if self.pos > (self.distance << 12) or self.k == self.nsteps :
+      self.pos = self.distance << 12
+    return self.pos >> 12
+
+  """
+  Get the current reference speed in counts per second.
+  """
+  def speed(self) :
+    return (self.vel * self.rate) >> 12
+
+# Table of the sine on a full turn in 256 steps (plus one for interpolation), x16384
+_SINE = None
+
+"""
+Incremental odometry of a differential drive.
+'radius' is the radius of the wheels and 'track' the distance between them in mm,
+'cpr' is the number of encoder counts per turn of the wheels. 'lsign' and 'rsign'
+give the sign of the counts of each wheel when the platform moves forward.
+The position is kept in µm, and the heading in 1/2**24 of a turn, counterclockwise.
+'update' uses integer arithmetic only.
+"""
+class Odometry :
+  def __init__(self, radius=35, track=141, cpr=1440, lsign=1, rsign=1) :
+    global _SINE
+    if _SINE is None :
+      import math
+      _SINE = array('h', [int(16384 * math.sin(2 * math.pi * i / 256)) for i in range(257)])
+    self.lsign = lsign
+    self.rsign = rsign
+    um_per_count = 2 * 3.141592653589793 * radius * 1000 / cpr
+    self.kdist = int(um_per_count * 256)                 # µm per count, x256
+    # heading change per count of difference between the wheels, x256
+    self.kturn = int(um_per_count / (track * 1000) / (2 * 3.141592653589793) * (1 << 24) * 256)
+    self.reset()
+
+  """
+  Set the pose: 'x' and 'y' in mm, 'heading' in degrees.
+  """
+  def reset(self, x=0, y=0, heading=0) :
+    self.x = int(x * 1000)
+    self.y = int(y * 1000)
+    self.heading = int(heading * (1 << 24) / 360) & 0xffffff
+
+  """
+  Get the sine (x16384) of angle 'h' in 1/2**24 of a turn, with linear interpolation.
+  """
+  def sin(self, h) :
+    i = (h >> 16) & 0xff
+    frac = (h >> 8) & 0xff
+    s = _SINE[i]
+    return s + (((_SINE[i + 1] - s) * frac) >> 8)
+
+  """
+  Update the pose with the changes 'dleft' and 'dright' of the encoder counts.
+  """
+  def update(self, dleft, dright) :
+    dleft *= self.lsign
+    dright *= self.rsign
+    dist = ((dleft + dright) * self.kdist) >> 9          # distance in µm
+    dhead = ((dright - dleft) * self.kturn) >> 8
+    mid = (self.heading + (dhead >> 1)) & 0xffffff
+    self.x += (dist * self.sin(mid + 0x400000)) >> 14   # cos is sin a quarter turn later
+    self.y += (dist * self.sin(mid)) >> 14
+    self.heading = (self.heading + dhead) & 0xffffff
+
+  """
+  Get the pose as (x, y, heading), in mm and degrees.
+  """
+  def pose(self) :
+    return (self.x / 1000, self.y / 1000, self.heading * 360 / (1 << 24))
+
+# Fields of a motion segment in a SegmentQueue
+SEG_LCOUNTS = const(0)  # signed counts of the left wheel (360 per turn)
+SEG_RCOUNTS = const(1)  # signed counts of the right wheel
+SEG_LSPEED = const(2)   # signed cruise speed of the left wheel in impulses on A per second
+SEG_RSPEED = const(3)   # signed cruise speed of the right wheel
+SEG_MS = const(4)       # duration of the segment in ms, 0 to end it with the moves
+SEG_POWER = const(5)    # power at the start of the segment in percents
+SEG_SIZE = const(6)     # number of fields of a segment
+
+"""
+Bounded queue of motion segments, with room for 'capacity' segments.
+The segments are kept in a preallocated array, and 'pop' copies the oldest one
+into the 'current' array, so that segments can be taken from the queue in 
+interrupt handlers without allocating memory. The fields of a segment are 
+given by the SEG_* constants.
+The queue is not protected against concurrent accesses, the caller must mask 
+the interrupts when the handler which takes the segments may run.
+"""
+class SegmentQueue :
+  def __init__(self, capacity=16) :
+    self.capacity = capacity
+    self.data = array('i', [0] * (capacity * SEG_SIZE))
+    self.current = array('i', [0] * SEG_SIZE)   # last segment taken by 'pop'
+    self.head = 0     # index of the oldest segment
+    self.count = 0    # number of segments in the queue
+
+  def __len__(self) :
+    return self.count
+
+  """
+  Add a segment at the end of the queue. Return False if the queue is full.
+  """
+  def push(self, lcounts, rcounts, lspeed, rspeed, ms, power) :
+    if self.count >= self.capacity :
+      return False
+    base = ((self.head + self.count) % self.capacity) * SEG_SIZE
+    d = self.data
+    d[base + SEG_LCOUNTS] = lcounts
+    d[base + SEG_RCOUNTS] = rcounts
+    d[base + SEG_LSPEED] = lspeed
+    d[base + SEG_RSPEED] = rspeed
+    d[base + SEG_MS] = ms
+    d[base + SEG_POWER] = power
+    self.count += 1
+    return True
+
+  """
+  Copy the oldest segment into 'current' and remove it from the queue.
+  Return False if the queue is empty.
+  """
+  def pop(self) :
+    if self.count == 0 :
+      return False
+    base = self.head * SEG_SIZE
+    for i in range(SEG_SIZE) :
+      self.current[i] = self.data[base + i]
+    self.head = (self.head + 1) % self.capacity
+    self.count -= 1
+    return True
+
+  """
+  Remove all segments from the queue.
+  """
+  def flush(self) :
+    self.count = 0
+
+# Fields of a telemetry sample, as 16 bits signed integers
+TEL_TIME = const(0)     # time of the sample in ms, modulo 65536
+TEL_LPOS = const(1)     # position of the left wheel in quadrature counts, modulo 65536
+TEL_LSPEED = const(2)   # speed of the left wheel in impulses on A per second
+TEL_LDUTY = const(3)    # signed duty of the left motor, on 10 bits
+TEL_RPOS = const(4)     # position of the right wheel
+TEL_RSPEED = const(5)   # speed of the right wheel
+TEL_RDUTY = const(6)    # signed duty of the right motor
+TEL_SIZE = const(7)     # number of fields of a sample
+
+"""
+Convert 'value' to a 16 bits signed integer, modulo 65536.
+"""
+def int16(value) :
+  return ((value + 0x8000) & 0xffff) - 0x8000
+
+"""
+Ring buffer of 'capacity' telemetry samples of 'width' 16 bits signed integers.
+The samples are written in place by an interrupt handler with 'slot' and 
+'commit', and the oldest ones are overwritten when the ring is full. The
+handler calls 'skip' instead for a sample which it could not write.
+'drain' packs the pending samples into a preallocated frame: a little endian
+header with the number of samples and the number of samples lost (overwritten
+or skipped) since the last frame (both on 16 bits), followed by the samples, 
+oldest first. The ring is not protected against concurrent accesses, the 
+caller of 'drain' must keep the handler from writing samples during the drain,
+but the handler may call 'skip' then: 'lost' is only written by the handler,
+and 'reported' only by 'drain'.
+"""
+class TelemetryRing :
+  def __init__(self, capacity=128, width=TEL_SIZE) :
+    self.capacity = capacity
+    self.width = width
+    self.data = array('h', [0] * (capacity * width))
+    self.frame = bytearray(4 + 2 * capacity * width)
+    self.head = 0     # index of the next sample to write
+    self.count = 0    # number of pending samples
+    self.lost = 0     # number of samples lost, modulo 2**16
+    self.reported = 0 # value of 'lost' at the last drain
+
+  def __len__(self) :
+    return self.count
+
+  """
+  Get the index in 'data' of the first field of the next sample to write.
+  """
+  def slot(self) :
+    return self.head * self.width
+
+  """
+  Validate the sample written at 'slot'.
+  """
+  def commit(self) :
+    self.head = (self.head + 1) % self.capacity
+    if self.count < self.capacity :
+      self.count += 1
+    else :
+      self.lost = (self.lost + 1) & 0xffff
+
+  """
+  Count a sample which could not be written as lost.
+  """
+  def skip(self) :
+    self.lost = (self.lost + 1) & 0xffff
+
+  """
+  Pack the pending samples into the frame and return a memoryview of the used
+  part of the frame, which is valid until the next call.
+  """
+  def drain(self) :
+    n = self.count
+    start = (self.head - n) % self.capacity
+    end = start + n
+    w2 = 2 * self.width
+    lost = self.lost
+    struct.pack_into('<HH', self.frame, 0, n, (lost - self.reported) & 0xffff)
+    self.reported = lost
+    data = memoryview(self.data)
+    frame = self.frame
+    if end <= self.capacity :
+      frame[4:4 + n * w2] = data[start * self.width:end * self.width]
+    else :
+      first = self.capacity - start
+      frame[4:4 + first * w2] = data[start * self.width:]
+      frame[4 + first * w2:4 + n * w2] = data[:(end - self.capacity) * self.width]
+    self.count = 0
+    return memoryview(frame)[:4 + n * w2]
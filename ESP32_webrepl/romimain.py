@@ -14,6 +14,7 @@ import webrepl
 import sys
 from machine import Pin
 from romiesp32 import RomiPlatform
+from romicmd import CommandTable
 
 ## TTGO T7_V1.4 board
 # pinmap = {
@@ -68,28 +69,84 @@ def sendStatus() :
                                                 rm.get_rpms()
                             ))
 
+"""
+Send the state of the motion queue of the chassis to the connected client
+"""
+def sendQueueStatus() :
+  sys.stdout.write("QSTAT %d %d %d %d\n" % romp.queue_status())
+
+"""
+Handlers of the commands, called with the list of the parsed arguments
+"""
+def cmdLedOn(args, context) :
+  led.on()
+
+def cmdLedOff(args, context) :
+  led.off()
+
+def cmdStat(args, context) :
+  sendStatus()
+
+def cmdPose(args, context) :
+  sys.stdout.write("POSE %f %f %f\n" % romp.pose())
+
+def cmdQueue(args, context) :
+  power = 20 if args[5] is None else args[5]
+  if romp.queue_segment(args[0], args[1], args[2] or 0, args[3] or 0, args[4] or 0, power) :
+    sendQueueStatus()
+  else :
+    sys.stdout.write("QFULL\n")
+
+def cmdFlush(args, context) :
+  romp.flush_queue()
+  sendQueueStatus()
+
+def cmdQstat(args, context) :
+  sendQueueStatus()
+
+def cmdCmdstat(args, context) :
+  sys.stdout.write("CMDSTAT" + "".join([" %s %d %d %d" % stat for stat in commands.stats()]) + "\n")
+
+def cmdMove(args, context) :
+  romp.move(args[0], args[1])
+
+def cmdCruise(args, context) :
+  romp.cruise(args[0], args[1])
+
+def cmdStop(args, context) :
+  romp.stop()
+
+def cmdShutdown(args, context) :
+  romp.shutdown()
+
+def cmdUnknown(msg, context) :
+  print("Unknown command %s" % msg)
+
+# Table of the commands
+commands = CommandTable()
+commands.register("LED_ON", cmdLedOn)
+commands.register("LED_OFF", cmdLedOff)
+commands.register("STAT", cmdStat)
+commands.register("POSE", cmdPose)
+commands.register("QUEUE", cmdQueue, "ff|ffff")
+commands.register("FLUSH", cmdFlush)
+commands.register("QSTAT", cmdQstat)
+commands.register("CMDSTAT", cmdCmdstat)
+commands.register("MOVE", cmdMove, "ff")
+commands.register("CRUISE", cmdCruise, "ff")
+commands.register("STOP", cmdStop)
+commands.register("SHUTDOWN", cmdShutdown)
+commands.unknown = cmdUnknown
+
 """
 Process a command received from the client
 """
 def processCommand(msg) :
   print("WS RECV : %s" % msg)
-  args = msg.split()
-  if args[0] == "LED_ON" :
-    led.on()
-  elif args[0] == "LED_OFF" :
-    led.off()
-  elif args[0] == "STAT" :
-    sendStatus()
-  elif args[0] == "MOVE" :
-    romp.move(float(args[1]), float(args[2]))
-  elif args[0] == "CRUISE" :
-    romp.cruise(float(args[1]), float(args[2]))
-  elif args[0] == "STOP" :
-    romp.stop()
-  elif args[0] == "SHUTDOWN" :
-    romp.shutdown()
-  else :
-    print("Unknown command %s" % msg)
+  try :
+    commands.dispatch(msg)
+  except ValueError as err :    # missing or invalid arguments
+    sys.stdout.write("ERR %s\n" % err)
 
 """
 Start the web REPL and execute an infinite loop to process the requests of the client
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+############
+# bridgetest.py for CPython
+#
+# Test of the UART bridge of ClientServeurPyboardESP32/ESP32 (romibridge.py)
+# on a host. The serial link is a pseudo-terminal pair: the bridge runs with
+# the simulated uasyncio of romisim.py on one end, and a stand-in for the
+# Pyboard runs in a thread on the other end, with the frames of romilink.py.
+# The web sockets are simulated objects which record the texts sent to them.
+#
+# The stand-in answers "DONE <command>" to the requests, remembers its answers
+# by tag as romiserver.py does, and counts how many times each command is
+# executed. Some commands make it misbehave:
+#   - SLOW ... is answered only after the next GO, so that the answers come
+#     out of order,
+#   - DROP ... loses its first answer, CORRUPT ... corrupts it,
+#   - MUTE ... is lost before being executed, each time it is sent.
+# The test checks the start of the session and the negotiation of the baud
+# rate, that several requests are in flight and that each answer goes to the
+# web socket which made the request, that lost or corrupted answers are
+# requested again without executing the command twice, that requests without
+# answer time out, that untagged messages are pushed to all the web sockets,
+# and that STAT is answered from the cached status until another command is sent.
+#
+# Usage: python3 tools/bridgetest.py
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import asyncio
+import os
+import select
+import sys
+import threading
+import time
+import tty
+
+import romisim
+
+# Directory of the bridge
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ClientServeurPyboardESP32', 'ESP32')
+
+"""
+UART of MicroPython on the file descriptor 'fd' of a pseudo-terminal:
+'read' does not block and returns None when there is nothing to read.
+"""
+class PtyUart :
+  def __init__(self, fd) :
+    self.fd = fd
+    self.baudrate = 115200
+    os.set_blocking(fd, False)
+
+  def read(self, n=256) :
+    try :
+      data = os.read(self.fd, n)
+    except BlockingIOError :
+      return None
+    return data if data else None
+
+  def write(self, data) :
+    data = bytes(data)
+    while data :
+      try :
+        n = os.write(self.fd, data)
+      except BlockingIOError :
+        time.sleep(0.001)
+        continue
+      data = data[n:]
+    return len(data)
+
+  def init(self, baudrate=115200, **kwargs) :
+    self.baudrate = baudrate
+
+"""
+Writer which keeps the bytes written, to corrupt a frame before sending it.
+"""
+class Capture :
+  def __init__(self) :
+    self.data = b''
+
+  def write(self, data) :
+    self.data += bytes(data)
+
+"""
+Stand-in for the Pyboard on the file descriptor 'fd' of a pseudo-terminal.
+"""
+class StandInBoard (threading.Thread) :
+  def __init__(self, fd, romilink) :
+    super().__init__(daemon=True)
+    self.uart = PtyUart(fd)
+    self.romilink = romilink
+    self.link = romilink.FrameLink(self.uart)
+    self.answers = {}     # answers by tag, to answer repeated requests again
+    self.executed = {}    # number of executions of the commands
+    self.seen = {}        # number of receptions of the commands
+    self.held = []        # answers of the SLOW commands, sent after GO
+    self.failed = set()   # DROP and CORRUPT commands whose first answer was lost
+    self.sessions = 0     # number of HELLO
+    self.lock = threading.Lock()
+
+  def run(self) :
+    while True :
+      select.select([self.uart.fd], [], [], 0.1)
+      data = self.uart.read(256)
+      if data :
+        self.link.feed(data, self.received)
+
+  """
+  Send 'text' tagged by 'tag' in a frame, corrupted if 'corrupt' is True.
+  """
+  def send(self, tag, text, corrupt=False) :
+    message = ("%s %s" % (tag, text)).encode() if tag else text.encode()
+    if not corrupt :
+      self.link.send(message)
+      return
+    capture = Capture()
+    self.romilink.FrameLink(capture).send(message)
+    frame = bytearray(capture.data)
+    frame[len(frame) // 2] ^= 0x20    # not 0, the frame is only corrupted
+    self.uart.write(frame)
+
+  """
+  Push an untagged message to the bridge.
+  """
+  def push(self, text) :
+    with self.lock :
+      self.send(None, text)
+
+  def received(self, message) :
+    with self.lock :
+      tag, _, cmd = bytes(message).decode().partition(' ')
+      if tag == '#0' :
+        self.send(tag, self.control(cmd))
+        return
+      self.seen[cmd] = self.seen.get(cmd, 0) + 1
+      word = cmd.split()[0]
+      if word == 'MUTE' :
+        return
+      if tag in self.answers :      # the answer was lost, send it again
+        self.send(tag, self.answers[tag])
+        return
+      self.executed[cmd] = self.executed.get(cmd, 0) + 1
+      answer = "DONE " + cmd
+      self.answers[tag] = answer
+      if word == 'SLOW' :
+        self.held.append((tag, answer))
+        return
+      if word in ('DROP', 'CORRUPT') and cmd not in self.failed :
+        self.failed.add(cmd)
+        if word == 'CORRUPT' :
+          self.send(tag, answer, corrupt=True)
+        return
+      self.send(tag, answer)
+      if word == 'GO' :
+        for tag, answer in reversed(self.held) :
+          self.send(tag, answer)
+        self.held = []
+
+  """
+  Answer a control message of the link (tag #0).
+  """
+  def control(self, cmd) :
+    word, _, args = cmd.partition(' ')
+    if word == 'HELLO' :
+      self.answers = {}
+      self.sessions += 1
+      return cmd
+    if word == 'PING' :
+      return "PONG " + args
+    if word in ('BAUD', 'BAUDOK') :
+      return "OK"
+    if word == 'STAT' :
+      return "UPDATE 1 0 0.0 0 0.0 0 0"
+    return "NOK"
+
+"""
+Simulated web socket, which records the texts sent to it.
+"""
+class FakeSocket :
+  def __init__(self, name) :
+    self.name = name
+    self.texts = []
+    self.cond = threading.Condition()
+
+  def SendText(self, text) :
+    with self.cond :
+      self.texts.append(text)
+      self.cond.notify_all()
+
+  """
+  Wait until 'n' texts were received, or 'timeout' s. Return the texts.
+  """
+  def wait(self, n, timeout=3.0) :
+    with self.cond :
+      self.cond.wait_for(lambda : len(self.texts) >= n, timeout)
+      return list(self.texts)
+
+"""
+Results of the checks, printed as they are made.
+"""
+class Checks :
+  def __init__(self) :
+    self.failures = 0
+
+  def check(self, name, ok, detail='') :
+    print("%-50s %s%s" % (name, "ok" if ok else "FAILED", "" if ok else " " + str(detail)))
+    if not ok :
+      self.failures += 1
+
+"""
+Wait until 'cond' is True or for 'timeout' s. Return the value of 'cond'.
+"""
+def wait_until(cond, timeout=5.0) :
+  deadline = time.monotonic() + timeout
+  while not cond() and time.monotonic() < deadline :
+    time.sleep(0.01)
+  return cond()
+
+def main() :
+  parser = argparse.ArgumentParser(description="Test of the UART bridge on a pseudo-terminal pair")
+  parser.add_argument('--dir', default=BRIDGE_DIR, help="directory of romibridge.py")
+  parser.add_argument('--clients', type=int, default=8, help="number of concurrent web sockets")
+  args = parser.parse_args()
+
+  romisim.install_micropython()
+  romisim.install_uasyncio()
+  romisim.use_directory(args.dir)
+  import romibridge
+  import romilink
+
+  master, slave = os.openpty()
+  tty.setraw(slave)
+  tty.setraw(master)
+  board = StandInBoard(slave, romilink)
+  board.start()
+  bridge = romibridge.UartBridge(PtyUart(master), retry_ms=100, maxretries=2, poll_ms=0)
+  threading.Thread(target=lambda : asyncio.run(bridge.run()), daemon=True).start()
+  checks = Checks()
+
+  ok = wait_until(lambda : bridge.baudrate == romibridge.BAUDRATES[-1])
+  checks.check("session started with HELLO", board.sessions == 1, board.sessions)
+  checks.check("baud rate negotiated", ok, bridge.baudrate)
+
+  # Answers out of order, to the right web socket
+  slow1, slow2, go = FakeSocket('slow1'), FakeSocket('slow2'), FakeSocket('go')
+  for ws in (slow1, slow2, go) :
+    bridge.connect(ws)
+  bridge.request(slow1, "SLOW 1")
+  bridge.request(slow2, "SLOW 2")
+  wait_until(lambda : len(board.held) == 2)
+  bridge.request(go, "GO")
+  texts = (slow1.wait(1), slow2.wait(1), go.wait(1))
+  checks.check("answers out of order matched to their web socket",
+               texts == (["DONE SLOW 1"], ["DONE SLOW 2"], ["DONE GO"]), texts)
+
+  # Several web sockets with several requests in flight, at most maxpending
+  sockets = [FakeSocket('ws%d' % i) for i in range(args.clients)]
+  count = max(1, bridge.maxpending // args.clients)
+  def client(ws) :
+    for j in range(count) :
+      bridge.request(ws, "ECHO %s %d" % (ws.name, j))
+  threads = [threading.Thread(target=client, args=(ws,)) for ws in sockets]
+  for t in threads :
+    t.start()
+  for t in threads :
+    t.join()
+  ok = True
+  for ws in sockets :
+    texts = sorted(ws.wait(count))
+    if texts != ["DONE ECHO %s %d" % (ws.name, j) for j in range(count)] :
+      ok = False
+      detail = (ws.name, texts)
+  checks.check("%d web sockets, %d requests in flight" % (args.clients, count * args.clients),
+               ok, detail if not ok else '')
+
+  # Lost and corrupted answers
+  for word in ('DROP', 'CORRUPT') :
+    ws = FakeSocket(word)
+    retries = bridge.retries
+    bridge.request(ws, word + " 1")
+    texts = ws.wait(1)
+    checks.check("%s: answer requested again" % word,
+                 texts == ["DONE %s 1" % word] and bridge.retries > retries, (texts, bridge.retries))
+    checks.check("%s: command executed once" % word,
+                 board.executed.get(word + " 1") == 1, board.executed.get(word + " 1"))
+  checks.check("corrupted frame detected by the CRC", bridge.link.crc_errors >= 1, bridge.link.crc_errors)
+
+  # Request without answer
+  ws = FakeSocket('mute')
+  timeouts = bridge.timeouts
+  bridge.request(ws, "MUTE 1")
+  texts = ws.wait(1)
+  checks.check("request without answer times out",
+               texts == ["NOK Timeout"] and bridge.timeouts == timeouts + 1, texts)
+  checks.check("request without answer sent %d times" % (bridge.maxretries + 1),
+               board.seen.get("MUTE 1") == bridge.maxretries + 1, board.seen.get("MUTE 1"))
+
+  # Pushed messages
+  board.push("DONE")
+  ok = all([ws.wait(2)[-1] == "DONE" for ws in (slow1, slow2, go)])
+  checks.check("untagged message pushed to all the web sockets", ok)
+
+  # Status cache
+  board.push("UPDATE 1 2 3.0 4 5.0 6 7")
+  go.wait(len(go.texts) + 1)
+  ws = FakeSocket('stat')
+  bridge.request(ws, "STAT")
+  texts = ws.wait(1)
+  checks.check("STAT answered from the cached status",
+               texts == ["UPDATE 1 2 3.0 4 5.0 6 7"] and "STAT" not in board.seen, texts)
+  bridge.request(ws, "ECHO stat")
+  bridge.request(ws, "STAT")
+  texts = ws.wait(3)
+  checks.check("cached status dropped by another command",
+               board.seen.get("STAT") == 1 and "DONE STAT" in texts, (texts, board.seen.get("STAT")))
+
+  link = bridge.link
+  print("link: %d frames received, %d sent, %d CRC errors, bridge: %d retries, %d timeouts, %d orphans"
+        % (link.received, link.sent, link.crc_errors, bridge.retries, bridge.timeouts, bridge.orphans))
+  sys.exit(1 if checks.failures > 0 else 0)
+
+if __name__ == '__main__' :
+  main()
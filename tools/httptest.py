@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+############
+# httptest.py for CPython
+#
+# Test of the serving of the web page of ClientServeurPyboardESP32/ESP32 on a
+# host. The page is packaged by packwww.py in a temporary directory, and a
+# local stand-in HTTP server answers the requests of the page with the answers
+# of romipage.py, as romimain.py does on the ESP32. The test requests the page
+# as a browser would, and measures the bytes transferred (headers included):
+#   - without gzip: the raw page,
+#   - first load with gzip: the gzipped page, with its ETag,
+#   - reload with If-None-Match: 304 without body,
+#   - reload after a change of the page (another ETag): the gzipped page.
+# It checks the status codes, the headers, and that the gzipped page is the
+# minified page.
+#
+# Usage: python3 tools/httptest.py [--page ClientServeurPyboardESP32/ESP32/www/index.html]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import gzip
+import http.server
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+import packwww
+
+# Directory of the web server of the bridge
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ClientServeurPyboardESP32', 'ESP32')
+
+"""
+Stand-in HTTP server for the page 'path' (its gzipped version is 'path'.gz).
+"""
+class PageServer (http.server.ThreadingHTTPServer) :
+  def __init__(self, path, romipage) :
+    super().__init__(('127.0.0.1', 0), PageHandler)
+    self.path = path
+    self.romipage = romipage
+    self.page, self.etag = romipage.loadPage(path + '.gz')
+
+"""
+Handler of the requests of the stand-in server, which answers as _pageHandler
+in romimain.py.
+"""
+class PageHandler (http.server.BaseHTTPRequestHandler) :
+  def do_GET(self) :
+    if self.path not in ('/', '/index.html') :
+      self.send_error(404)
+      return
+    server = self.server
+    headers = {}
+    for name, value in self.headers.items() :
+      headers[name.lower()] = value
+    answer = server.romipage.pageAnswer(headers, server.etag)
+    if answer is None :
+      with open(server.path, 'rb') as f :
+        self.send_body(200, {}, f.read())
+    elif answer[0] == 304 :
+      self.send_body(304, answer[1], None)
+    else :
+      self.send_body(200, answer[1], server.page)
+
+  """
+  Send an answer with 'code', 'headers' and 'body' (None for no body).
+  """
+  def send_body(self, code, headers, body) :
+    self.send_response(code)
+    for name, value in headers.items() :
+      self.send_header(name, value)
+    if body is not None :
+      self.send_header('Content-Type', 'text/html; charset=UTF-8')
+      self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if body is not None :
+      self.wfile.write(body)
+
+  def log_message(self, format, *args) :
+    pass
+
+"""
+Request the page from the server at 'address' with the request 'headers',
+and return the status code, the headers (names in lower case), the body and
+the number of bytes of the answer.
+"""
+def get(address, headers) :
+  request = "GET / HTTP/1.0\r\nHost: %s:%d\r\n" % address
+  for name, value in headers.items() :
+    request += "%s: %s\r\n" % (name, value)
+  with socket.create_connection(address) as sock :
+    sock.sendall((request + "\r\n").encode())
+    data = b''
+    while True :
+      chunk = sock.recv(65536)
+      if not chunk :
+        break
+      data += chunk
+  head, _, body = data.partition(b"\r\n\r\n")
+  lines = head.decode('latin-1').split("\r\n")
+  fields = {}
+  for line in lines[1:] :
+    name, _, value = line.partition(':')
+    fields[name.strip().lower()] = value.strip()
+  return (int(lines[0].split()[1]), fields, body, len(data))
+
+"""
+Results of the checks, printed as they are made.
+"""
+class Checks :
+  def __init__(self) :
+    self.failures = 0
+
+  def check(self, name, ok, detail='') :
+    print("%-50s %s%s" % (name, "ok" if ok else "FAILED", "" if ok else " " + str(detail)))
+    if not ok :
+      self.failures += 1
+
+def main() :
+  parser = argparse.ArgumentParser(description="Bytes transferred for the page of the bridge")
+  parser.add_argument('--page', default=os.path.join(SERVER_DIR, 'www', 'index.html'), help="page to serve")
+  parser.add_argument('--dir', default=SERVER_DIR, help="directory of romipage.py")
+  args = parser.parse_args()
+
+  sys.path.insert(0, os.path.abspath(args.dir))
+  import romipage
+
+  tmp = tempfile.mkdtemp()
+  try :
+    path = os.path.join(tmp, 'index.html')
+    shutil.copy(args.page, path)
+    with open(path, encoding='utf-8') as f :
+      minified = packwww.minify(f.read()).encode('utf-8')
+    with open(path + '.gz', 'wb') as f :
+      f.write(packwww.compress(minified))
+    server = PageServer(path, romipage)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = server.server_address
+    checks = Checks()
+    sizes = {}
+
+    code, fields, body, sizes['raw'] = get(address, {})
+    with open(path, 'rb') as f :
+      checks.check("raw page without gzip", code == 200 and body == f.read(), code)
+    checks.check("raw page not gzipped", 'content-encoding' not in fields, fields)
+
+    code, fields, body, sizes['gzip'] = get(address, {'Accept-Encoding': 'gzip, deflate'})
+    etag = fields.get('etag')
+    checks.check("gzipped page", code == 200 and fields.get('content-encoding') == 'gzip', code)
+    checks.check("gzipped page is the minified page", gzip.decompress(body) == minified)
+    checks.check("ETag of the page is the one of packwww.py",
+                 etag == packwww.etag(packwww.compress(minified)), etag)
+    checks.check("cached for a long time", 'max-age=%d' % romipage.CACHE_MAX_AGE
+                                           in fields.get('cache-control', ''), fields)
+
+    code, fields, body, sizes['304'] = get(address, {'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    checks.check("reload answered by 304 without body", code == 304 and body == b'', code)
+    checks.check("304 keeps the ETag", fields.get('etag') == etag, fields)
+
+    code, fields, body, sizes['changed'] = get(address, {'Accept-Encoding': 'gzip',
+                                                         'If-None-Match': '"0123456789abcdef"'})
+    checks.check("reload of a changed page answered by 200", code == 200 and len(body) > 0, code)
+    server.shutdown()
+  finally :
+    shutil.rmtree(tmp)
+
+  print("bytes transferred: raw %d, gzipped %d (%.0f%%), 304 %d (%.1f%%)"
+        % (sizes['raw'], sizes['gzip'], 100.0 * sizes['gzip'] / sizes['raw'],
+           sizes['304'], 100.0 * sizes['304'] / sizes['raw']))
+  sys.exit(1 if checks.failures > 0 else 0)
+
+if __name__ == '__main__' :
+  main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+############
+# isrcheck.py for CPython and Micropython
+#
+# Check of the interrupt handlers of the encoders of RomiMotor (romiesp32.py):
+# the handlers are called for a number of simulated edges, in the normal mode
+# (enca_handler and encb_handler) and in quadrature mode (quad_handler), while
+# a target rotation is set so that target_check runs on every edge. The check
+# counts the memory allocated by the handlers and measures the time per edge.
+#
+# On the host, the real romiesp32.py is loaded with the simulated modules of
+# romisim.py. CPython allocates integer objects on its own, so the check counts
+# the memory blocks which are still allocated after the edges: it must be 0,
+# the state of the handlers lives in preallocated arrays. The time per edge
+# is the one of the interpreted code, and only useful to compare versions.
+#
+# On the board, copy this file and run it from the REPL:
+#   import isrcheck
+#   isrcheck.board_check()
+# enca_handler and encb_handler then run with the heap locked (micropython.heap_lock),
+# so that any allocation raises MemoryError, and the time per edge is the real
+# one. quad_handler reads the levels of the pins, so it is only checked on the host.
+#
+# Usage: python3 tools/isrcheck.py [--edges 20000] [--dir ESP32_microserver]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import sys
+import time
+
+"""
+Call the handlers of 'motor' for 'edges' edges of the encoder, as a wheel
+turning forward (B before A) with an edge every 'period_us' µs. 'advance' is
+called with the time between two edges to move the clock forward (None on the
+board, where the time goes by). In quadrature mode, the levels of the outputs
+are set before calling quad_handler, as the pins would.
+The target of the motor is set after the last edge so that target_check runs
+on every edge without stopping the motor. 'lock' is called just before the 
+first edge, once the handlers are bound.
+"""
+def run_edges(motor, edges, period_us=500, advance=None, lock=None) :
+  motor.rotate_counts(edges + 1000, 20)
+  enca = motor.enca
+  encb = motor.encb
+  if motor.quadrature :
+    handler = motor.quad_handler
+    # levels (A, B) of the outputs, B leading A
+    levels = ((0, 1), (1, 1), (1, 0), (0, 0))
+    if lock is not None :
+      lock()
+    for i in range(edges) :
+      a, b = levels[i & 3]
+      enca.level = a
+      encb.level = b
+      if advance is not None :
+        advance(period_us // 4)
+      handler(enca)
+  else :
+    ahandler = motor.enca_handler
+    bhandler = motor.encb_handler
+    if lock is not None :
+      lock()
+    for i in range(edges) :
+      if advance is not None :
+        advance(period_us // 2)
+      bhandler(encb)
+      if advance is not None :
+        advance(period_us // 2)
+      ahandler(enca)
+
+"""
+Check the handlers of a motor on the host. Return the number of memory blocks
+still allocated after the edges, and the time per edge in µs.
+"""
+def host_check(motor, edges, clock) :
+  import gc
+  import tracemalloc
+  clock_file = sys.modules[type(clock).__module__].__file__
+  run_edges(motor, 100, advance=clock.advance)    # warm up the caches of the interpreter
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  run_edges(motor, edges, advance=clock.advance)
+  gc.collect()
+  after = tracemalloc.take_snapshot()
+  tracemalloc.stop()
+  # Only the blocks allocated by the handlers and their callees, not by this
+  # check or by the simulation (the virtual clock is an integer object)
+  filters = [tracemalloc.Filter(False, f) for f in (__file__, tracemalloc.__file__, clock_file)]
+  stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'filename')
+  blocks = sum([s.count_diff for s in stats if s.count_diff > 0])
+  t0 = time.perf_counter()
+  run_edges(motor, edges, advance=clock.advance)
+  t1 = time.perf_counter()
+  if motor.quadrature :
+    calls = edges
+  else :
+    calls = 2 * edges   # one edge on A and one on B
+  return (blocks, (t1 - t0) * 1000000 / calls)
+
+"""
+Check enca_handler and encb_handler on the board, with the heap locked during
+the edges, and print the time per edge in µs. Return True if they do not allocate.
+"""
+def board_check(edges=2000) :
+  import micropython
+  from romiesp32 import RomiPlatform
+  platform = RomiPlatform()
+  motor = platform.leftmotor
+  run_edges(motor, 100)
+  start = [0]
+  def lock() :
+    start[0] = time.ticks_us()
+    micropython.heap_lock()
+  try :
+    run_edges(motor, edges, lock=lock)
+    t1 = time.ticks_us()
+  except MemoryError :
+    micropython.heap_unlock()
+    platform.stop()
+    print("the handlers allocate memory")
+    return False
+  micropython.heap_unlock()
+  platform.stop()
+  print("no allocation, %.1f us per edge" % (time.ticks_diff(t1, start[0]) / (2 * edges)))
+  return True
+
+def main() :
+  import argparse
+  import romisim
+  parser = argparse.ArgumentParser(description="Allocations and time per edge of the encoder handlers")
+  parser.add_argument('--edges', type=int, default=20000, help="number of edges per check")
+  parser.add_argument('--dir', default=romisim.SERVER_DIR, help="directory of romiesp32.py")
+  args = parser.parse_args()
+
+  romiesp32 = romisim.load_motor_module(args.dir)
+  romisim.CLOCK.set(0)
+  failed = False
+  for quadrature in (False, True) :
+    platform = romiesp32.RomiPlatform(quadrature=quadrature)
+    motor = platform.leftmotor
+    blocks, us = host_check(motor, args.edges, romisim.CLOCK)
+    print("quadrature=%-5s %6d edges: %3d blocks retained, %6.2f us per edge (host)"
+          % (quadrature, args.edges, blocks, us))
+    expected = args.edges // 4 if quadrature else args.edges   # rising edges of A
+    if motor.count_a != expected or motor.target_a == 0 :
+      print("    the handlers did not count the edges (count_a = %d)" % motor.count_a)
+      failed = True
+    failed = failed or blocks > 0
+  sys.exit(1 if failed else 0)
+
+if __name__ == '__main__' :
+  main()
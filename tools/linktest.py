@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+############
+# linktest.py for CPython
+#
+# Test of the link layer of ClientServeurPyboardESP32 (romilink.py) on a host.
+# The COBS encoding must round-trip for any data, in particular around the
+# blocks of 254 non zero bytes, whose code (0xFF) is not followed by a 0 when
+# decoding: runs of 253, 254 and 255 non zero bytes, followed or not by a 0
+# and by other bytes, and random data with many 0 bytes. The frames of
+# FrameLink must also give back the messages sent, whatever the chunks in
+# which their bytes are fed to the receiver.
+#
+# Usage: python3 tools/linktest.py [--dir ClientServeurPyboardESP32/Pyboard]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import os
+import random
+import sys
+
+# Directories of the copies of romilink.py
+LINK_DIRS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ClientServeurPyboardESP32', d)
+             for d in ('ESP32', 'Pyboard')]
+
+"""
+Writer which keeps the bytes written, as the UART of a FrameLink.
+"""
+class Capture :
+  def __init__(self) :
+    self.data = b''
+
+  def write(self, data) :
+    self.data += bytes(data)
+
+"""
+Results of the checks, printed as they are made.
+"""
+class Checks :
+  def __init__(self) :
+    self.failures = 0
+
+  def check(self, name, ok, detail='') :
+    print("%-50s %s%s" % (name, "ok" if ok else "FAILED", "" if ok else " " + str(detail)))
+    if not ok :
+      self.failures += 1
+
+"""
+Encode and decode 'data' with the COBS functions of 'romilink', and return
+the decoded data (None if it is not valid), and whether the encoded data has no 0.
+"""
+def roundtrip(romilink, data) :
+  n = len(data)
+  enc = bytearray(n + n // 254 + 1)
+  m = romilink.cobs_encode(bytearray(data), n, enc)
+  out = bytearray(n + 1)
+  k = romilink.cobs_decode(enc, m, out)
+  return (None if k is None else bytes(out[:k]), 0 not in enc[:m])
+
+"""
+Data around the blocks of 254 non zero bytes.
+"""
+def boundary_cases() :
+  cases = []
+  for run in (253, 254, 255, 508) :
+    for tail in (b'', b'\x00', b'\x00\x05', b'\x00\x00', b'\x05') :
+      cases.append(("%d x 0x01 + %s" % (run, tail.hex() or "nothing"), b'\x01' * run + tail))
+  return cases
+
+def main() :
+  parser = argparse.ArgumentParser(description="Test of the COBS frames of romilink.py")
+  parser.add_argument('--dir', action='append', help="directory of romilink.py (all the copies by default)")
+  parser.add_argument('--count', type=int, default=2000, help="number of random data")
+  parser.add_argument('--seed', type=int, default=0, help="seed of the random data")
+  args = parser.parse_args()
+
+  checks = Checks()
+  for directory in args.dir or LINK_DIRS :
+    sys.path.insert(0, os.path.abspath(directory))
+    sys.modules.pop('romilink', None)
+    import romilink
+    sys.path.pop(0)
+    print("%s:" % os.path.relpath(romilink.__file__))
+
+    for name, data in boundary_cases() :
+      decoded, nozero = roundtrip(romilink, data)
+      checks.check("round-trip of " + name, decoded == data and nozero, decoded)
+
+    rnd = random.Random(args.seed)
+    failed = None
+    for i in range(args.count) :
+      data = bytes([rnd.choice((0, 0, rnd.randrange(1, 256))) for j in range(rnd.randrange(0, 600))])
+      decoded, nozero = roundtrip(romilink, data)
+      if decoded != data or not nozero :
+        failed = data
+        break
+    checks.check("round-trip of %d random data" % args.count, failed is None, failed)
+
+    capture = Capture()
+    sender = romilink.FrameLink(capture)
+    messages = [b'\x01' * 254 + b'\x00\x05', b'', b'#1 STAT', bytes(range(256)) * 2]
+    for message in messages :
+      sender.send(message)
+    receiver = romilink.FrameLink(None)
+    received = []
+    data = capture.data
+    start = 0
+    while start < len(data) :
+      end = min(len(data), start + rnd.randrange(1, 64))
+      receiver.feed(data[start:end], lambda m : received.append(bytes(m)))
+      start = end
+    checks.check("frames received in chunks", received == messages and receiver.crc_errors == 0,
+                 (len(received), receiver.crc_errors))
+  sys.exit(1 if checks.failures > 0 else 0)
+
+if __name__ == '__main__' :
+  main()
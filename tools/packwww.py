@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+############
+# packwww.py for CPython
+#
+# Package a web page for the web servers on the ESP32: the page is minified
+# and gzipped into a single file (for instance www/index.html.gz), which the
+# server sends as is with "Content-Encoding: gzip".
+# The minification is conservative: it only removes HTML comments,
+# JavaScript comments on their own line, indentation and blank lines,
+# and leaves the content of <pre> and <textarea> untouched.
+#
+# Usage: python3 tools/packwww.py ClientServeurPyboardESP32/ESP32/www/index.html
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import gzip
+import hashlib
+import re
+
+_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_KEEP = re.compile(r'(<(pre|textarea)\b.*?</\2>)', re.DOTALL | re.IGNORECASE)
+
+"""
+Minify the lines of 'text', which are not in a <pre> or <textarea> element.
+"""
+def minify_lines(text) :
+  lines = []
+  for line in text.split('\n') :
+    line = line.strip()
+    if line == '' or line.startswith('//') :
+      continue
+    lines.append(line)
+  return '\n'.join(lines)
+
+"""
+Minify the HTML page 'text'.
+"""
+def minify(text) :
+  text = _COMMENT.sub('', text)
+  parts = _KEEP.split(text)
+  result = []
+  i = 0
+  while i < len(parts) :
+    result.append(minify_lines(parts[i]))
+    if i + 1 < len(parts) :
+      result.append(parts[i + 1])   # <pre> or <textarea> element, kept as is
+    i += 3
+  return ''.join(result)
+
+"""
+Gzip 'data' reproducibly (no file name and no time in the header),
+so that the same page always gives the same file and the same ETag.
+"""
+def compress(data) :
+  return gzip.compress(data, compresslevel=9, mtime=0)
+
+"""
+Get the ETag of the gzipped page 'data', as computed by the server.
+"""
+def etag(data) :
+  return '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+
+def main() :
+  parser = argparse.ArgumentParser(description="Minify and gzip a web page for the ESP32")
+  parser.add_argument('page', help="HTML page to package")
+  parser.add_argument('-o', '--output', help="gzipped page (default: page.gz)")
+  parser.add_argument('--no-minify', action='store_true', help="only gzip the page")
+  args = parser.parse_args()
+
+  with open(args.page, encoding='utf-8') as f :
+    text = f.read()
+  raw = text.encode('utf-8')
+  if not args.no_minify :
+    text = minify(text)
+  minified = text.encode('utf-8')
+  packed = compress(minified)
+  output = args.output or args.page + '.gz'
+  with open(output, 'wb') as f :
+    f.write(packed)
+  print("%s: %d bytes, minified %d bytes, gzipped %d bytes (%.0f%%)"
+        % (args.page, len(raw), len(minified), len(packed), 100.0 * len(packed) / len(raw)))
+  print("%s: ETag %s" % (output, etag(packed)))
+
+if __name__ == '__main__' :
+  main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+############
+# pidbench.py for CPython
+#
+# Benchmark of the cruise modes of RomiMotor (romiesp32.py): the stepwise
+# correction ('step') and the integer PID controller ('pid'). The real
+# romiesp32.py is loaded with the simulated modules of romisim.py, and drives
+# a simulated wheel: its speed follows the duty of the PWM with a first order
+# lag, above a dead band where the motor does not turn, and its encoder
+# generates the edges on B and A which call the interrupt handlers of the motor.
+# The shared timer of RomiMotor is fired every period on a virtual clock.
+#
+# For each mode and each target speed, the wheel starts at rest and cruises
+# for a given time. The benchmark reports the settle time (after which the
+# speed stays within a tolerance of the target), the overshoot, and the mean
+# error of the speed over the last second.
+#
+# Usage: python3 tools/pidbench.py [--rpm 1,2,4] [--duration 5] [--json results.json]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import json
+import random
+
+import romisim
+
+"""
+Simulated wheel driven by 'motor', a RomiMotor on simulated pins. The speed
+(in impulses on A per second) tends to 'gain' * (duty - 'deadband') with a
+time constant of 'tau' s, and the load adds a random relative 'noise' to it.
+"""
+class SimWheel :
+  def __init__(self, motor, gain=1.2, deadband=60, tau=0.08, noise=0.0, seed=0) :
+    self.motor = motor
+    self.gain = gain
+    self.deadband = deadband
+    self.tau = tau
+    self.noise = noise
+    self.rnd = random.Random(seed)
+    self.speed = 0.0      # in impulses on A per second
+    self.position = 0.0   # in impulses on A
+
+  """
+  Speed reached with the current duty of the motor.
+  """
+  def steady_speed(self) :
+    if self.motor.sleep.value() == 0 :
+      return 0.0
+    duty = self.motor.pwm.duty() - self.deadband
+    if duty <= 0 :
+      return 0.0
+    return self.gain * duty * (1 + self.rnd.uniform(-self.noise, self.noise))
+
+  """
+  Integrate the speed and the position for 'dt_us' µs of the virtual clock,
+  and generate the edges of the encoder (B just before A, as when turning forward).
+  """
+  def step(self, dt_us) :
+    dt = dt_us / 1000000.0
+    self.speed += (self.steady_speed() - self.speed) * min(1.0, dt / self.tau)
+    start = int(self.position)
+    self.position += self.speed * dt
+    edges = int(self.position) - start
+    if edges == 0 :
+      romisim.CLOCK.advance(dt_us)
+      return
+    # spread the edges over the step
+    for i in range(edges) :
+      romisim.CLOCK.advance(dt_us // edges - 10)
+      self.motor.encb.trigger()
+      romisim.CLOCK.advance(10)
+      self.motor.enca.trigger()
+    romisim.CLOCK.advance(dt_us - edges * (dt_us // edges))
+
+"""
+Run 'motor' in cruise 'mode' toward 'rpm' for 'duration' s, and return the
+speed of the wheel every ms, in impulses on A per second.
+"""
+def run_cruise(romiesp32, wheel, mode, rpm, duration, step_us=250) :
+  motor = wheel.motor
+  timer = romiesp32.RomiMotor.rpmtimer
+  period_us = timer.period * 1000
+  motor.stop()
+  motor.cruise_mode(mode)
+  motor.cruise(rpm)
+  speeds = []
+  elapsed = 0
+  next_tick = period_us
+  while elapsed < duration * 1000000 :
+    wheel.step(step_us)
+    elapsed += step_us
+    if elapsed >= next_tick :
+      timer.fire()
+      next_tick += period_us
+    if elapsed % 1000 == 0 :
+      speeds.append(wheel.speed)
+  return speeds
+
+"""
+Compute the settle time (ms, None if the speed does not settle), the overshoot
+(%) and the mean error over the last second (%) of the 'speeds' sampled every ms.
+"""
+def analyze(speeds, target, tolerance=0.05) :
+  settle = None
+  for i in range(len(speeds) - 1, -1, -1) :
+    if abs(speeds[i] - target) > tolerance * target :
+      break
+    settle = i + 1
+  overshoot = max(0.0, (max(speeds) - target) * 100.0 / target)
+  last = speeds[-1000:]
+  error = sum([abs(v - target) for v in last]) * 100.0 / (len(last) * target)
+  return (settle, overshoot, error)
+
+def main() :
+  parser = argparse.ArgumentParser(description="Settle time and overshoot of the cruise modes of RomiMotor")
+  parser.add_argument('--rpm', default='1,2,4,8', help="comma separated target speeds (RPMs of 'cruise')")
+  parser.add_argument('--modes', default='step,pid', help="comma separated cruise modes")
+  parser.add_argument('--duration', type=float, default=5.0, help="duration of each run in s")
+  parser.add_argument('--tolerance', type=float, default=5.0, help="settle tolerance in %% of the target")
+  parser.add_argument('--gain', type=float, default=1.2, help="speed of the wheel per unit of duty")
+  parser.add_argument('--deadband', type=int, default=60, help="duty under which the wheel does not turn")
+  parser.add_argument('--tau', type=float, default=0.08, help="time constant of the wheel in s")
+  parser.add_argument('--noise', type=float, default=0.02, help="relative noise of the load")
+  parser.add_argument('--dir', default=romisim.SERVER_DIR, help="directory of romiesp32.py")
+  parser.add_argument('--json', help="file where the results are written in JSON")
+  args = parser.parse_args()
+
+  romiesp32 = romisim.load_motor_module(args.dir)
+  romisim.CLOCK.set(0)
+  platform = romiesp32.RomiPlatform()
+  motor = platform.leftmotor
+  results = []
+  for mode in args.modes.split(',') :
+    for rpm in [float(r) for r in args.rpm.split(',')] :
+      wheel = SimWheel(motor, args.gain, args.deadband, args.tau, args.noise)
+      target = int(rpm * 60)
+      speeds = run_cruise(romiesp32, wheel, mode, rpm, args.duration)
+      settle, overshoot, error = analyze(speeds, target, args.tolerance / 100.0)
+      results.append({'mode': mode, 'rpm': rpm, 'settle_ms': settle,
+                      'overshoot_pct': overshoot, 'error_pct': error})
+      print("%-4s %5.1f RPM: settle %8s, overshoot %6.1f%%, mean error %5.1f%%"
+            % (mode, rpm, "%d ms" % settle if settle is not None else "never", overshoot, error))
+  if args.json :
+    with open(args.json, 'w') as f :
+      json.dump(results, f, indent=2)
+
+if __name__ == '__main__' :
+  main()
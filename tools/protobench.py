@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+############
+# protobench.py for CPython
+#
+# Benchmark of the text protocol and of the binary protocol (romiproto.py) of
+# the RomiServer of ESP32_microserver. The RomiServer of romimain.py is loaded
+# with the simulated modules of romisim.py, and the same requests are sent in
+# both protocols. The frames of the binary protocol are carried by text
+# messages in base64, as the websocket server of the board requires (see
+# romiproto.py). For each request, the benchmark reports:
+#   - the bytes of the request and of its answer, and the bytes on the wire
+#     with the websocket frame headers (the requests of a client are masked),
+#   - the time to parse the request (CommandTable.parse_batch for the text
+#     protocol, romiproto.decode_text and decode_request for the binary protocol),
+#   - the time to process the request and build its answer (process_request).
+# The times are the ones of CPython, only their ratio is meaningful for the board.
+#
+# Usage: python3 tools/protobench.py [--count 20000] [--json results.json]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import json
+import time
+
+import romisim
+
+# Address of the simulated client
+CLIENT = ('127.0.0.1', 50000)
+
+"""
+Get the requests of the benchmark as (name, text request, binary request).
+"""
+def requests(romiproto) :
+  enc = lambda op, *args : romiproto.encode_text(romiproto.encode_request(op, *args))
+  return [
+    ('STAT',   "STAT",                 enc(romiproto.OP_STAT)),
+    ('POSE',   "POSE",                 enc(romiproto.OP_POSE)),
+    ('QSTAT',  "QSTAT",                enc(romiproto.OP_QSTAT)),
+    ('MOVE',   "MOVE 1.25 -0.75",      enc(romiproto.OP_MOVE, 1.25, -0.75)),
+    ('CRUISE', "CRUISE 12.5 12.5",     enc(romiproto.OP_CRUISE, 12.5, 12.5)),
+    ('LTHROT', "LTHROT -35",           enc(romiproto.OP_LTHROT, -35)),
+    ('QUEUE',  "QUEUE 1.5 1.5 6 6 0 30", enc(romiproto.OP_QUEUE, 1.5, 1.5, 6, 6, 0, 30)),
+    ('STOP',   "STOP",                 enc(romiproto.OP_STOP))
+  ]
+
+"""
+Size of the header of a websocket frame of 'n' bytes, with the mask of the
+frames sent by a client if 'masked' is True.
+"""
+def ws_header(n, masked) :
+  size = 2
+  if n >= 0x10000 :
+    size += 8
+  elif n >= 126 :
+    size += 2
+  if masked :
+    size += 4
+  return size
+
+"""
+Mean time in µs of 'count' calls of 'function' with 'arg'.
+"""
+def timeit(function, arg, count) :
+  t0 = time.perf_counter()
+  for i in range(count) :
+    function(arg)
+  t1 = time.perf_counter()
+  return (t1 - t0) * 1000000 / count
+
+"""
+Measure the request 'name' in both protocols on 'server', and return the results.
+"""
+def measure(server, romiproto, name, text, binary, count) :
+  cmds = server._commands
+  result = {'request': name}
+  server.cmd_proto(["TEXT"], CLIENT)
+  answer = server.process_request(text, CLIENT)
+  answer = answer.encode() if isinstance(answer, str) else bytes(answer)
+  result['text'] = {
+    'request_bytes': len(text),
+    'answer_bytes': len(answer),
+    'wire_bytes': len(text) + ws_header(len(text), True) + len(answer) + ws_header(len(answer), False),
+    'parse_us': timeit(cmds.parse_batch, text, count),
+    'process_us': timeit(lambda m : server.process_request(m, CLIENT), text, count)
+  }
+  server.cmd_proto(["BIN"], CLIENT)
+  answer = server.process_request(binary, CLIENT)
+  if romiproto.decode_text(answer)[0] == romiproto.OP_ERROR :
+    raise ValueError("Binary request %s not processed" % name)
+  result['binary'] = {
+    'request_bytes': len(binary),
+    'answer_bytes': len(answer),
+    'wire_bytes': len(binary) + ws_header(len(binary), True) + len(answer) + ws_header(len(answer), False),
+    'parse_us': timeit(lambda m : romiproto.decode_request(romiproto.decode_text(m)), binary, count),
+    'process_us': timeit(lambda m : server.process_request(m, CLIENT), binary, count)
+  }
+  server.cmd_proto(["TEXT"], CLIENT)
+  server._romi.stop()
+  server._romi.flush_queue()
+  return result
+
+def main() :
+  parser = argparse.ArgumentParser(description="Bytes and parse time of the text and binary protocols")
+  parser.add_argument('--count', type=int, default=20000, help="number of requests per measure")
+  parser.add_argument('--dir', default=romisim.SERVER_DIR, help="directory of romimain.py")
+  parser.add_argument('--json', help="file where the results are written in JSON")
+  args = parser.parse_args()
+
+  server = romisim.load_server(args.dir)
+  import romiproto
+  results = []
+  print("%-7s %-6s %8s %8s %8s %10s %12s" % ("", "", "request", "answer", "wire", "parse", "process"))
+  for name, text, binary in requests(romiproto) :
+    result = measure(server, romiproto, name, text, binary, args.count)
+    results.append(result)
+    for proto in ('text', 'binary') :
+      r = result[proto]
+      print("%-7s %-6s %6d B %6d B %6d B %7.2f us %9.2f us"
+            % (name if proto == 'text' else "", proto, r['request_bytes'], r['answer_bytes'],
+               r['wire_bytes'], r['parse_us'], r['process_us']))
+  for key in ('wire_bytes', 'parse_us', 'process_us') :
+    text = sum([r['text'][key] for r in results])
+    binary = sum([r['binary'][key] for r in results])
+    print("binary / text %-10s: %.2f" % (key, binary / text))
+  if args.json :
+    with open(args.json, 'w') as f :
+      json.dump(results, f, indent=2)
+
+if __name__ == '__main__' :
+  main()
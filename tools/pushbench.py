@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+############
+# pushbench.py for CPython
+#
+# Benchmark of the pushed status updates of the RomiServer of ESP32_microserver
+# against the number of subscribed clients. The RomiServer of romimain.py is
+# loaded with the simulated modules of romisim.py, N simulated clients
+# subscribe to the updates, and the callback of the push timer is called
+# directly. The benchmark reports the time per tick of:
+#   - broadcast: push_handler, where the fields are read once per tick and
+#     the update is encoded once for all the clients,
+#   - delta: push_handler with all the clients in delta mode, where the
+#     update is encoded for each client,
+#   - per client: the status read and encoded for each client, as when
+#     each client polls the server with STAT.
+# The writes to the clients only count the bytes, so the times are the ones
+# of the server code (on CPython, only their ratio is meaningful for the board).
+#
+# Usage: python3 tools/pushbench.py [--clients 1,2,4,8,16] [--ticks 2000]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import json
+import time
+
+import romisim
+
+"""
+Simulated connection of a client, which counts the bytes written to it.
+"""
+class CountingWriter :
+  def __init__(self) :
+    self.bytes = 0
+    self.frames = 0
+
+  def write(self, data) :
+    self.bytes += len(data)
+    self.frames += 1
+
+"""
+Connect 'n' simulated clients to 'server', subscribed to all the fields of
+UPDATE at 'rate' Hz, in delta mode if 'delta' is True. Return their writers.
+"""
+def connect_clients(server, n, rate, delta) :
+  writers = []
+  for i in range(n) :
+    address = ('10.0.0.%d' % (i + 1), 40000 + i)
+    writer = CountingWriter()
+    server._clients.append(writer)
+    server._addresses[writer] = address
+    if delta :
+      server.cmd_deltamode([1000], address)
+    server.subscribe(address, rate, [])
+    writers.append(writer)
+  return writers
+
+"""
+Disconnect the clients of 'writers' from 'server'.
+"""
+def disconnect_clients(server, writers) :
+  for writer in writers :
+    server.close_handler(writer)
+
+"""
+Mean time in µs per tick of 'tick' over 'ticks' ticks. The wheels of the
+simulated platform cruise, so that the status changes at every tick.
+"""
+def time_ticks(server, tick, ticks) :
+  server._romi.cruise(30, -30)
+  t0 = time.perf_counter()
+  for i in range(ticks) :
+    tick()
+  t1 = time.perf_counter()
+  server._romi.stop()
+  return (t1 - t0) * 1000000 / ticks
+
+"""
+Measure the time per tick of the three ways of updating 'n' clients.
+"""
+def measure(server, n, ticks, rate) :
+  result = {'clients': n}
+  writers = connect_clients(server, n, rate, False)
+  result['broadcast_us'] = time_ticks(server, lambda : server.push_handler(None), ticks)
+  result['bytes_per_tick'] = sum([w.bytes for w in writers]) / ticks
+  disconnect_clients(server, writers)
+  writers = connect_clients(server, n, rate, True)
+  result['delta_us'] = time_ticks(server, lambda : server.push_handler(None), ticks)
+  disconnect_clients(server, writers)
+  writers = connect_clients(server, n, rate, False)
+  addresses = [server.getClientFromReader(w)[0] for w in writers]
+  def per_client() :
+    for address in addresses :
+      server.send_to(address, server.status(address).encode())
+  result['per_client_us'] = time_ticks(server, per_client, ticks)
+  disconnect_clients(server, writers)
+  return result
+
+def main() :
+  parser = argparse.ArgumentParser(description="CPU time per push tick against the number of clients")
+  parser.add_argument('--clients', default='1,2,4,8,16', help="comma separated numbers of clients")
+  parser.add_argument('--ticks', type=int, default=2000, help="number of ticks per measure")
+  parser.add_argument('--dir', default=romisim.SERVER_DIR, help="directory of romimain.py")
+  parser.add_argument('--json', help="file where the results are written in JSON")
+  args = parser.parse_args()
+
+  server = romisim.load_server(args.dir)
+  romisim.SimTimer.manual = True    # the push timer is not started, push_handler is called here
+  results = []
+  for n in [int(c) for c in args.clients.split(',')] :
+    # every client is due at each tick
+    result = measure(server, n, args.ticks, 1000 / server._min_push_ms)
+    results.append(result)
+    print("%3d clients: broadcast %8.1f us/tick, delta %8.1f us/tick, per client %8.1f us/tick, %7.0f B/tick"
+          % (n, result['broadcast_us'], result['delta_us'], result['per_client_us'], result['bytes_per_tick']))
+  if args.json :
+    with open(args.json, 'w') as f :
+      json.dump(results, f, indent=2)
+
+if __name__ == '__main__' :
+  main()
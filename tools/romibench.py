@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+############
+# romibench.py for CPython
+#
+# Latency and throughput benchmark of the text protocol of the Romi servers.
+# Workers send commands drawn from a weighted mix (STAT, MOVE, CRUISE, LTHROT...)
+# and wait for each answer before sending the next command. The benchmark
+# runs for each level of concurrency (number of workers), and reports the
+# median (p50) and 99th percentile (p99) of the round trip time and the
+# throughput; the highest throughput is the saturation throughput.
+#
+# Targets:
+#   --url ws://HOST:PORT      websocket server (one connection per worker),
+#                             with the webrepl password prompt unless --no-login
+#   --serial PORT             serial link (requires pyserial), either with one
+#                             command per line (--framing line, one worker only),
+#                             or with the tagged COBS frames of romilink.py
+#                             (--framing cobs), as the Pyboard of ClientServeurPyboardESP32
+#   no target                 a local stand-in server (see romisim.py)
+#
+# Usage: python3 tools/romibench.py --concurrency 1,4,16 --duration 5
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import wslite
+
+# Generators of the commands, by name
+COMMANDS = {
+  'STAT':    lambda rnd : "STAT",
+  'POSE':    lambda rnd : "POSE",
+  'QSTAT':   lambda rnd : "QSTAT",
+  'LED_ON':  lambda rnd : "LED_ON",
+  'LED_OFF': lambda rnd : "LED_OFF",
+  'STOP':    lambda rnd : "STOP",
+  'MOVE':    lambda rnd : "MOVE %.2f %.2f" % (rnd.uniform(-0.5, 0.5), rnd.uniform(-0.5, 0.5)),
+  'CRUISE':  lambda rnd : "CRUISE %.1f %.1f" % (rnd.uniform(-30, 30), rnd.uniform(-30, 30)),
+  'LTHROT':  lambda rnd : "LTHROT %d" % rnd.randint(-50, 50),
+  'RTHROT':  lambda rnd : "RTHROT %d" % rnd.randint(-50, 50),
+}
+
+DEFAULT_MIX = "STAT=40,MOVE=10,CRUISE=10,LTHROT=20,RTHROT=20"
+
+"""
+Parse a command mix such as "STAT=40,MOVE=10" into a list of (name, weight).
+"""
+def parse_mix(text) :
+  mix = []
+  for item in text.split(',') :
+    name, _, weight = item.partition('=')
+    name = name.strip().upper()
+    if name not in COMMANDS :
+      raise ValueError("Unknown command %s (known: %s)" % (name, ", ".join(sorted(COMMANDS))))
+    mix.append((name, float(weight) if weight else 1.0))
+  return mix
+
+"""
+Get the 'p' percentile (0 to 100) of the sorted list 'values' (nearest rank).
+"""
+def percentile(values, p) :
+  if len(values) == 0 :
+    return float('nan')
+  k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+  return values[k]
+
+"""
+Connection of a worker to a websocket server.
+"""
+class WsConnection :
+  def __init__(self, url, password, login=True, timeout=5.0) :
+    self.ws = wslite.connect(url, timeout)
+    if login :
+      while True :    # answer the password prompt, until the server is ready
+        message = self.ws.recv()
+        if message is None :
+          raise ConnectionError("Connection refused by the server")
+        if isinstance(message, str) and message.startswith("Password:") :
+          self.ws.send(password + "\n")
+        elif isinstance(message, str) and "WebREPL connected" in message :
+          break
+
+  """
+  Send command 'line' and return its answer (None if the connection is lost).
+  """
+  def request(self, line) :
+    self.ws.send(line + "\n")
+    return self.ws.recv()
+
+  def close(self) :
+    self.ws.close()
+
+"""
+Serial link to a board, shared by the workers. With framing 'line', the
+commands and the answers are lines of text, and only one command may be in
+flight. With framing 'cobs', they are frames of romilink.py, and the commands
+are tagged by a sequence number to match the answers.
+"""
+class SerialLink :
+  def __init__(self, port, baudrate=115200, framing='line', timeout=2.0) :
+    try :
+      import serial
+    except ImportError :
+      raise SystemExit("pyserial is required for --serial")
+    self.port = serial.Serial(port, baudrate, timeout=0.1)
+    self.framing = framing
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    if framing == 'cobs' :
+      sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      '..', 'ClientServeurPyboardESP32', 'Pyboard'))
+      from romilink import FrameLink
+      self.link = FrameLink(self.port)
+      self.seq = 0
+      self.waiting = {}     # [event, answer] of the commands in flight, by sequence number
+      threading.Thread(target=self.reader, daemon=True).start()
+      self.hello()
+
+  """
+  Start a new session with HELLO <nonce> (tag 0), so that the board forgets
+  the answers it remembers by tag from a previous session.
+  """
+  def hello(self) :
+    nonce = "%d" % random.getrandbits(24)
+    for i in range(3) :
+      entry = [threading.Event(), None]
+      with self.lock :
+        self.waiting[0] = entry
+        self.link.send(("#0 HELLO " + nonce).encode())
+      entry[0].wait(self.timeout)
+      if entry[1] is not None and entry[1].strip() == "HELLO " + nonce :
+        return
+    raise SystemExit("No answer to HELLO from the board")
+
+  """
+  Read the frames and give the tagged answers to the waiting workers.
+  """
+  def reader(self) :
+    while True :
+      data = self.port.read(256)
+      if data :
+        self.link.feed(data, self.received)
+
+  def received(self, message) :
+    text = bytes(message).decode(errors='replace')
+    if not text.startswith('#') :     # pushed message
+      return
+    tag, _, answer = text.partition(' ')
+    with self.lock :
+      entry = self.waiting.pop(int(tag[1:]), None)
+    if entry is not None :
+      entry[1] = answer
+      entry[0].set()
+
+  """
+  Send command 'line' and return its answer (None on timeout).
+  """
+  def request(self, line) :
+    if self.framing == 'line' :
+      with self.lock :
+        self.port.write((line + "\r\n").encode())
+        answer = self.port.readline()
+      return answer.decode(errors='replace') if answer else None
+    entry = [threading.Event(), None]
+    with self.lock :
+      self.seq = self.seq % 0xffff + 1
+      seq = self.seq
+      self.waiting[seq] = entry
+      self.link.send(("#%d %s" % (seq, line)).encode())
+    if not entry[0].wait(self.timeout) :
+      with self.lock :
+        self.waiting.pop(seq, None)
+    return entry[1]
+
+  def close(self) :
+    pass
+
+"""
+Worker which sends commands on 'conn' until 'stop', and records in 'samples'
+the (command, round trip time in s, success) of the commands answered after 'start'.
+"""
+def worker(conn, mix, rnd, start, stop, samples) :
+  names = [name for name, weight in mix]
+  weights = [weight for name, weight in mix]
+  while True :
+    name = rnd.choices(names, weights)[0]
+    line = COMMANDS[name](rnd)
+    t0 = time.perf_counter()
+    if t0 >= stop :
+      break
+    try :
+      answer = conn.request(line)
+    except OSError :
+      answer = None
+    t1 = time.perf_counter()
+    ok = answer is not None and not (isinstance(answer, str) and answer.startswith(("ERR", "NOK")))
+    if t0 >= start :
+      samples.append((name, t1 - t0, ok))
+    if answer is None and isinstance(conn, WsConnection) :
+      break       # the connection is lost
+
+"""
+Run the workers of one level of concurrency for 'duration' s after 'warmup' s,
+and return the statistics of the level.
+"""
+def run_level(connect, concurrency, mix, duration, warmup, seed) :
+  conns = [connect() for i in range(concurrency)]
+  now = time.perf_counter()
+  start = now + warmup
+  stop = start + duration
+  samples = []
+  threads = [threading.Thread(target=worker,
+                              args=(conns[i], mix, random.Random(seed + i), start, stop, samples))
+             for i in range(concurrency)]
+  for t in threads :
+    t.start()
+  for t in threads :
+    t.join()
+  for conn in conns :
+    conn.close()
+  return summarize(concurrency, duration, samples)
+
+"""
+Compute the statistics of the samples of a level, latencies in ms.
+"""
+def summarize(concurrency, duration, samples) :
+  latencies = sorted([dt * 1000 for name, dt, ok in samples])
+  result = {
+    'concurrency': concurrency,
+    'commands': len(samples),
+    'errors': len([s for s in samples if not s[2]]),
+    'throughput': len(samples) / duration,
+    'p50_ms': percentile(latencies, 50),
+    'p99_ms': percentile(latencies, 99),
+    'per_command': {}
+  }
+  for name in sorted(set([s[0] for s in samples])) :
+    values = sorted([dt * 1000 for n, dt, ok in samples if n == name])
+    result['per_command'][name] = {
+      'commands': len(values),
+      'p50_ms': percentile(values, 50),
+      'p99_ms': percentile(values, 99)
+    }
+  return result
+
+"""
+Print the statistics of a level.
+"""
+def report(result) :
+  print("concurrency %3d: %7d commands, %5d errors, %9.1f cmd/s, p50 %8.3f ms, p99 %8.3f ms"
+        % (result['concurrency'], result['commands'], result['errors'],
+           result['throughput'], result['p50_ms'], result['p99_ms']))
+  for name, stats in result['per_command'].items() :
+    print("    %-8s %7d commands, p50 %8.3f ms, p99 %8.3f ms"
+          % (name, stats['commands'], stats['p50_ms'], stats['p99_ms']))
+
+def main() :
+  parser = argparse.ArgumentParser(description="Benchmark of the text protocol of the Romi servers")
+  target = parser.add_mutually_exclusive_group()
+  target.add_argument('--url', help="websocket server, for instance ws://192.168.4.1:8080")
+  target.add_argument('--serial', help="serial port of the board")
+  parser.add_argument('--baud', type=int, default=115200, help="baud rate of the serial link")
+  parser.add_argument('--framing', choices=('line', 'cobs'), default='line',
+                      help="framing of the serial link")
+  parser.add_argument('--password', default='', help="password of the webrepl prompt")
+  parser.add_argument('--no-login', action='store_true', help="the server has no password prompt")
+  parser.add_argument('--concurrency', default='1,2,4,8',
+                      help="comma separated numbers of concurrent workers")
+  parser.add_argument('--duration', type=float, default=5.0, help="duration of each level in s")
+  parser.add_argument('--warmup', type=float, default=1.0, help="warmup before each level in s")
+  parser.add_argument('--mix', default=DEFAULT_MIX, help="weighted command mix")
+  parser.add_argument('--seed', type=int, default=0, help="seed of the random commands")
+  parser.add_argument('--json', help="file where the results are written in JSON")
+  args = parser.parse_args()
+
+  mix = parse_mix(args.mix)
+  levels = [int(c) for c in args.concurrency.split(',')]
+  if args.serial :
+    link = SerialLink(args.serial, args.baud, args.framing)
+    if args.framing == 'line' and max(levels) > 1 :
+      print("Only one command may be in flight with framing 'line', concurrency set to 1")
+      levels = [1]
+    connect = lambda : link
+  else :
+    url = args.url
+    login = not args.no_login
+    if url is None :
+      import romisim
+      standin = romisim.start(password=args.password)
+      url = "ws://%s:%d" % standin.server_address
+      login = True
+      print("Stand-in server at %s" % url)
+    connect = lambda : WsConnection(url, args.password, login)
+
+  results = []
+  for level in levels :
+    result = run_level(connect, level, mix, args.duration, args.warmup, args.seed)
+    report(result)
+    results.append(result)
+  best = max(results, key=lambda r : r['throughput'])
+  print("saturation throughput: %.1f cmd/s at concurrency %d" % (best['throughput'], best['concurrency']))
+  summary = {'mix': args.mix, 'levels': results,
+             'saturation': {'throughput': best['throughput'], 'concurrency': best['concurrency']}}
+  if args.json :
+    with open(args.json, 'w') as f :
+      json.dump(summary, f, indent=2)
+
+if __name__ == '__main__' :
+  main()
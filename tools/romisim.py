@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+############
+# romisim.py for CPython
+#
+# Simulation of the boards on a host, used by the host tools.
+#
+# It provides simulated versions of the modules which only exist in MicroPython
+# (micropython, machine, uasyncio and the ticks functions of time), so that the
+# modules of the boards can be loaded as they are under CPython:
+#   - load_motor_module loads romiesp32.py, to run the real RomiMotor on 
+#     simulated pins and timers, driven by a virtual clock (see CLOCK);
+#   - load_server loads ESP32_microserver/romimain.py with a simulated platform,
+#     so that the requests are processed by the same code as on the board.
+#
+# Run as a script, it is a stand-in for the websocket server of ESP32_microserver,
+# which follows the connection protocol of the server (webrepl password prompt).
+#
+# Usage: python3 tools/romisim.py [--port 8080] [--password PWD]
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import asyncio
+import builtins
+import contextlib
+import importlib
+import io
+import math
+import os
+import socketserver
+import sys
+import threading
+import time
+import types
+
+import wslite
+
+# Directory of the server which is simulated
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ESP32_microserver')
+
+# Lock of the simulated board: requests and timer callbacks run one at a time,
+# as on the board.
+LOCK = threading.RLock()
+
+_COUNTS_PER_TURN = 360        # impulses on A per turn of the wheel
+_WHEEL_MM = 220.0             # circumference of the wheels
+_TRACK_MM = 141.0             # distance between the wheels
+
+"""
+Simulated motor of the Romi chassis: the position is integrated from the
+speed, and moves end when they reach their target.
+"""
+class SimMotor :
+  def __init__(self) :
+    self.position = 0.0       # in impulses on A
+    self.rpm = 0.0
+    self.throttle = 0
+    self.target = None        # position at which the current move ends
+    self.last = time.monotonic()
+
+  """
+  Integrate the position up to now.
+  """
+  def update(self) :
+    now = time.monotonic()
+    self.position += self.rpm * _COUNTS_PER_TURN / 60.0 * (now - self.last)
+    self.last = now
+    if self.target is not None and (self.position - self.target) * self.rpm >= 0 :
+      self.position = self.target
+      self.target = None
+      self.rpm = 0.0
+
+  @property
+  def count_a(self) :
+    self.update()
+    return int(self.position)
+
+  def get_rpms(self) :
+    self.update()
+    return self.rpm
+
+  """
+  Speed in impulses on A per second, always non negative as on the board.
+  """
+  def speed(self) :
+    return int(abs(self.get_rpms()) * _COUNTS_PER_TURN / 60)
+
+  def getThrottle(self) :
+    return self.throttle
+
+  """
+  Turn by 'turns' turns at 60 RPM.
+  """
+  def move(self, turns) :
+    self.update()
+    self.throttle = 0
+    self.target = self.position + turns * _COUNTS_PER_TURN
+    self.rpm = math.copysign(60.0, turns) if turns != 0 else 0.0
+
+  def cruise(self, rpm) :
+    self.update()
+    self.throttle = 0
+    self.target = None
+    self.rpm = rpm
+
+  def set_throttle(self, throttle) :
+    self.update()
+    self.throttle = throttle
+    self.target = None
+    self.rpm = throttle * 1.5   # about 150 RPM at full throttle
+
+  def stop(self) :
+    self.cruise(0.0)
+
+"""
+Simulated RomiPlatform, with the methods used by RomiServer.
+"""
+class SimPlatform :
+  def __init__(self, pinmap=None, capacity=16) :
+    self.leftmotor = SimMotor()
+    self.rightmotor = SimMotor()
+    self.capacity = capacity
+    self.seg_done = 0
+    self.telemetry = False
+
+  def move(self, lturns, rturns) :
+    self.leftmotor.move(lturns)
+    self.rightmotor.move(rturns)
+
+  def cruise(self, lrpm, rrpm) :
+    self.leftmotor.cruise(lrpm)
+    self.rightmotor.cruise(rrpm)
+
+  def throttle(self, left, right) :
+    if left is not None :
+      self.leftmotor.set_throttle(left)
+    if right is not None :
+      self.rightmotor.set_throttle(right)
+
+  def stop(self) :
+    self.leftmotor.stop()
+    self.rightmotor.stop()
+
+  def shutdown(self) :
+    self.stop()
+
+  """
+  Pose computed from the positions of the wheels, as if the chassis had
+  turned before moving straight.
+  """
+  def pose(self) :
+    left = self.leftmotor.count_a * _WHEEL_MM / _COUNTS_PER_TURN
+    right = self.rightmotor.count_a * _WHEEL_MM / _COUNTS_PER_TURN
+    heading = (right - left) / _TRACK_MM
+    dist = (left + right) / 2
+    return (dist * math.cos(heading), dist * math.sin(heading), math.degrees(heading))
+
+  """
+  Segments are run at once, one after the other. The arguments are checked
+  as by RomiPlatform.
+  """
+  def queue_segment(self, lturns, rturns, lrpm=0, rrpm=0, ms=0, power=20) :
+    if lturns == 0 and rturns == 0 and ms <= 0 :
+      raise ValueError("A segment without move needs a duration")
+    self.move(lturns, rturns)
+    self.seg_done += 1
+    return True
+
+  def flush_queue(self) :
+    pass
+
+  """
+  The simulated platform has no periodic task.
+  """
+  def pause_tasks(self) :
+    pass
+
+  def resume_tasks(self) :
+    pass
+
+  def queue_status(self) :
+    return (0, self.capacity, 0, self.seg_done)
+
+  def start_telemetry(self, rate=100, capacity=128) :
+    self.telemetry = True
+    return float(rate)
+
+  def stop_telemetry(self) :
+    self.telemetry = False
+
+  """
+  Empty telemetry frame (no sample, none dropped).
+  """
+  def drain_telemetry(self) :
+    if not self.telemetry :
+      return None
+    return b'\x00\x00\x00\x00'
+
+"""
+Clock of the simulation, read by time.ticks_us and time.ticks_ms. It follows
+the clock of the host, unless it is made virtual by 'set', after which it 
+only changes through 'set' and 'advance'.
+"""
+class SimClock :
+  def __init__(self) :
+    self.virtual = None     # virtual time in µs
+
+  def us(self) :
+    if self.virtual is None :
+      return int(time.perf_counter() * 1000000)
+    return self.virtual
+
+  def set(self, us) :
+    self.virtual = int(us)
+
+  def advance(self, us) :
+    self.virtual = self.us() + int(us)
+
+CLOCK = SimClock()
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+# Callbacks given to micropython.schedule, run by run_scheduled
+SCHEDULED = []
+
+"""
+Run the callbacks given to micropython.schedule, as MicroPython does after
+an interrupt handler.
+"""
+def run_scheduled() :
+  while SCHEDULED :
+    callback, arg = SCHEDULED.pop(0)
+    callback(arg)
+
+"""
+Simulated Pin of the machine module. The handler installed by 'irq' is
+called by 'trigger'.
+"""
+class SimPin :
+  OUT = 1
+  IN = 0
+  OPEN_DRAIN = 2
+  PULL_UP = 1
+  PULL_DOWN = 2
+  IRQ_RISING = 1
+  IRQ_FALLING = 2
+
+  def __init__(self, pin, mode=None, pull=None, value=None, **kwargs) :
+    self.pin = pin
+    self.level = 0 if value is None else value
+    self.handler = None
+
+  def irq(self, trigger=None, handler=None, hard=False) :
+    self.handler = handler
+
+  """
+  Call the interrupt handler of the pin, then the scheduled callbacks.
+  """
+  def trigger(self) :
+    if self.handler is not None :
+      self.handler(self)
+    run_scheduled()
+
+  def on(self) :
+    self.level = 1
+
+  def off(self) :
+    self.level = 0
+
+  def value(self, level=None) :
+    if level is None :
+      return self.level
+    self.level = 1 if level else 0
+
+"""
+Simulated PWM of the machine module, which records the duty.
+"""
+class SimPWM :
+  def __init__(self, pin, freq=1000, duty=0) :
+    self.pin = pin
+    self._freq = freq
+    self._duty = duty
+
+  def duty(self, value=None) :
+    if value is None :
+      return self._duty
+    self._duty = max(0, min(1023, int(value)))
+
+  def freq(self, value=None) :
+    if value is None :
+      return self._freq
+    self._freq = value
+
+"""
+Simulated Timer of the machine module: the callback is called in a thread,
+with the lock of the board. When 'manual' is True, the timers only record
+their callback and period, and the simulation calls 'fire' itself.
+"""
+class SimTimer :
+  PERIODIC = 1
+  ONE_SHOT = 0
+  manual = False
+  instances = []      # timers created in manual mode
+
+  def __init__(self, id=-1) :
+    self.stopped = None
+    self.callback = None
+    self.period = None
+
+  def init(self, period=1000, mode=PERIODIC, callback=None, freq=None) :
+    self.deinit()
+    if freq is not None :
+      period = 1000 // freq
+    self.callback = callback
+    self.period = period
+    if SimTimer.manual :
+      SimTimer.instances.append(self)
+      return
+    stopped = threading.Event()
+    self.stopped = stopped
+    def run() :
+      while not stopped.wait(period / 1000.0) :
+        with LOCK :
+          if not stopped.is_set() :
+            callback(self)
+        if mode != SimTimer.PERIODIC :
+          break
+    threading.Thread(target=run, daemon=True).start()
+
+  def deinit(self) :
+    if self.stopped is not None :
+      self.stopped.set()
+      self.stopped = None
+
+  """
+  Call the callback of the timer, then the scheduled callbacks.
+  """
+  def fire(self) :
+    if self.callback is not None :
+      self.callback(self)
+    run_scheduled()
+
+"""
+Simulated base class of wsserver. The stand-in server registers the clients
+in '_clients' and '_addresses' itself.
+"""
+class SimWebSocketServer :
+  def __init__(self, port=8080, address="0.0.0.0", password='') :
+    self.port = port
+    self._clients = []
+    self._addresses = {}
+
+  def start(self) :
+    return "ws://localhost:%d" % self.port
+
+  def do_accept(self, address) :
+    return True
+
+  def getClientFromReader(self, reader) :
+    return (self._addresses.get(reader), reader)
+
+  def close_handler(self, reader) :
+    if reader in self._clients :
+      self._clients.remove(reader)
+    self._addresses.pop(reader, None)
+
+"""
+Simulated HttpServer of httpserver.
+"""
+class SimHttpServer :
+  def start(self) :
+    return "http://localhost"
+
+"""
+Install the ticks functions of MicroPython in the time module, and the
+micropython module, for code compiled by the viper emitter. Viper pointers
+are the arrays themselves.
+"""
+def install_micropython() :
+  time.ticks_us = lambda : CLOCK.us() & _TICKS_MAX
+  time.ticks_ms = lambda : (CLOCK.us() // 1000) & _TICKS_MAX
+  time.ticks_diff = lambda a, b : ((a - b + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+  time.ticks_add = lambda a, b : (a + b) & _TICKS_MAX
+  time.sleep_ms = lambda ms : time.sleep(ms / 1000.0)
+  time.sleep_us = lambda us : time.sleep(us / 1000000.0)
+  micropython = types.ModuleType('micropython')
+  micropython.const = lambda value : value
+  micropython.viper = lambda f : f
+  micropython.native = lambda f : f
+  micropython.schedule = lambda callback, arg : SCHEDULED.append((callback, arg))
+  micropython.alloc_emergency_exception_buf = lambda size : None
+  micropython.heap_lock = lambda : None
+  micropython.heap_unlock = lambda : 0
+  sys.modules['micropython'] = micropython
+  builtins.ptr32 = lambda buf : buf
+  builtins.ptr16 = lambda buf : buf
+  builtins.ptr8 = lambda buf : buf
+
+"""
+Install the simulated machine module.
+"""
+def install_machine() :
+  machine = types.ModuleType('machine')
+  machine.Pin = SimPin
+  machine.PWM = SimPWM
+  machine.Timer = SimTimer
+  machine.disable_irq = lambda : 0
+  machine.enable_irq = lambda state : None
+  machine.idle = lambda : None
+  sys.modules['machine'] = machine
+
+"""
+Flag of uasyncio which may be set from another thread or an interrupt handler.
+"""
+class SimThreadSafeFlag :
+  def __init__(self) :
+    self.loop = None
+    self.event = None
+    self.pending = False
+
+  def set(self) :
+    if self.loop is None :
+      self.pending = True
+    else :
+      self.loop.call_soon_threadsafe(self.event.set)
+
+  async def wait(self) :
+    if self.loop is None :
+      self.loop = asyncio.get_running_loop()
+      self.event = asyncio.Event()
+      if self.pending :
+        self.event.set()
+    await self.event.wait()
+    self.event.clear()
+
+"""
+StreamReader of uasyncio on an object with a non blocking 'read' method,
+such as a UART of MicroPython: the stream is polled every millisecond.
+"""
+class SimStreamReader :
+  def __init__(self, stream) :
+    self.stream = stream
+
+  async def read(self, n) :
+    while True :
+      data = self.stream.read(n)
+      if data :
+        return data
+      await asyncio.sleep(0.001)
+
+"""
+Install a uasyncio module built on asyncio.
+"""
+def install_uasyncio() :
+  uasyncio = types.ModuleType('uasyncio')
+  uasyncio.sleep = asyncio.sleep
+  uasyncio.sleep_ms = lambda ms : asyncio.sleep(ms / 1000.0)
+  uasyncio.create_task = asyncio.create_task
+  uasyncio.run = asyncio.run
+  uasyncio.Event = asyncio.Event
+  uasyncio.TimeoutError = asyncio.TimeoutError
+  uasyncio.ThreadSafeFlag = SimThreadSafeFlag
+  uasyncio.StreamReader = SimStreamReader
+  async def wait_for_ms(aw, ms) :
+    return await asyncio.wait_for(aw, ms / 1000.0)
+  uasyncio.wait_for_ms = wait_for_ms
+  sys.modules['uasyncio'] = uasyncio
+
+"""
+Add 'directory' at the start of the module path.
+"""
+def use_directory(directory) :
+  directory = os.path.abspath(directory)
+  if directory not in sys.path :
+    sys.path.insert(0, directory)
+
+"""
+Load romiesp32 from 'directory' on simulated pins, with the timers in manual
+mode: the simulation calls RomiMotor.rpmtimer.fire() itself.
+"""
+def load_motor_module(directory=SERVER_DIR) :
+  install_micropython()
+  install_machine()
+  SimTimer.manual = True
+  sys.modules.pop('romiesp32', None)
+  use_directory(directory)
+  return importlib.import_module('romiesp32')
+
+"""
+Install the simulated modules of the board used by romimain, with SimPlatform
+as the RomiPlatform of romiesp32.
+"""
+def install_modules() :
+  install_micropython()
+  install_machine()
+  romiesp32 = types.ModuleType('romiesp32')
+  romiesp32.RomiPlatform = SimPlatform
+  sys.modules['romiesp32'] = romiesp32
+  wsserver = types.ModuleType('wsserver')
+  wsserver.WebSocketServer = SimWebSocketServer
+  sys.modules['wsserver'] = wsserver
+  httpserver = types.ModuleType('httpserver')
+  httpserver.HttpServer = SimHttpServer
+  sys.modules['httpserver'] = httpserver
+
+"""
+Load romimain from 'directory' with the simulated modules, and return its
+RomiServer, which drives a SimPlatform.
+"""
+def load_server(directory=SERVER_DIR) :
+  install_modules()
+  use_directory(directory)
+  with contextlib.redirect_stdout(io.StringIO()) :   # messages of the startup of the board
+    romimain = importlib.import_module('romimain')
+  return romimain.wsrv
+
+"""
+Writer of the answers and of the pushed updates to a client, for RomiServer.send_to.
+They are sent in text frames, as by the websocket of MicroPython, so bytes
+must be valid UTF-8, as for a browser.
+"""
+class ClientWriter :
+  def __init__(self, ws) :
+    self.ws = ws
+
+  def write(self, data) :
+    if not isinstance(data, str) :
+      data = bytes(data).decode()
+    self.ws.send(data)
+
+"""
+Websocket server which gives the requests of its clients to 'server' (a
+RomiServer) after the password prompt, and sends back the answers. As on the
+board, only the text messages are given to 'server' (webrepl uses the binary
+frames for transferring files), and the answers are sent in text frames.
+"""
+class StandIn(socketserver.ThreadingTCPServer) :
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, server, host='127.0.0.1', port=8080, password='') :
+    self.romi_server = server
+    self.password = password
+    super().__init__((host, port), StandInHandler)
+
+  """
+  Serve the websocket client 'ws' at 'address'.
+  """
+  def serve_client(self, ws, address) :
+    ws.send("Password: ")
+    password = ws.recv()
+    if password is None :
+      return
+    if password.strip() != self.password :
+      ws.send("\r\nAccess denied\r\n")
+      return
+    ws.send("\r\nWebREPL connected\r\n>>> ")
+    server = self.romi_server
+    writer = ClientWriter(ws)
+    with LOCK :
+      handler = server.do_accept(address)
+      server._clients.append(writer)
+      server._addresses[writer] = address
+    try :
+      while True :
+        message = ws.recv()
+        if message is None :
+          break
+        if not isinstance(message, str) :   # binary frame, not for RomiServer
+          continue
+        with LOCK :
+          answer = handler(message)
+          if answer :
+            writer.write(answer)
+    finally :
+      with LOCK :
+        server.close_handler(writer)
+
+"""
+Handler of the connections of the stand-in server.
+"""
+class StandInHandler(socketserver.BaseRequestHandler) :
+  def handle(self) :
+    try :
+      ws = wslite.accept(self.request)
+    except ConnectionError :
+      return
+    try :
+      self.server.serve_client(ws, self.client_address)
+    except OSError :
+      pass
+    finally :
+      ws.close()
+
+"""
+Start a stand-in server in a thread, and return it. Its address is 'server_address'.
+"""
+def start(host='127.0.0.1', port=0, password='') :
+  standin = StandIn(load_server(), host, port, password)
+  threading.Thread(target=standin.serve_forever, daemon=True).start()
+  return standin
+
+def main() :
+  parser = argparse.ArgumentParser(description="Simulated Romi websocket server")
+  parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+  parser.add_argument('--port', type=int, default=8080, help="port to listen on")
+  parser.add_argument('--password', default='', help="password of the webrepl prompt")
+  args = parser.parse_args()
+  standin = StandIn(load_server(), args.host, args.port, args.password)
+  print("Web socket URL: ws://%s:%d" % standin.server_address)
+  try :
+    standin.serve_forever()
+  except KeyboardInterrupt :
+    pass
+
+if __name__ == '__main__' :
+  main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+############
+# servertest.py for CPython
+#
+# Test of the answers of the RomiServer of ESP32_microserver (romimain.py) on
+# a host. The RomiServer is loaded with the simulated modules of romisim.py,
+# and the requests are given to process_request as by the websocket server.
+# The test checks that a command with missing or invalid arguments is answered
+# by ERR, alone or in a batch, and that the server keeps answering after it,
+# in particular for SUBSCRIBE.
+# It also checks that the status seen by a client in delta mode, which gets
+# DELTA frames both in the answers to its requests and in the pushed updates,
+# stays the status of the platform when the two are interleaved, and that the
+# frames of the binary protocol and the telemetry frames are carried by text
+# messages.
+#
+# Usage: python3 tools/servertest.py
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import argparse
+import binascii
+import sys
+
+import romisim
+
+# Address of the simulated client
+CLIENT = ('127.0.0.1', 50000)
+
+# Requests with missing or invalid arguments
+BAD_REQUESTS = ["MOVE 1", "MOVE a b", "TELEM", "PROTO", "QUEUE 0 0", "CRUISE 1 x"]
+
+# Subscriptions without rate, with an invalid rate or field
+BAD_SUBSCRIPTIONS = ["SUBSCRIBE", "SUBSCRIBE abc", "SUBSCRIBE 0", "SUBSCRIBE -5", "SUBSCRIBE 10 FOO"]
+
+"""
+Simulated connection of a client, which keeps the frames pushed to it.
+"""
+class FrameWriter :
+  def __init__(self) :
+    self.frames = []
+
+  def write(self, data) :
+    self.frames.append(bytes(data).decode() if not isinstance(data, str) else data)
+
+"""
+Status shown by the page of a client, updated by the UPDATE and DELTA frames.
+"""
+class PageStatus :
+  def __init__(self) :
+    self.fields = None
+
+  def apply(self, frame) :
+    words = frame.split()
+    if words[0] == "UPDATE" :
+      self.fields = words[1:]
+    elif words[0] == "DELTA" :
+      for k in range(1, len(words), 2) :
+        self.fields[int(words[k])] = words[k + 1]
+
+"""
+Results of the checks, printed as they are made.
+"""
+class Checks :
+  def __init__(self) :
+    self.failures = 0
+
+  def check(self, name, ok, detail='') :
+    print("%-50s %s%s" % (name, "ok" if ok else "FAILED", "" if ok else " " + str(detail)))
+    if not ok :
+      self.failures += 1
+
+"""
+Answer of 'server' to 'request' from 'client', or the exception it raised.
+"""
+def answer(server, request, client=CLIENT) :
+  try :
+    return server.process_request(request, client)
+  except Exception as err :
+    return err
+
+"""
+Check that each of 'requests' is answered by ERR, alone and in a batch.
+"""
+def check_errors(checks, server, requests) :
+  for request in requests :
+    text = answer(server, request)
+    checks.check("%s answered by ERR" % request,
+                 isinstance(text, str) and text.startswith("ERR "), repr(text))
+    text = answer(server, "STAT;" + request)
+    checks.check("%s in a batch answered by ERR" % request,
+                 isinstance(text, str) and text.startswith("ERR "), repr(text))
+  text = answer(server, "STAT")
+  checks.check("STAT answered after the errors",
+               isinstance(text, str) and text.startswith("UPDATE "), repr(text))
+
+"""
+Check that the status of the page of a client in delta mode stays right when
+the answers to its requests and the pushed updates are interleaved, while
+another client changes the throttle between them.
+"""
+def check_delta_interleaving(checks, server) :
+  other = ('127.0.0.1', 50001)
+  writer = FrameWriter()
+  server._clients.append(writer)
+  server._addresses[writer] = CLIENT
+  page = PageStatus()
+  page.apply(answer(server, "STAT"))    # full status before delta mode
+  answer(server, "DELTAMODE 1000")
+  server.subscribe(CLIENT, 1000 / server._min_push_ms, [])
+  steps = ["push", "LTHROT 50", "other LTHROT 0", "push", "RTHROT -20", "push",
+           "other RTHROT 0", "STAT", "push", "other LTHROT 30", "push"]
+  ok = True
+  for step in steps :
+    if step == "push" :
+      del writer.frames[:]
+      server.push_handler(None)
+      frames = writer.frames
+    elif step.startswith("other ") :
+      answer(server, step[6:], other)
+      continue
+    else :
+      frames = [answer(server, step)]
+    for frame in frames :
+      page.apply(frame)
+    expected = server.status(other).split()[1:]
+    if page.fields != expected :
+      ok = False
+      detail = (step, page.fields, expected)
+  checks.check("status of a client in delta mode with pushes", ok, detail if not ok else '')
+  server.unsubscribe(CLIENT)
+  answer(server, "DELTAMODE 0")
+  server.close_handler(writer)
+
+"""
+Check that the requests of the binary protocol, carried by text messages,
+are answered by text messages which carry the answer frames.
+"""
+def check_binary(checks, server) :
+  import romiproto
+  stat = romiproto.encode_text(romiproto.encode_request(romiproto.OP_STAT))
+  text = answer(server, stat)
+  checks.check("binary request before PROTO BIN answered by an error",
+               isinstance(text, str) and romiproto.decode_text(text)[0] == romiproto.OP_ERROR, repr(text))
+  answer(server, "PROTO BIN")
+  text = answer(server, stat)
+  checks.check("binary STAT answered by a text message",
+               isinstance(text, str) and romiproto.decode_text(text)[0] == romiproto.OP_UPDATE, repr(text))
+  text = answer(server, "!not base64")
+  checks.check("invalid text message answered by an error",
+               isinstance(text, str) and romiproto.decode_text(text)[0] == romiproto.OP_ERROR, repr(text))
+  text = answer(server, "STAT")
+  checks.check("text request in binary mode answered by UPDATE",
+               isinstance(text, str) and text.startswith("UPDATE "), repr(text))
+  answer(server, "PROTO TEXT")
+
+"""
+Check that the telemetry frame is answered by DRAIN in base64.
+"""
+def check_drain(checks, server) :
+  answer(server, "TELEM 50")
+  text = answer(server, "DRAIN")
+  ok = isinstance(text, str) and text.startswith("DRAIN ")
+  if ok :
+    frame = binascii.a2b_base64(text[6:])
+    ok = len(frame) >= 4 and (len(frame) - 4) % 14 == 0
+  checks.check("DRAIN answered by the frame in base64", ok, repr(text))
+  answer(server, "TELEM 0")
+  text = answer(server, "DRAIN")
+  checks.check("DRAIN without telemetry answered by TELEM 0 0", text == "TELEM 0 0\n", repr(text))
+
+def main() :
+  parser = argparse.ArgumentParser(description="Test of the answers of RomiServer")
+  parser.add_argument('--dir', default=romisim.SERVER_DIR, help="directory of romimain.py")
+  args = parser.parse_args()
+
+  server = romisim.load_server(args.dir)
+  romisim.SimTimer.manual = True    # the push timer is not started, push_handler is called here
+  checks = Checks()
+  check_errors(checks, server, BAD_REQUESTS)
+  check_errors(checks, server, BAD_SUBSCRIPTIONS)
+  checks.check("no subscription made by the errors", len(server._subscriptions) == 0,
+               server._subscriptions)
+  check_delta_interleaving(checks, server)
+  check_binary(checks, server)
+  check_drain(checks, server)
+  sys.exit(1 if checks.failures > 0 else 0)
+
+if __name__ == '__main__' :
+  main()
@@ -0,0 +1,181 @@
+############
+# wslite.py for CPython
+#
+# Minimal websocket (RFC 6455) client and server connections, using only the
+# standard library, for the host tools which talk to the servers of the Romi
+# chassis (see romibench.py and romisim.py).
+# Only unfragmented text and binary messages are supported, which is what
+# the servers on the ESP32 send.
+#
+# © Frédéric Boulanger <frederic.softdev@gmail.com>
+# 2020-04-02 -- 2020-05-24
+# This software is licensed under the Eclipse Public License 2.0
+############
+import base64
+import hashlib
+import os
+import socket
+import struct
+from urllib.parse import urlparse
+
+_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+"""
+Compute the value of Sec-WebSocket-Accept for 'key'.
+"""
+def accept_key(key) :
+  return base64.b64encode(hashlib.sha1(key + _GUID).digest())
+
+"""
+Read the header of an HTTP request or answer from 'stream', and return its
+first line and a dictionary of its fields, with names in lower case.
+"""
+def read_http_header(stream) :
+  first = stream.readline().decode('latin-1').strip()
+  fields = {}
+  while True :
+    line = stream.readline().decode('latin-1')
+    if line in ('', '\r\n', '\n') :
+      break
+    name, _, value = line.partition(':')
+    fields[name.strip().lower()] = value.strip()
+  return (first, fields)
+
+"""
+A websocket connection on socket 'sock'. The frames sent by a client are masked.
+"""
+class WebSocket :
+  def __init__(self, sock, client) :
+    self.sock = sock
+    self.stream = sock.makefile('rb')
+    self.client = client
+    self.closed = False
+
+  """
+  Send 'payload' in a frame with opcode 'op'.
+  """
+  def send_frame(self, op, payload) :
+    header = bytearray([0x80 | op])
+    n = len(payload)
+    mask = 0x80 if self.client else 0
+    if n < 126 :
+      header.append(mask | n)
+    elif n < 0x10000 :
+      header.append(mask | 126)
+      header += struct.pack('>H', n)
+    else :
+      header.append(mask | 127)
+      header += struct.pack('>Q', n)
+    if self.client :
+      key = os.urandom(4)
+      header += key
+      payload = bytes([b ^ key[i & 3] for i, b in enumerate(payload)])
+    self.sock.sendall(bytes(header) + payload)
+
+  """
+  Send a message, in a text frame if it is a str, in a binary frame otherwise.
+  """
+  def send(self, message) :
+    if isinstance(message, str) :
+      self.send_frame(OP_TEXT, message.encode('utf-8'))
+    else :
+      self.send_frame(OP_BINARY, bytes(message))
+
+  """
+  Read exactly 'n' bytes.
+  """
+  def read_exact(self, n) :
+    data = self.stream.read(n)
+    if data is None or len(data) < n :
+      raise ConnectionError("Connection closed")
+    return data
+
+  """
+  Receive the next message: a str for a text frame, bytes for a binary frame,
+  or None when the connection is closed. Pings are answered.
+  """
+  def recv(self) :
+    while not self.closed :
+      try :
+        b0, b1 = self.read_exact(2)
+      except (ConnectionError, OSError) :
+        self.closed = True
+        return None
+      op = b0 & 0x0f
+      n = b1 & 0x7f
+      if n == 126 :
+        n = struct.unpack('>H', self.read_exact(2))[0]
+      elif n == 127 :
+        n = struct.unpack('>Q', self.read_exact(8))[0]
+      key = self.read_exact(4) if b1 & 0x80 else None
+      payload = self.read_exact(n)
+      if key is not None :
+        payload = bytes([b ^ key[i & 3] for i, b in enumerate(payload)])
+      if op == OP_TEXT :
+        return payload.decode('utf-8')
+      if op == OP_BINARY :
+        return payload
+      if op == OP_PING :
+        self.send_frame(OP_PONG, payload)
+      elif op == OP_CLOSE :
+        self.close()
+        return None
+    return None
+
+  """
+  Close the connection.
+  """
+  def close(self) :
+    if not self.closed :
+      self.closed = True
+      try :
+        self.send_frame(OP_CLOSE, b'')
+      except OSError :
+        pass
+    try :
+      self.sock.close()
+    except OSError :
+      pass
+
+"""
+Open a websocket connection to 'url' (ws://host:port/path).
+"""
+def connect(url, timeout=5.0) :
+  parts = urlparse(url)
+  host = parts.hostname
+  port = parts.port or 80
+  sock = socket.create_connection((host, port), timeout)
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  key = base64.b64encode(os.urandom(16))
+  request = ("GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+             "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n"
+             % (parts.path or '/', host, port, key.decode()))
+  sock.sendall(request.encode())
+  ws = WebSocket(sock, True)
+  first, fields = read_http_header(ws.stream)
+  if ' 101 ' not in first + ' ' or fields.get('sec-websocket-accept', '').encode() != accept_key(key) :
+    sock.close()
+    raise ConnectionError("Websocket handshake failed: %s" % first)
+  return ws
+
+"""
+Accept a websocket connection on socket 'sock', just accepted by a server.
+"""
+def accept(sock) :
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  ws = WebSocket(sock, False)
+  first, fields = read_http_header(ws.stream)
+  key = fields.get('sec-websocket-key')
+  if key is None :
+    sock.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+    sock.close()
+    raise ConnectionError("Not a websocket request: %s" % first)
+  sock.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+               b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept_key(key.encode()) + b"\r\n\r\n")
+  return ws